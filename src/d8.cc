@@ -17,6 +17,9 @@
 #include <string.h>
 #include <sys/stat.h>
 
+#include <string>
+#include <vector>
+
 #ifdef V8_SHARED
 #include <assert.h>
 #endif  // V8_SHARED
@@ -1326,6 +1329,9 @@ bool Shell::SetOptions(int argc, char* argv[]) {
     } else if (strcmp(argv[i], "--test") == 0) {
       options.test_shell = true;
       argv[i] = NULL;
+    } else if (strcmp(argv[i], "--batch") == 0) {
+      options.batch_mode = true;
+      argv[i] = NULL;
     } else if (strcmp(argv[i], "--send-idle-notification") == 0) {
       options.send_idle_notification = true;
       argv[i] = NULL;
@@ -1409,6 +1415,14 @@ bool Shell::SetOptions(int argc, char* argv[]) {
   }
   current->End(argc);
 
+  if (options.batch_mode &&
+      (options.stress_opt || options.stress_deopt ||
+       options.interactive_shell || options.num_isolates > 1)) {
+    printf("--batch cannot be combined with --stress-opt, --stress-deopt, "
+           "--shell or --isolate\n");
+    return false;
+  }
+
   if (!logfile_per_isolate && options.num_isolates) {
     SetFlagsFromString("--nologfile_per_isolate");
   }
@@ -1464,6 +1478,75 @@ int Shell::RunMain(Isolate* isolate, int argc, char* argv[]) {
 }
 
 
+// Reads a line from stdin into |line|, without the newline.  Returns
+// false at the end of the input.
+static bool ReadBatchLine(std::string* line) {
+  line->clear();
+  int c;
+  while ((c = fgetc(stdin)) != EOF) {
+    if (c == '\n') return true;
+    line->push_back(static_cast<char>(c));
+  }
+  return !line->empty();
+}
+
+
+static const char kBatchMarker[] = "##d8-batch##";
+
+
+// Runs the tests that the test runner writes to stdin, one per line as
+// tab-separated file arguments, each in a fresh context of the same
+// isolate.  The V8 flags are the ones d8 was started with.  A test that
+// fails exits the process just like it would without --batch; after every
+// other test a marker line with exit code 0 is written to both stdout and
+// stderr, so the runner can tell where the output of the test ends.
+int Shell::RunBatch(Isolate* isolate) {
+  printf("%s ready\n", kBatchMarker);
+  fflush(stdout);
+  std::string line;
+  while (ReadBatchLine(&line)) {
+    if (line.empty()) continue;
+    std::vector<char*> args;
+    char* arg = &line[0];
+    while (arg != NULL) {
+      char* tab = strchr(arg, '\t');
+      if (tab != NULL) *tab++ = '\0';
+      if (*arg) args.push_back(arg);
+      arg = tab;
+    }
+    args.push_back(NULL);
+    SourceGroup group;
+    group.Begin(&args[0], 0);
+    group.End(static_cast<int>(args.size()) - 1);
+    {
+      HandleScope scope(isolate);
+      Local<Context> context = CreateEvaluationContext(isolate);
+      Context::Scope cscope(context);
+      PerIsolateData::RealmScope realm_scope(PerIsolateData::Get(isolate));
+      group.Execute(isolate);
+    }
+    // Same as after a run in RunMain(), so that a test gets the same
+    // notifications as in a fresh process.
+    isolate->ContextDisposedNotification();
+    if (options.send_idle_notification) {
+      const int kLongIdlePauseInMs = 1000;
+      isolate->IdleNotification(kLongIdlePauseInMs);
+    }
+    if (options.invoke_weak_callbacks) {
+      // By sending a low memory notifications, we will try hard to collect
+      // all garbage and will therefore also invoke all weak callbacks of
+      // actually unreachable persistent handles.
+      isolate->LowMemoryNotification();
+    }
+    printf("\n%s 0\n", kBatchMarker);
+    fflush(stdout);
+    fprintf(stderr, "\n%s 0\n", kBatchMarker);
+    fflush(stderr);
+  }
+  return 0;
+}
+
+
 #ifndef V8_SHARED
 static void DumpHeapConstants(i::Isolate* isolate) {
   i::Heap* heap = isolate->heap();
@@ -1663,7 +1746,9 @@ int Shell::Main(int argc, char* argv[]) {
     }
 #endif
 
-    if (options.stress_opt || options.stress_deopt) {
+    if (options.batch_mode) {
+      result = RunBatch(isolate);
+    } else if (options.stress_opt || options.stress_deopt) {
       Testing::SetStressRunType(options.stress_opt
                                 ? Testing::kStressTypeOpt
                                 : Testing::kStressTypeDeopt);
@@ -207,6 +207,7 @@ class ShellOptions {
         dump_heap_constants(false),
         expected_to_throw(false),
         mock_arraybuffer_allocator(false),
+        batch_mode(false),
         num_isolates(1),
         compile_options(v8::ScriptCompiler::kNoCompileOptions),
         isolate_sources(NULL),
@@ -219,7 +220,8 @@ class ShellOptions {
   }
 
   bool use_interactive_shell() {
-    return (interactive_shell || !script_executed) && !test_shell;
+    return (interactive_shell || !script_executed) && !test_shell &&
+           !batch_mode;
   }
 
   bool script_executed;
@@ -233,6 +235,7 @@ class ShellOptions {
   bool dump_heap_constants;
   bool expected_to_throw;
   bool mock_arraybuffer_allocator;
+  bool batch_mode;
   int num_isolates;
   v8::ScriptCompiler::CompileOptions compile_options;
   SourceGroup* isolate_sources;
@@ -261,6 +264,7 @@ class Shell : public i::AllStatic {
   static Handle<String> ReadFile(Isolate* isolate, const char* name);
   static Local<Context> CreateEvaluationContext(Isolate* isolate);
   static int RunMain(Isolate* isolate, int argc, char* argv[]);
+  static int RunBatch(Isolate* isolate);
   static int Main(int argc, char* argv[]);
   static void Exit(int exit_code);
   static void OnExit();
@@ -77,6 +77,12 @@ class CcTestSuite(testsuite.TestSuite):
 
   def GetFlagsForTestCase(self, testcase, context):
     testname = testcase.path.split(os.path.sep)[-1]
+    if testcase.dependency is not None:
+      # All tests depending on the same test read the file it writes, so
+      # the runner runs it only once per set of flags. The name must not
+      # contain the path of the dependent test, which the runner replaces
+      # to get the command of the dependency.
+      testname = "dep_" + testcase.dependency.split(os.path.sep)[-1]
     serialization_file = os.path.join(self.serdes_dir, "serdes_" + testname)
     serialization_file += ''.join(testcase.flags).replace('-', '_')
     return (testcase.flags + [testcase.path] + context.mode_flags +
@@ -84,6 +84,9 @@ class MessageTestSuite(testsuite.TestSuite):
             string.find("Native Client module will be loaded") > 0 or
             string.find("NaClHostDescOpen:") > 0)
 
+  def GetExpectationFiles(self, testcase):
+    return [os.path.join(self.root, testcase.path + ".out")]
+
   def IsFailureOutput(self, output, testpath):
     expected_path = os.path.join(self.root, testpath + ".out")
     expected_lines = []
@@ -43,7 +43,7 @@ class MjsunitTestSuite(testsuite.TestSuite):
 
   def ListTests(self, context):
     tests = []
-    for dirname, dirs, files in os.walk(self.root):
+    for dirname, dirs, files in self.GetIndex().Walk(self.root):
       for dotted in [x for x in dirs if x.startswith('.')]:
         dirs.remove(dotted)
       dirs.sort()
@@ -55,13 +55,10 @@ class MjsunitTestSuite(testsuite.TestSuite):
           tests.append(test)
     return tests
 
-  def GetFlagsForTestCase(self, testcase, context):
-    source = self.GetSourceForTest(testcase)
-    flags = [] + context.mode_flags
-    flags_match = re.findall(FLAGS_PATTERN, source)
-    for match in flags_match:
+  def ParseMetadata(self, source):
+    flags = []
+    for match in re.findall(FLAGS_PATTERN, source):
       flags += match.strip().split()
-
     files_list = []  # List of file names to append to command arguments.
     files_match = FILES_PATTERN.search(source);
     # Accept several lines of 'Files:'.
@@ -71,10 +68,20 @@ class MjsunitTestSuite(testsuite.TestSuite):
         files_match = FILES_PATTERN.search(source, files_match.end())
       else:
         break
-    files = [ os.path.normpath(os.path.join(self.root, '..', '..', f))
-              for f in files_list ]
+    return {
+      "flags": flags,
+      "files": files_list,
+      "env": bool(SELF_SCRIPT_PATTERN.search(source)),
+    }
+
+  def GetFlagsForTestCase(self, testcase, context):
     testfilename = os.path.join(self.root, testcase.path + self.suffix())
-    if SELF_SCRIPT_PATTERN.search(source):
+    metadata = self.GetMetadata(testfilename)
+    flags = context.mode_flags + metadata["flags"]
+
+    files = [ os.path.normpath(os.path.join(self.root, '..', '..', f))
+              for f in metadata["files"] ]
+    if metadata["env"]:
       env = ["-e", "TEST_FILE_NAME=\"%s\"" % testfilename.replace("\\", "\\\\")]
       files = env + files
     files.append(os.path.join(self.root, "mjsunit.js"))
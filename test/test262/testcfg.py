@@ -57,7 +57,7 @@ class Test262TestSuite(testsuite.TestSuite):
 
   def ListTests(self, context):
     tests = []
-    for dirname, dirs, files in os.walk(self.testroot):
+    for dirname, dirs, files in self.GetIndex().Walk(self.testroot):
       for dotted in [x for x in dirs if x.startswith(".")]:
         dirs.remove(dotted)
       if context.noi18n and "intl402" in dirs:
@@ -81,8 +81,12 @@ class Test262TestSuite(testsuite.TestSuite):
     with open(filename) as f:
       return f.read()
 
+  def ParseMetadata(self, source):
+    return {"negative": "@negative" in source}
+
   def IsNegativeTest(self, testcase):
-    return "@negative" in self.GetSourceForTest(testcase)
+    filename = os.path.join(self.testroot, testcase.path + ".js")
+    return self.GetMetadata(filename)["negative"]
 
   def IsFailureOutput(self, output, testpath):
     if output.exit_code != 0:
@@ -111,6 +111,9 @@ class WebkitTestSuite(testsuite.TestSuite):
             string.find("Native Client module will be loaded") > 0 or
             string.find("NaClHostDescOpen:") > 0)
 
+  def GetExpectationFiles(self, testcase):
+    return [os.path.join(self.root, testcase.path) + "-expected.txt"]
+
   def IsFailureOutput(self, output, testpath):
     if super(WebkitTestSuite, self).IsFailureOutput(output, testpath):
       return True
@@ -42,6 +42,7 @@ import time
 
 from testrunner.local import execution
 from testrunner.local import progress
+from testrunner.local import sharding
 from testrunner.local import testsuite
 from testrunner.local import utils
 from testrunner.local import verbose
@@ -192,6 +193,10 @@ def BuildOptions():
   result.add_option("-m", "--mode",
                     help="The test modes in which to run (comma-separated)",
                     default="release,debug")
+  result.add_option("--max-output-size",
+                    help=("Maximum number of bytes kept of each of stdout and "
+                          "stderr of a test, 0 for no limit"),
+                    default=16 * 1024 * 1024, type="int")
   result.add_option("--outdir", help="Base directory with compile output",
                     default="out")
   result.add_option("-p", "--progress",
@@ -268,22 +273,6 @@ def ProcessOptions(options):
   return True
 
 
-def ShardTests(tests, shard_count, shard_run):
-  if shard_count < 2:
-    return tests
-  if shard_run < 1 or shard_run > shard_count:
-    print "shard-run not a valid number, should be in [1:shard-count]"
-    print "defaulting back to running all tests"
-    return tests
-  count = 0
-  shard = []
-  for test in tests:
-    if count % shard_count == shard_run - 1:
-      shard.append(test)
-    count += 1
-  return shard
-
-
 def Main():
   parser = BuildOptions()
   (options, args) = parser.parse_args()
@@ -317,13 +306,17 @@ def Main():
     for s in suites:
       s.DownloadData()
 
-  for mode in options.mode:
-    for arch in options.arch:
-      try:
-        code = Execute(arch, mode, args, options, suites, workspace)
-        exit_code = exit_code or code
-      except KeyboardInterrupt:
-        return 2
+  try:
+    for mode in options.mode:
+      for arch in options.arch:
+        try:
+          code = Execute(arch, mode, args, options, suites, workspace)
+          exit_code = exit_code or code
+        except KeyboardInterrupt:
+          return 2
+  finally:
+    for s in suites:
+      s.SaveIndex()
   return exit_code
 
 
@@ -374,7 +367,12 @@ def Execute(arch, mode, args, options, suites, workspace):
                         True,  # No sorting of test cases.
                         0,  # Don't rerun failing tests.
                         0,  # No use of a rerun-failing-tests maximum.
-                        False)  # No predictable mode.
+                        False,  # No predictable mode.
+                        options.max_output_size or None,
+                        False,  # No batch workers.
+                        False,  # No adaptive timeouts.
+                        None,  # No result cache.
+                        False)  # Worker processes, not threads.
 
   # Find available test suites and read test cases from them.
   variables = {
@@ -397,6 +395,7 @@ def Execute(arch, mode, args, options, suites, workspace):
   # Remember test case prototypes for the fuzzing phase.
   test_backup = dict((s, []) for s in suites)
 
+  sharder = sharding.Sharder(options.shard_count, options.shard_run)
   for s in suites:
     s.ReadStatusFile(variables)
     s.ReadTestCases(ctx)
@@ -404,6 +403,7 @@ def Execute(arch, mode, args, options, suites, workspace):
       s.FilterTestCasesByArgs(args)
     all_tests += s.tests
     s.FilterTestCasesByStatus(False)
+    s.tests = sharder.Shard(s.tests)
     test_backup[s] = s.tests
     analysis_flags = ["--deopt-every-n-times", "%d" % MAX_DEOPT,
                       "--print-deopt-stress"]
@@ -42,7 +42,10 @@ import sys
 import time
 
 from testrunner.local import execution
+from testrunner.local import perfdata
 from testrunner.local import progress
+from testrunner.local import resultcache
+from testrunner.local import sharding
 from testrunner.local import testsuite
 from testrunner.local import utils
 from testrunner.local import verbose
@@ -134,6 +137,10 @@ SLOW_ARCHS = ["android_arm",
 
 def BuildOptions():
   result = optparse.OptionParser()
+  result.add_option("--adaptive-timeouts",
+                    help=("Give tests with enough perf data a timeout based "
+                          "on their earlier durations, capped by --timeout"),
+                    default=False, action="store_true")
   result.add_option("--arch",
                     help=("The architecture to run tests for, "
                           "'auto' or 'native' for auto-detect"),
@@ -144,11 +151,18 @@ def BuildOptions():
   result.add_option("--asan",
                     help="Regard test expectations for ASAN",
                     default=False, action="store_true")
+  result.add_option("--batch-workers",
+                    help=("Run d8 tests in long-lived d8 processes that run "
+                          "many tests each (needs a d8 with --batch)"),
+                    default=False, action="store_true")
   result.add_option("--buildbot",
                     help="Adapt to path structure used on buildbots",
                     default=False, action="store_true")
   result.add_option("--cat", help="Print the source of the tests",
                     default=False, action="store_true")
+  result.add_option("--clear-result-cache",
+                    help="Forget the tests cached by --result-cache",
+                    default=False, action="store_true")
   result.add_option("--flaky-tests",
                     help="Regard tests marked as flaky (run|skip|dontcare)",
                     default="dontcare")
@@ -176,6 +190,10 @@ def BuildOptions():
   result.add_option("-m", "--mode",
                     help="The test modes in which to run (comma-separated)",
                     default="release,debug")
+  result.add_option("--max-output-size",
+                    help=("Maximum number of bytes kept of each of stdout and "
+                          "stderr of a test, 0 for no limit"),
+                    default=16 * 1024 * 1024, type="int")
   result.add_option("--no-i18n", "--noi18n",
                     help="Skip internationalization tests",
                     default=False, action="store_true")
@@ -215,6 +233,14 @@ def BuildOptions():
                     default=False, action="store_true")
   result.add_option("--json-test-results",
                     help="Path to a file for storing json results.")
+  result.add_option("--result-cache",
+                    help=("Skip tests that passed before with the same "
+                          "binary, test files, flags and expectations"),
+                    default=False, action="store_true")
+  result.add_option("--result-cache-size",
+                    help=("Number of passes kept by --result-cache, the least "
+                          "recently used are dropped"),
+                    default=100000, type="int")
   result.add_option("--rerun-failures-count",
                     help=("Number of times to rerun each failing test case. "
                           "Very slow tests will be rerun only once."),
@@ -225,6 +251,10 @@ def BuildOptions():
   result.add_option("--shard-count",
                     help="Split testsuites into this number of shards",
                     default=1, type="int")
+  result.add_option("--shard-durations",
+                    help=("Balance the shards by the test durations in this "
+                          "file, see --write-shard-durations. All shards "
+                          "need the same file"))
   result.add_option("--shard-run",
                     help="Run this shard from the split up tests.",
                     default=1, type="int")
@@ -238,6 +268,10 @@ def BuildOptions():
   result.add_option("--stress-only",
                     help="Only run tests with --always-opt --stress-opt",
                     default=False, action="store_true")
+  result.add_option("--thread-workers",
+                    help=("Run the tests from threads of the test runner "
+                          "instead of worker processes"),
+                    default=False, action="store_true")
   result.add_option("--time", help="Print timing information after running",
                     default=False, action="store_true")
   result.add_option("-t", "--timeout", help="Timeout in seconds",
@@ -251,6 +285,9 @@ def BuildOptions():
                     default=False, action="store_true")
   result.add_option("--warn-unused", help="Report unused rules",
                     default=False, action="store_true")
+  result.add_option("--write-shard-durations",
+                    help=("Write the test durations of the local perf data "
+                          "to this file for --shard-durations, and exit"))
   result.add_option("--junitout", help="File name of the JUnit output")
   result.add_option("--junittestsuite",
                     help="The testsuite name in the JUnit output file",
@@ -290,6 +327,15 @@ def ProcessOptions(options):
 
   # Special processing of other options, sorted alphabetically.
 
+  if options.shard_durations and not os.path.isfile(options.shard_durations):
+    print("Shard durations file not found: %s" % options.shard_durations)
+    return False
+  if options.write_shard_durations:
+    options.arch_and_mode = list(options.arch_and_mode)
+    if len(options.arch_and_mode) != 1:
+      print("--write-shard-durations needs exactly one arch and mode.")
+      return False
+
   if options.buildbot:
     # Buildbots run presubmit tests as a separate step.
     options.no_presubmit = True
@@ -372,22 +418,6 @@ def ProcessOptions(options):
   return True
 
 
-def ShardTests(tests, shard_count, shard_run):
-  if shard_count < 2:
-    return tests
-  if shard_run < 1 or shard_run > shard_count:
-    print "shard-run not a valid number, should be in [1:shard-count]"
-    print "defaulting back to running all tests"
-    return tests
-  count = 0
-  shard = []
-  for test in tests:
-    if count % shard_count == shard_run - 1:
-      shard.append(test)
-    count += 1
-  return shard
-
-
 def Main():
   parser = BuildOptions()
   (options, args) = parser.parse_args()
@@ -430,16 +460,23 @@ def Main():
     if suite:
       suites.append(suite)
 
+  if options.clear_result_cache:
+    resultcache.Clear(os.path.join("out", "testrunner_data"))
+
   if options.download_data:
     for s in suites:
       s.DownloadData()
 
-  for (arch, mode) in options.arch_and_mode:
-    try:
-      code = Execute(arch, mode, args, options, suites, workspace)
-    except KeyboardInterrupt:
-      return 2
-    exit_code = exit_code or code
+  try:
+    for (arch, mode) in options.arch_and_mode:
+      try:
+        code = Execute(arch, mode, args, options, suites, workspace)
+      except KeyboardInterrupt:
+        return 2
+      exit_code = exit_code or code
+  finally:
+    for s in suites:
+      s.SaveIndex()
   return exit_code
 
 
@@ -459,6 +496,15 @@ def Execute(arch, mode, args, options, suites, workspace):
   if mode == "optdebug":
     mode = "debug"  # "optdebug" is just an alias.
 
+  if options.write_shard_durations:
+    perf_data_manager = perfdata.PerfDataManager(
+        os.path.join("out", "testrunner_data"))
+    sharding.WriteDurations(options.write_shard_durations,
+                            perf_data_manager.GetStore(arch, mode))
+    perf_data_manager.close()
+    print(">>> Wrote test durations to %s" % options.write_shard_durations)
+    return 0
+
   # Populate context object.
   mode_flags = MODE_FLAGS[mode]
   timeout = options.timeout
@@ -475,6 +521,11 @@ def Execute(arch, mode, args, options, suites, workspace):
     # Predictable mode is slower.
     timeout *= 2
 
+  # Passes in predictable mode are about allocations, not results.
+  result_cache = None
+  if options.result_cache and not options.predictable:
+    result_cache = max(options.result_cache_size, 1)
+
   ctx = context.Context(arch, mode, shell_dir,
                         mode_flags, options.verbose,
                         timeout, options.isolates,
@@ -485,7 +536,12 @@ def Execute(arch, mode, args, options, suites, workspace):
                         options.no_sorting,
                         options.rerun_failures_count,
                         options.rerun_failures_max,
-                        options.predictable)
+                        options.predictable,
+                        options.max_output_size or None,
+                        options.batch_workers,
+                        options.adaptive_timeouts,
+                        result_cache,
+                        options.thread_workers)
 
   # TODO(all): Combine "simulator" and "simulator_run".
   simulator_run = not options.dont_skip_simulator_slow_tests and \
@@ -508,6 +564,11 @@ def Execute(arch, mode, args, options, suites, workspace):
   all_tests = []
   num_tests = 0
   test_id = 0
+  durations = None
+  if options.shard_durations:
+    durations = sharding.ReadDurations(options.shard_durations)
+  sharder = sharding.Sharder(options.shard_count, options.shard_run,
+                             durations)
   for s in suites:
     s.ReadStatusFile(variables)
     s.ReadTestCases(ctx)
@@ -523,7 +584,7 @@ def Execute(arch, mode, args, options, suites, workspace):
     s.tests = [ t.CopyAddingFlags(v)
                 for t in s.tests
                 for v in s.VariantFlags(t, variant_flags) ]
-    s.tests = ShardTests(s.tests, options.shard_count, options.shard_run)
+    s.tests = sharder.Shard(s.tests)
     num_tests += len(s.tests)
     for t in s.tests:
       t.id = test_id
@@ -539,6 +600,8 @@ def Execute(arch, mode, args, options, suites, workspace):
     print "No tests to run."
     return 0
 
+  sharder.PrintPrediction(options.j)
+
   # Run the tests, either locally or distributed on the network.
   start_time = time.time()
   progress_indicator = progress.PROGRESS_INDICATORS[options.progress]()
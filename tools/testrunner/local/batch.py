@@ -0,0 +1,285 @@
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Runs d8 tests in long-lived d8 processes started with --batch.
+
+Every pool worker keeps a few d8 workers, one per set of V8 flags. A
+worker gets the file arguments of one test per line on stdin, runs them
+in a fresh context and writes END_OF_TEST to stdout and stderr once the
+test has passed. A test that fails ends the worker with the exit code d8
+would have used anyway, and the next test starts a new worker.
+
+The output of the workers is read with commands.WaitReadable(), so batch
+mode is not available on Windows.
+"""
+
+import collections
+import os
+import subprocess
+import threading
+import time
+
+from . import commands
+from . import utils
+from ..objects import output
+
+
+# Must match kBatchMarker in src/d8.cc.
+MARKER = "##d8-batch##"
+READY = "%s ready\n" % MARKER
+END_OF_TEST = "\n%s 0\n" % MARKER
+TAIL_SIZE = max(len(READY), len(END_OF_TEST))
+
+# Arguments that d8 does not support with --batch, or that only work once
+# per process.
+UNBATCHABLE_ARGS = frozenset(["--", "--batch", "--isolate", "--shell",
+                              "--stress-opt", "--stress-deopt"])
+
+# How long a new worker may take until it is ready for the first test.
+STARTUP_TIMEOUT = 60.0
+
+# Number of idle workers with different flags kept per pool worker.
+MAX_WORKERS = 4
+
+
+def SplitCommand(args):
+  """Splits the d8 command |args| into the V8 flags and the sources.
+
+  The sources are the file names and "-e <code>" pairs, in order. A flag
+  without "=" that is followed by an argument that is neither a flag nor
+  an existing file takes that argument as its value, e.g.
+  "--deopt-every-n-times 5". Returns None if the command cannot run in a
+  batch worker.
+  """
+  for arg in args:
+    if "\t" in arg or "\n" in arg:
+      return None
+  flags = []
+  sources = []
+  i = 1
+  while i < len(args):
+    arg = args[i]
+    if arg in UNBATCHABLE_ARGS or arg.startswith("--stress-runs"):
+      return None
+    if arg == "-e":
+      if i + 1 == len(args):
+        return None
+      sources += args[i:i + 2]
+      i += 2
+      continue
+    if arg.startswith("-"):
+      flags.append(arg)
+      if (arg.startswith("--") and "=" not in arg and i + 1 < len(args) and
+          not args[i + 1].startswith("-") and
+          not os.path.isfile(args[i + 1])):
+        flags.append(args[i + 1])
+        i += 1
+    elif arg:
+      sources.append(arg)
+    i += 1
+  if not sources:
+    return None
+  return (flags, sources)
+
+
+class Stream(object):
+  """Collects a pipe of a worker, see Worker._Read().
+
+  All but the last TAIL_SIZE bytes go to a commands.OutputReader, which
+  caps them at |limit| as they arrive. The last bytes are held back, so
+  that a terminator is recognized and stripped without being truncated.
+  """
+
+  def __init__(self, pipe, limit):
+    self.pipe = pipe
+    self.fd = pipe.fileno()
+    self.limit = limit
+    self.reader = commands.OutputReader(pipe, limit, threaded=False)
+    self.tail = ""
+    self.eof = False
+
+  def Add(self, chunk):
+    if not chunk:
+      self.eof = True
+      self.pipe.close()
+      return
+    if len(chunk) >= TAIL_SIZE:
+      if self.tail:
+        self.reader.Add(self.tail)
+      if len(chunk) > TAIL_SIZE:
+        self.reader.Add(chunk[:-TAIL_SIZE])
+      self.tail = chunk[-TAIL_SIZE:]
+      return
+    data = self.tail + chunk
+    if len(data) > TAIL_SIZE:
+      self.reader.Add(data[:-TAIL_SIZE])
+    self.tail = data[-TAIL_SIZE:]
+
+  def EndsWith(self, terminator):
+    return self.tail.endswith(terminator)
+
+  def IsWaiting(self, terminator):
+    return not self.eof and not self.EndsWith(terminator)
+
+  def Take(self, terminator):
+    """Returns the data collected so far without a final |terminator| and
+    whether it ended with |terminator|, and empties the stream."""
+    found = self.EndsWith(terminator)
+    tail = self.tail
+    if found:
+      tail = tail[:-len(terminator)]
+    if tail:
+      self.reader.Add(tail)
+    data = self.reader.Result()
+    self.reader = commands.OutputReader(self.pipe, self.limit, threaded=False)
+    self.tail = ""
+    return (data, found)
+
+
+class Worker(object):
+  def __init__(self, shell, flags, verbose, max_output):
+    self.process = commands.StartProcess(verbose, [shell, "--batch"] + flags,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+    with all_workers_lock:
+      all_workers.add(self)
+    # Each of stdout and stderr of a test is capped at |max_output| bytes.
+    self.stdout = Stream(self.process.stdout, max_output)
+    self.stderr = Stream(self.process.stderr, max_output)
+    self.tests_run = 0
+    self._Read([self.stdout], READY, time.time() + STARTUP_TIMEOUT)
+    (_, self.ready) = self.stdout.Take(READY)
+    # Anything d8 printed at startup belongs to no test.
+    self._Read([self.stderr], END_OF_TEST, time.time())
+    self.stderr.Take(END_OF_TEST)
+
+  def _Read(self, streams, terminator, deadline):
+    """Reads from |streams| until each of them ends with |terminator| or is
+    closed, or until |deadline| has passed."""
+    while True:
+      waiting = dict((s.fd, s) for s in streams if s.IsWaiting(terminator))
+      if not waiting:
+        return
+      wait = None
+      if deadline is not None:
+        wait = max(0, deadline - time.time())
+      ready = commands.WaitReadable(waiting.keys(), wait)
+      if not ready:
+        return
+      for fd in ready:
+        waiting[fd].Add(os.read(fd, 65536))
+
+  def Run(self, sources, timeout):
+    """Runs one test. Returns (output, passed), where |passed| is False if
+    the test ended the worker, crashed it or timed out."""
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    try:
+      self.process.stdin.write("\t".join(sources) + "\n")
+      self.process.stdin.flush()
+    except IOError:
+      # The worker died since the last test.
+      pass
+    self._Read([self.stdout, self.stderr], END_OF_TEST, deadline)
+    if self.stdout.EndsWith(END_OF_TEST) and self.stderr.EndsWith(END_OF_TEST):
+      self.tests_run += 1
+      return (output.Output(0, False, self.stdout.Take(END_OF_TEST)[0],
+                            self.stderr.Take(END_OF_TEST)[0]), True)
+    # Without the terminator, the pipes were either closed by the exiting
+    # worker or the deadline has passed.
+    timed_out = not (self.stdout.eof and self.stderr.eof)
+    if timed_out:
+      # The watchdog follows up with SIGKILL if d8 ignores SIGTERM.
+      (exit_code, _) = commands.WaitForProcess(self.process, 0)
+    else:
+      exit_code = self.process.wait()
+    # Collect what was written after the deadline, but do not wait for
+    # pipes inherited by children of d8 for long.
+    self._Read([self.stdout, self.stderr], END_OF_TEST,
+               time.time() + commands.OUTPUT_GRACE_TIME)
+    return (output.Output(exit_code, timed_out,
+                          self.stdout.Take(END_OF_TEST)[0],
+                          self.stderr.Take(END_OF_TEST)[0]), False)
+
+  def Close(self):
+    """Ends the worker, which is killed unless it exits right away."""
+    with all_workers_lock:
+      all_workers.discard(self)
+    try:
+      self.process.stdin.close()
+    except IOError:
+      pass
+    commands.WaitForProcess(self.process, commands.OUTPUT_GRACE_TIME)
+    for stream in (self.stdout, self.stderr):
+      if not stream.eof:
+        stream.pipe.close()
+
+
+# Holds the idle workers of each pool thread in |workers|, least recently
+# used first, keyed by the shell, the output cap and the flags.
+local = threading.local()
+
+# All workers of this process that were not closed yet.
+all_workers = set()
+all_workers_lock = threading.Lock()
+
+# Keys whose workers did not start, e.g. because of a d8 without --batch.
+unbatchable = set()
+
+
+def Execute(args, verbose=False, timeout=None, max_output=None):
+  """Runs the d8 command |args| like commands.Execute, but in a batch
+  worker if possible.
+
+  A test that does not pass in a worker that ran other tests before is
+  run again in a fresh process, so that failures are never caused by
+  state left behind by earlier tests.
+  """
+  args = [ c for c in args if c != "" ]
+  split = SplitCommand(args)
+  key = None
+  if split is not None:
+    key = (args[0], max_output) + tuple(split[0])
+  if key is None or key in unbatchable or utils.IsWindows():
+    return commands.Execute(args, verbose, timeout, max_output)
+  (flags, sources) = split
+  if not hasattr(local, "workers"):
+    local.workers = collections.OrderedDict()
+  workers = local.workers
+  worker = workers.pop(key, None)
+  if worker is None:
+    worker = Worker(args[0], flags, verbose, max_output)
+    if not worker.ready:
+      worker.Close()
+      unbatchable.add(key)
+      return commands.Execute(args, verbose, timeout, max_output)
+  if verbose: print "#", " ".join(sources)
+  (result, passed) = worker.Run(sources, timeout)
+  if passed:
+    workers[key] = worker
+    while len(workers) > MAX_WORKERS:
+      workers.popitem(last=False)[1].Close()
+    return result
+  worker.Close()
+  if worker.tests_run and not result.HasTimedOut():
+    return commands.Execute(args, verbose, timeout, max_output)
+  return result
+
+
+def CloseWorkers():
+  """Closes the idle workers of the calling pool worker."""
+  workers = getattr(local, "workers", {})
+  while workers:
+    workers.popitem()[1].Close()
+
+
+def CloseAll():
+  """Closes all workers of this process, e.g. those of pool worker threads
+  that were interrupted."""
+  with all_workers_lock:
+    workers = list(all_workers)
+  for worker in workers:
+    worker.Close()
@@ -26,27 +26,34 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import collections
+import ctypes
+import errno
+import heapq
+import itertools
+import math
 import os
+import select
 import signal
 import subprocess
 import sys
-import tempfile
+import threading
 import time
 
 from ..local import utils
 from ..objects import output
 
 
-def KillProcessWithID(pid):
+def KillProcessWithID(pid, sig=signal.SIGTERM):
   if utils.IsWindows():
     os.popen('taskkill /T /F /PID %d' % pid)
   else:
-    os.kill(pid, signal.SIGTERM)
+    os.kill(pid, sig)
 
 
-MAX_SLEEP_TIME = 0.1
-INITIAL_SLEEP_TIME = 0.0001
-SLEEP_TIME_FACTOR = 1.25
+# Seconds a timed-out process gets to exit after SIGTERM before SIGKILL.
+KILL_GRACE_TIME = 1.0
+
 
 SEM_INVALID_VALUE = -1
 SEM_NOGPFAULTERRORBOX = 0x0002  # Microsoft Platform SDK WinBase.h
@@ -63,7 +70,7 @@ def Win32SetErrorMode(mode):
   return prev_error_mode
 
 
-def RunProcess(verbose, timeout, args, **rest):
+def StartProcess(verbose, args, **rest):
   if verbose: print "#", " ".join(args)
   popen_args = args
   prev_error_mode = SEM_INVALID_VALUE
@@ -82,70 +89,348 @@ def RunProcess(verbose, timeout, args, **rest):
   )
   if (utils.IsWindows() and prev_error_mode != SEM_INVALID_VALUE):
     Win32SetErrorMode(prev_error_mode)
-  # Compute the end time - if the process crosses this limit we
-  # consider it timed out.
-  if timeout is None: end_time = None
-  else: end_time = time.time() + timeout
-  timed_out = False
-  # Repeatedly check the exit code from the process in a
-  # loop and keep track of whether or not it times out.
-  exit_code = None
-  sleep_time = INITIAL_SLEEP_TIME
-  while exit_code is None:
-    if (not end_time is None) and (time.time() >= end_time):
-      # Kill the process and wait for it to exit.
-      KillProcessWithID(process.pid)
-      exit_code = process.wait()
-      timed_out = True
-    else:
-      exit_code = process.poll()
-      time.sleep(sleep_time)
-      sleep_time = sleep_time * SLEEP_TIME_FACTOR
-      if sleep_time > MAX_SLEEP_TIME:
-        sleep_time = MAX_SLEEP_TIME
-  return (exit_code, timed_out)
-
-
-def PrintError(string):
-  sys.stderr.write(string)
-  sys.stderr.write("\n")
-
-
-def CheckedUnlink(name):
-  # On Windows, when run with -jN in parallel processes,
-  # OS often fails to unlink the temp file. Not sure why.
-  # Need to retry.
-  # Idea from https://bugs.webkit.org/attachment.cgi?id=75982&action=prettypatch
-  retry_count = 0
-  while retry_count < 30:
+  return process
+
+
+def WaitReadable(fds, timeout):
+  """Waits until one of the pipes |fds| has data or is closed, for at most
+  |timeout| seconds unless it is None. Returns the fds ready for reading,
+  or none at the timeout.
+
+  Uses poll() where possible, since select() fails for fds of FD_SETSIZE
+  (1024) and above, which a runner with many worker threads can reach.
+  Pipes cannot be waited for like this on Windows.
+  """
+  deadline = None
+  if timeout is not None:
+    deadline = time.time() + timeout
+  while True:
     try:
-      os.unlink(name)
-      return
-    except OSError, e:
-      retry_count += 1
-      time.sleep(retry_count * 0.1)
-  PrintError("os.unlink() " + str(e))
+      if hasattr(select, "poll"):
+        poller = select.poll()
+        for fd in fds:
+          poller.register(fd, select.POLLIN)
+        if timeout is None:
+          return [fd for (fd, _) in poller.poll()]
+        # In milliseconds, rounded up so as not to wake up too early.
+        return [fd for (fd, _) in
+                poller.poll(int(math.ceil(max(0, timeout) * 1000)))]
+      return select.select(fds, [], [], timeout)[0]
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+    if deadline is not None:
+      timeout = deadline - time.time()
+
+
+class Watchdog(object):
+  """Kills processes that run past their deadline, all from one thread.
+  A process gets SIGTERM at its deadline and SIGKILL KILL_GRACE_TIME
+  seconds later.
+
+  The thread sleeps in WaitReadable() until the next deadline. A pipe
+  wakes it up early when a sooner deadline is added. Pipes cannot be
+  waited for on Windows, so the watchdog is not used there.
+  """
+
+  def __init__(self):
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+    # Heap of [deadline, sequence number, process or None once it exited,
+    # whether it timed out and got SIGTERM].
+    self.deadlines = []
+    self.exited = 0  # Entries in |deadlines| whose process exited.
+    self.sequence = itertools.count()
+    (self.wakeup_read, self.wakeup_write) = os.pipe()
+    self.thread = threading.Thread(target=self._Run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Add(self, process, timeout):
+    """Watches |process|. Pass the result to Remove() once it exited."""
+    entry = [time.time() + timeout, next(self.sequence), process, False]
+    with self.lock:
+      heapq.heappush(self.deadlines, entry)
+      if self.deadlines[0] is entry:
+        os.write(self.wakeup_write, "x")
+    return entry
 
+  def Remove(self, entry):
+    """Stops watching and returns whether the process timed out."""
+    with self.lock:
+      if entry[2] is not None:
+        entry[2] = None
+        self.exited += 1
+        # Drop the entries of exited processes once they are the majority.
+        if self.exited * 2 > len(self.deadlines):
+          self.deadlines = [e for e in self.deadlines if e[2] is not None]
+          heapq.heapify(self.deadlines)
+          self.exited = 0
+      return entry[3]
 
-def Execute(args, verbose=False, timeout=None):
+  def _Run(self):
+    while True:
+      with self.lock:
+        now = time.time()
+        while self.deadlines and (self.deadlines[0][2] is None or
+                                  self.deadlines[0][0] <= now):
+          entry = heapq.heappop(self.deadlines)
+          process = entry[2]
+          if process is None:
+            self.exited -= 1
+            continue
+          # WaitForProcess() reaps the process only after removing it, or
+          # while holding the lock, see WaitForExit().
+          if process.returncode is not None:
+            entry[2] = None
+          elif not entry[3]:
+            entry[3] = True
+            KillProcessWithID(process.pid)
+            entry[0] = now + KILL_GRACE_TIME
+            heapq.heappush(self.deadlines, entry)
+          else:
+            entry[2] = None
+            KillProcessWithID(process.pid, signal.SIGKILL)
+        wait = None
+        if self.deadlines:
+          wait = self.deadlines[0][0] - now
+      if WaitReadable([self.wakeup_read], wait):
+        os.read(self.wakeup_read, 4096)
+
+
+# The waitid() arguments P_PID and WEXITED | WNOWAIT by OS.
+WAITID_ARGS = {
+  "linux": (1, 0x4 | 0x01000000),
+  "macos": (1, 0x4 | 0x20),
+}
+
+# Interval of the fallback in WaitForExit().
+POLL_INTERVAL = 0.01
+
+
+def WaitForExit(process, lock):
+  """Blocks until |process| exits. Where waitid() is available, the process
+  is left unreaped, so its pid cannot be reused before process.wait().
+  Elsewhere it is reaped while holding |lock|."""
+  args = WAITID_ARGS.get(utils.GuessOS())
+  if args is not None:
+    waitid = ctypes.CDLL(None, use_errno=True).waitid
+    siginfo = ctypes.create_string_buffer(256)  # More than a siginfo_t.
+    while waitid(args[0], process.pid, siginfo, args[1]) != 0:
+      error = ctypes.get_errno()
+      if error == errno.ECHILD:
+        return  # Reaped already.
+      if error != errno.EINTR:
+        raise OSError(error, os.strerror(error))
+    return
+  while True:
+    with lock:
+      if process.poll() is not None:
+        return
+    time.sleep(POLL_INTERVAL)
+
+
+watchdog = None
+watchdog_lock = threading.Lock()
+
+
+def GetWatchdog():
+  global watchdog
+  with watchdog_lock:
+    # A forked child has the object, but not the thread.
+    if watchdog is None or watchdog.pid != os.getpid():
+      watchdog = Watchdog()
+    return watchdog
+
+
+def WaitForProcess(process, timeout):
+  # Block until the process exits. If it is still running when the timeout
+  # expires, it is killed and counts as timed out.
+  if timeout is None:
+    return (process.wait(), False)
+  if not utils.IsWindows():
+    watchdog = GetWatchdog()
+    entry = watchdog.Add(process, timeout)
+    try:
+      WaitForExit(process, watchdog.lock)
+    finally:
+      # The process is not reaped yet, so the watchdog cannot kill another
+      # process with the same pid before it is removed.
+      timed_out = watchdog.Remove(entry)
+    return (process.wait(), timed_out)
+  state = {"timed_out": False, "exited": False}
+  lock = threading.Lock()
+  def KillOnTimeout():
+    with lock:
+      # The pid might have been reused once the process has been reaped.
+      if not state["exited"]:
+        state["timed_out"] = True
+        KillProcessWithID(process.pid)
+  timer = threading.Timer(timeout, KillOnTimeout)
+  timer.daemon = True
+  timer.start()
   try:
-    args = [ c for c in args if c != "" ]
-    (fd_out, outname) = tempfile.mkstemp()
-    (fd_err, errname) = tempfile.mkstemp()
-    (exit_code, timed_out) = RunProcess(
-      verbose,
-      timeout,
-      args=args,
-      stdout=fd_out,
-      stderr=fd_err
-    )
+    exit_code = process.wait()
   finally:
-    # TODO(machenbach): A keyboard interrupt before the assignment to
-    # fd_out|err can lead to reference errors here.
-    os.close(fd_out)
-    os.close(fd_err)
-    out = file(outname).read()
-    errors = file(errname).read()
-    CheckedUnlink(outname)
-    CheckedUnlink(errname)
-  return output.Output(exit_code, timed_out, out, errors)
+    with lock:
+      state["exited"] = True
+    # No need to wait for the timer, it does nothing any more.
+    timer.cancel()
+  return (exit_code, state["timed_out"])
+
+
+def RunProcess(verbose, timeout, args, **rest):
+  process = StartProcess(verbose, args, **rest)
+  return WaitForProcess(process, timeout)
+
+
+# Inserted where the middle of an over-long output stream was dropped.
+TRUNCATION_MARKER = "\n\n[... %d bytes of output truncated ...]\n\n"
+
+# How long to wait for the output of a killed process, whose pipes might
+# have been inherited by a child that is still running.
+OUTPUT_GRACE_TIME = 1.0
+
+
+class OutputReader(object):
+  """Drains a pipe, on a background thread unless |threaded| is False, in
+  which case the owner passes the data to Add().
+
+  If |limit| is not None and more than |limit| bytes arrive, only the
+  first and the last |limit| / 2 bytes are kept, so that both the start of
+  the output and a crash report at its end survive, and the dropped middle
+  is replaced by TRUNCATION_MARKER.
+  """
+
+  def __init__(self, pipe, limit, threaded=True):
+    self.pipe = pipe
+    self.limit = limit
+    self.head = []
+    self.head_size = 0
+    self.tail = collections.deque()
+    self.tail_size = 0
+    self.dropped = 0
+    # Guards the buffers, in case Result() gives up waiting for the thread.
+    self.lock = threading.Lock()
+    self.thread = None
+    if threaded:
+      self.thread = threading.Thread(target=self._Read)
+      self.thread.daemon = True
+      self.thread.start()
+
+  def _Read(self):
+    fd = self.pipe.fileno()
+    while True:
+      chunk = os.read(fd, 65536)
+      if not chunk:
+        break
+      self.Add(chunk)
+    self.pipe.close()
+
+  def Add(self, chunk):
+    with self.lock:
+      self._Add(chunk)
+
+  def _Add(self, chunk):
+    if self.limit is None:
+      self.head.append(chunk)
+      return
+    head_limit = self.limit // 2
+    if self.head_size < head_limit:
+      part = chunk[:head_limit - self.head_size]
+      self.head.append(part)
+      self.head_size += len(part)
+      chunk = chunk[len(part):]
+    if not chunk:
+      return
+    self.tail.append(chunk)
+    self.tail_size += len(chunk)
+    tail_limit = self.limit - head_limit
+    while self.tail_size - len(self.tail[0]) >= tail_limit:
+      dropped = self.tail.popleft()
+      self.tail_size -= len(dropped)
+      self.dropped += len(dropped)
+
+  def Result(self, timeout=None):
+    if self.thread is not None:
+      self.thread.join(timeout)
+    with self.lock:
+      head = "".join(self.head)
+      tail = "".join(self.tail)
+      dropped = self.dropped
+    if self.limit is not None:
+      excess = max(0, len(tail) - (self.limit - self.limit // 2))
+      tail = tail[excess:]
+      dropped += excess
+    if dropped:
+      return head + TRUNCATION_MARKER % dropped + tail
+    return head + tail
+
+
+def ReadPipes(process, readers, timeout):
+  """Drains the pipes of |readers| on the calling thread, without helper
+  threads. Kills |process| if it runs for longer than |timeout| seconds.
+  Not available on Windows, see WaitReadable().
+
+  Returns (exit_code, timed_out) like WaitForProcess.
+  """
+  deadline = None
+  if timeout is not None:
+    deadline = time.time() + timeout
+  timed_out = False
+  pending = dict((reader.pipe.fileno(), reader) for reader in readers)
+  while pending:
+    wait = None
+    if deadline is not None:
+      wait = max(0, deadline - time.time())
+    for fd in WaitReadable(pending.keys(), wait):
+      chunk = os.read(fd, 65536)
+      if chunk:
+        pending[fd].Add(chunk)
+      else:
+        pending.pop(fd).pipe.close()
+    if deadline is None or time.time() < deadline:
+      continue
+    if timed_out:
+      # Either the pipes were inherited by a child that is still running,
+      # or the process ignores SIGTERM and keeps writing.
+      break
+    timed_out = True
+    KillProcessWithID(process.pid)
+    deadline = time.time() + OUTPUT_GRACE_TIME
+  for reader in pending.itervalues():
+    reader.pipe.close()
+  if deadline is None:
+    return (process.wait(), False)
+  # The process might still be running, after closing its pipes or after
+  # SIGTERM. The watchdog kills it at the deadline, for good if needed.
+  (exit_code, killed) = WaitForProcess(process, max(0, deadline - time.time()))
+  return (exit_code, timed_out or killed)
+
+
+def Execute(args, verbose=False, timeout=None, max_output=None):
+  """Runs |args| and captures its output through pipes.
+
+  Each of stdout and stderr is capped at |max_output| bytes, see
+  OutputReader. None means no cap.
+  """
+  args = [ c for c in args if c != "" ]
+  process = StartProcess(verbose, args, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+  # Both pipes are drained concurrently, so a child blocked on a full
+  # stderr pipe cannot keep us from reading stdout, or the other way round.
+  threaded = utils.IsWindows()
+  out = OutputReader(process.stdout, max_output, threaded)
+  errors = OutputReader(process.stderr, max_output, threaded)
+  if not threaded:
+    (exit_code, timed_out) = ReadPipes(process, [out, errors], timeout)
+    return output.Output(exit_code, timed_out, out.Result(), errors.Result())
+  (exit_code, timed_out) = WaitForProcess(process, timeout)
+  if timed_out:
+    deadline = time.time() + OUTPUT_GRACE_TIME
+    stdout = out.Result(OUTPUT_GRACE_TIME)
+    stderr = errors.Result(max(0, deadline - time.time()))
+  else:
+    stdout = out.Result()
+    stderr = errors.Result()
+  return output.Output(exit_code, timed_out, stdout, stderr)
@@ -27,35 +27,85 @@
 
 
 import os
-import shutil
 import time
 
 from pool import Pool
+from . import batch
 from . import commands
 from . import perfdata
+from . import resultcache
+from . import statusfile
 from . import utils
 
 
 class Job(object):
-  def __init__(self, command, dep_command, test_id, timeout, verbose):
+  def __init__(self, command, dep_command, test_id, timeout, verbose,
+               max_output, batch):
     self.command = command
     self.dep_command = dep_command
     self.id = test_id
     self.timeout = timeout
     self.verbose = verbose
+    self.max_output = max_output
+    self.batch = batch
+
+
+class Dependency(object):
+  """The dependency command of some tests, run only once for all of them.
+  """
+
+  def __init__(self, job_id):
+    self.id = job_id
+    self.passed = None  # Whether it succeeded, None until it ran.
+    self.waiting = []  # Jobs of the tests that wait for it to run.
+
+
+# With --adaptive-timeouts, a test that ran at least
+# ADAPTIVE_TIMEOUT_MIN_RESULTS times before gets ADAPTIVE_TIMEOUT_FACTOR
+# times its 99th percentile duration as timeout, but no less than
+# ADAPTIVE_TIMEOUT_MIN seconds and no more than the usual timeout.
+ADAPTIVE_TIMEOUT_FACTOR = 5
+ADAPTIVE_TIMEOUT_MIN = 10.0
+ADAPTIVE_TIMEOUT_MIN_RESULTS = 5
+
+
+def AdaptiveTimeout(entry):
+  """Returns the timeout for a test with the given PerfDataEntry, or None
+  if there is not enough data."""
+  if entry is None or entry.sketch.total < ADAPTIVE_TIMEOUT_MIN_RESULTS:
+    return None
+  return max(ADAPTIVE_TIMEOUT_MIN,
+             ADAPTIVE_TIMEOUT_FACTOR * entry.sketch.Quantile(0.99))
 
 
 def RunTest(job):
+  if job.id < 0:
+    # The dependency of several tests, see Runner._GetJobs(). They only run
+    # once it has a result, so an exception must not get lost in the pool.
+    try:
+      return _RunJob(job)
+    except Exception, e:
+      print(">>> EXCEPTION: %s" % e)
+      return (job.id, None, 0.0)
+  return _RunJob(job)
+
+
+def _RunJob(job):
   start_time = time.time()
   if job.dep_command is not None:
-    dep_output = commands.Execute(job.dep_command, job.verbose, job.timeout)
+    dep_output = commands.Execute(job.dep_command, job.verbose, job.timeout,
+                                  job.max_output)
     # TODO(jkummerow): We approximate the test suite specific function
     # IsFailureOutput() by just checking the exit code here. Currently
     # only cctests define dependencies, for which this simplification is
     # correct.
     if dep_output.exit_code != 0:
       return (job.id, dep_output, time.time() - start_time)
-  output = commands.Execute(job.command, job.verbose, job.timeout)
+  if job.batch:
+    execute = batch.Execute
+  else:
+    execute = commands.Execute
+  output = execute(job.command, job.verbose, job.timeout, job.max_output)
   return (job.id, output, time.time() - start_time)
 
 class Runner(object):
@@ -64,14 +114,24 @@ class Runner(object):
     self.datapath = os.path.join("out", "testrunner_data")
     self.perf_data_manager = perfdata.PerfDataManager(self.datapath)
     self.perfdata = self.perf_data_manager.GetStore(context.arch, context.mode)
-    self.perf_failures = False
     self.printed_allocations = False
     self.tests = [ t for s in suites for t in s.tests ]
-    if not context.no_sorting:
+    if not context.no_sorting or context.adaptive_timeouts:
+      sort_keys = {}
       for t in self.tests:
-        t.duration = self.perfdata.FetchPerfData(t) or 1.0
-      self.tests.sort(key=lambda t: t.duration, reverse=True)
+        entry = self.perfdata.FetchPerfEntry(t)
+        t.duration = (entry and entry.avg) or 1.0
+        # Start the tests with the longest tails first, so they don't end
+        # up being the last ones running.
+        sort_keys[t] = (entry and entry.sketch.Quantile(0.95)) or t.duration
+        if context.adaptive_timeouts:
+          t.timeout = AdaptiveTimeout(entry)
+      if not context.no_sorting:
+        self.tests.sort(key=lambda t: sort_keys[t], reverse=True)
     self._CommonInit(len(self.tests), progress_indicator, context)
+    if context.result_cache:
+      self.result_cache = resultcache.ResultCache(self.datapath,
+                                                  context.result_cache)
 
   def _CommonInit(self, num_tests, progress_indicator, context):
     self.indicator = progress_indicator
@@ -83,26 +143,95 @@ class Runner(object):
     self.failed = []
     self.crashed = 0
     self.reran_tests = 0
+    # Dependencies keyed by their command, and in the order of their ids
+    # -1, -2, ..., which keep them apart from test ids.
+    self.dependencies = {}
+    self.dependency_list = []
+    self.result_cache = None
+    self.cache_keys = {}  # Keyed by test.
+    self.cached = 0
 
   def _RunPerfSafe(self, fun):
     try:
       fun()
     except Exception, e:
       print("PerfData exception: %s" % e)
-      self.perf_failures = True
 
-  def _GetJob(self, test):
-    command = self.GetCommand(test)
+  def _IsCached(self, test, command):
+    """Returns whether |test| passed before with the same inputs, see
+    resultcache.py. Remembers its key to store a new pass."""
+    # A pass of a flaky test says nothing about the next run.
+    if test.outcomes and statusfile.IsFlaky(test.outcomes):
+      return False
+    shell = command[len(self.context.command_prefix)]
+    key = self.result_cache.GetKey(
+        test, command, self._GetDepCommand(test, command), shell)
+    if self.result_cache.HasPassed(key):
+      return True
+    self.cache_keys[test] = key
+    return False
+
+  def _GetJob(self, test, command=None):
+    if command is None:
+      command = self.GetCommand(test)
     timeout = self.context.timeout
     if ("--stress-opt" in test.flags or
         "--stress-opt" in self.context.mode_flags or
         "--stress-opt" in self.context.extra_flags):
       timeout *= 4
-    if test.dependency is not None:
-      dep_command = [ c.replace(test.path, test.dependency) for c in command ]
-    else:
-      dep_command = None
-    return Job(command, dep_command, test.id, timeout, self.context.verbose)
+    if test.timeout is not None and test.run == 1:
+      # Reruns get the usual timeout, in case the test really got slower.
+      timeout = min(timeout, test.timeout)
+    dep_command = self._GetDepCommand(test, command)
+    # Batch workers reuse one d8 process for many tests, which is neither
+    # predictable nor compatible with wrappers like valgrind.
+    use_batch = (self.context.batch_workers and
+                 not self.context.predictable and
+                 not self.context.command_prefix and
+                 test.suite.shell() == "d8" and
+                 dep_command is None)
+    return Job(command, dep_command, test.id, timeout, self.context.verbose,
+               self.context.max_output, use_batch)
+
+  def _GetJobs(self, test, command=None):
+    """Returns the jobs that run |test|, or its dependency if it did not run
+    yet, or none if |test| has to wait for its dependency."""
+    job = self._GetJob(test, command)
+    if job.dep_command is None:
+      return [job]
+    key = tuple(job.dep_command)
+    dependency = self.dependencies.get(key)
+    if dependency is None:
+      dependency = Dependency(-1 - len(self.dependency_list))
+      self.dependencies[key] = dependency
+      self.dependency_list.append(dependency)
+      dependency.waiting.append(job)
+      return [Job(job.dep_command, None, dependency.id, job.timeout,
+                  job.verbose, job.max_output, False)]
+    if dependency.passed is None:
+      dependency.waiting.append(job)
+      return []
+    if dependency.passed:
+      job.dep_command = None
+    return [job]
+
+  def _ProcessDependency(self, result, pool):
+    dependency = self.dependency_list[-1 - result[0]]
+    # As in RunTest(), only the exit code counts. There is no output if
+    # running the dependency raised an exception.
+    dependency.passed = result[1] is not None and result[1].exit_code == 0
+    for job in dependency.waiting:
+      # Tests of a failed dependency run it again themselves, so that they
+      # fail with its output.
+      if dependency.passed:
+        job.dep_command = None
+      pool.add([job])
+    dependency.waiting = []
+
+  def _GetDepCommand(self, test, command):
+    if test.dependency is None:
+      return None
+    return [ c.replace(test.path, test.dependency) for c in command ]
 
   def _MaybeRerun(self, pool, test):
     if test.run <= self.context.rerun_failures_count:
@@ -124,7 +253,8 @@ class Runner(object):
       test.duration = None
       test.output = None
       test.run += 1
-      pool.add([self._GetJob(test)])
+      for job in self._GetJobs(test):
+        pool.add([job])
       self.remaining += 1
 
   def _ProcessTestNormal(self, test, result, pool):
@@ -138,6 +268,8 @@ class Runner(object):
         self.crashed += 1
     else:
       self.succeeded += 1
+      if test.run == 1 and test in self.cache_keys:
+        self.result_cache.AddPass(self.cache_keys[test])
     self.remaining -= 1
     # For the indicator, everything that happens after the first run is treated
     # as unexpected even if it flakily passes in order to include it in the
@@ -192,7 +324,8 @@ class Runner(object):
       # remember the output for comparison.
       test.run += 1
       test.output = result[1]
-      pool.add([self._GetJob(test)])
+      for job in self._GetJobs(test):
+        pool.add([job])
     # Always update the perf database.
     return True
 
@@ -200,31 +333,46 @@ class Runner(object):
     self.indicator.Starting()
     self._RunInternal(jobs)
     self.indicator.Done()
+    if self.cached:
+      print(">>> Skipped %d tests that passed before with the same inputs" %
+            self.cached)
     if self.failed or self.remaining:
       return 1
     return 0
 
   def _RunInternal(self, jobs):
-    pool = Pool(jobs)
+    pool = Pool(jobs, self.context.thread_workers,
+                teardown_fn=batch.CloseWorkers)
     test_map = {}
-    # TODO(machenbach): Instead of filling the queue completely before
-    # pool.imap_unordered, make this a generator that already starts testing
-    # while the queue is filled.
-    queue = []
-    queued_exception = None
-    for test in self.tests:
-      assert test.id >= 0
-      test_map[test.id] = test
-      try:
-        queue.append([self._GetJob(test)])
-      except Exception, e:
-        # If this failed, save the exception and re-raise it later (after
-        # all other tests have had a chance to run).
-        queued_exception = e
-        continue
+    queued_exception = [None]
+    def gen_tests():
+      # The pool pulls jobs from this generator as workers become free, so
+      # testing starts right away and building the commands overlaps with
+      # running the tests.
+      for test in self.tests:
+        assert test.id >= 0
+        test_map[test.id] = test
+        try:
+          command = self.GetCommand(test)
+          if self.result_cache is not None and self._IsCached(test, command):
+            self.cached += 1
+            self.total -= 1
+            self.remaining -= 1
+            continue
+          jobs = self._GetJobs(test, command)
+        except Exception, e:
+          # If this failed, save the exception and re-raise it later (after
+          # all other tests have had a chance to run).
+          queued_exception[0] = e
+          continue
+        for job in jobs:
+          yield [job]
     try:
-      it = pool.imap_unordered(RunTest, queue)
+      it = pool.imap_unordered(RunTest, gen_tests())
       for result in it:
+        if result[0] < 0:
+          self._ProcessDependency(result, pool)
+          continue
         test = test_map[result[0]]
         if self.context.predictable:
           update_perf = self._ProcessTestPredictable(test, result, pool)
@@ -234,14 +382,19 @@ class Runner(object):
           self._RunPerfSafe(lambda: self.perfdata.UpdatePerfData(test))
     finally:
       pool.terminate()
+      # Every pool worker closes its own batch workers when it stops. This
+      # catches the ones left behind by an interrupted teardown.
+      batch.CloseAll()
+      # The perf data keeps everything committed before a failure, so
+      # there is nothing to clean up here.
       self._RunPerfSafe(lambda: self.perf_data_manager.close())
-      if self.perf_failures:
-        # Nuke perf data in case of failures. This might not work on windows as
-        # some files might still be open.
-        print "Deleting perf test data due to db corruption."
-        shutil.rmtree(self.datapath)
-    if queued_exception:
-      raise queued_exception
+      if self.result_cache is not None:
+        try:
+          self.result_cache.close()
+        except Exception, e:
+          print("Result cache exception: %s" % e)
+    if queued_exception[0]:
+      raise queued_exception[0]
 
     # Make sure that any allocations were printed in predictable mode.
     assert not self.context.predictable or self.printed_allocations
@@ -26,15 +26,87 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import math
 import os
 import shelve
+import sqlite3
 import threading
 
 
+# Number of results buffered in memory before they are written to disk.
+FLUSH_INTERVAL = 1000
+
+# Seconds to wait for another runner holding the database lock.
+LOCK_TIMEOUT = 60.0
+
+
+class DurationSketch(object):
+  """A histogram of durations in logarithmic buckets.
+
+  Bucket i holds the durations up to SMALLEST * GROWTH ** (i + 1), so
+  quantiles are off by at most 10%, and an entry needs no more than a few
+  dozen buckets. Once more than LIMIT results are recorded, all counts are
+  halved, which keeps the sketch weighted towards recent results like the
+  average in PerfDataEntry.
+  """
+
+  SMALLEST = 0.001
+  GROWTH = 1.1
+  LIMIT = 200
+
+  def __init__(self):
+    self.buckets = {}  # Bucket index -> count.
+    self.total = 0
+    self.max = 0.0
+
+  def Add(self, duration):
+    bucket = 0
+    if duration > self.SMALLEST:
+      bucket = int(math.log(duration / self.SMALLEST, self.GROWTH))
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.total += 1
+    self.max = max(self.max, duration)
+    if self.total > self.LIMIT:
+      for bucket in self.buckets.keys():
+        self.buckets[bucket] //= 2
+        if not self.buckets[bucket]:
+          del self.buckets[bucket]
+      self.total = sum(self.buckets.itervalues())
+
+  def Quantile(self, q):
+    """Returns an upper bound of the |q| quantile, or None without data."""
+    if not self.total:
+      return None
+    rank = q * self.total
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        return min(self.SMALLEST * self.GROWTH ** (bucket + 1), self.max)
+    return self.max
+
+  def Serialize(self):
+    return " ".join(["%r" % self.max] +
+                    ["%d:%d" % item for item in sorted(self.buckets.items())])
+
+  @staticmethod
+  def Deserialize(data):
+    sketch = DurationSketch()
+    if data:
+      fields = data.split()
+      sketch.max = float(fields[0])
+      for field in fields[1:]:
+        (bucket, count) = field.split(":")
+        sketch.buckets[int(bucket)] = int(count)
+      sketch.total = sum(sketch.buckets.itervalues())
+    return sketch
+
+
 class PerfDataEntry(object):
   def __init__(self):
     self.avg = 0.0
     self.count = 0
+    self.sketch = DurationSketch()
 
   def AddResult(self, result):
     kLearnRateLimiter = 99  # Greater value means slower learning.
@@ -45,12 +117,36 @@ class PerfDataEntry(object):
     self.avg = self.avg * effective_count + result
     self.count = effective_count + 1
     self.avg /= self.count
+    self.sketch.Add(result)
+
+
+def GetKey(test):
+  """Computes the key used to access data for the given testcase."""
+  flags = "".join(test.flags)
+  return str("%s.%s.%s" % (test.suitename(), test.path, flags))
 
 
 class PerfDataStore(object):
+  """Test durations of one arch and mode, kept in an SQLite database.
+
+  The whole table is read on the first lookup. New results are buffered
+  and merged into the database in a single transaction every
+  FLUSH_INTERVAL results and on close(). Merging re-reads the stored
+  entries under the database lock, so runners sharing the database
+  don't overwrite each other's results. A run that dies loses at most its
+  unwritten results.
+  """
+
   def __init__(self, datadir, arch, mode):
-    filename = os.path.join(datadir, "%s.%s.perfdata" % (arch, mode))
-    self.database = shelve.open(filename, protocol=2)
+    self.filename = os.path.join(datadir, "%s.%s.perfdata.sqlite" %
+                                 (arch, mode))
+    # The shelve database of earlier versions, imported once.
+    self.shelve_filename = os.path.join(datadir, "%s.%s.perfdata" %
+                                        (arch, mode))
+    self.database = None
+    self.entries = None  # Keyed by test key, loaded on demand.
+    self.pending = {}  # Test key -> list of durations not yet written.
+    self.num_pending = 0
     self.closed = False
     self.lock = threading.Lock()
 
@@ -59,21 +155,134 @@ class PerfDataStore(object):
 
   def close(self):
     if self.closed: return
-    self.database.close()
-    self.closed = True
+    with self.lock:
+      try:
+        self._Flush()
+      finally:
+        if self.database is not None:
+          self.database.close()
+        self.closed = True
+
+  def _Connect(self):
+    if self.database is None:
+      try:
+        self.database = self._Open()
+      except sqlite3.OperationalError:
+        raise  # E.g. locked by another runner for too long.
+      except sqlite3.DatabaseError, e:
+        # Keep the unreadable file for inspection and start over.
+        print("Perf data in %s is unreadable (%s), starting over." %
+              (self.filename, e))
+        os.rename(self.filename, self.filename + ".corrupt")
+        self.database = self._Open()
+    return self.database
+
+  def _Open(self):
+    existed = os.path.exists(self.filename)
+    database = sqlite3.connect(self.filename, timeout=LOCK_TIMEOUT,
+                               isolation_level=None,
+                               check_same_thread=False)
+    try:
+      database.execute("CREATE TABLE IF NOT EXISTS perfdata ("
+                       "key TEXT PRIMARY KEY, avg REAL, count INTEGER, "
+                       "sketch TEXT)")
+      columns = [row[1] for row in
+                 database.execute("PRAGMA table_info(perfdata)")]
+      if "sketch" not in columns:
+        database.execute("ALTER TABLE perfdata ADD COLUMN sketch TEXT")
+      if not existed:
+        self._ImportShelve(database)
+      database.execute("SELECT COUNT(*) FROM perfdata").fetchone()
+    except:
+      database.close()
+      raise
+    return database
+
+  def _ImportShelve(self, database):
+    try:
+      old = shelve.open(self.shelve_filename, flag="r", protocol=2)
+    except Exception:
+      return  # No old database, or one that is unreadable.
+    try:
+      rows = [(key, old[key].avg, old[key].count) for key in old.keys()]
+    except Exception, e:
+      print("Could not import perf data from %s: %s" %
+            (self.shelve_filename, e))
+      return
+    finally:
+      old.close()
+    database.execute("BEGIN IMMEDIATE")
+    database.executemany("INSERT OR IGNORE INTO perfdata (key, avg, count) "
+                         "VALUES (?, ?, ?)", rows)
+    database.execute("COMMIT")
+
+  def _Load(self):
+    if self.entries is None:
+      self.entries = {}
+      cursor = self._Connect().execute(
+          "SELECT key, avg, count, sketch FROM perfdata")
+      for row in cursor:
+        self.entries[str(row[0])] = self._Entry(row[1:])
+
+  @staticmethod
+  def _Entry(row):
+    entry = PerfDataEntry()
+    if row is not None:
+      (entry.avg, entry.count, sketch) = row
+      entry.sketch = DurationSketch.Deserialize(sketch)
+    return entry
+
+  def _Flush(self):
+    if not self.pending:
+      return
+    database = self._Connect()
+    # Writers are serialized from here on, so the entries read below are
+    # not changed by anyone else before the commit.
+    database.execute("BEGIN IMMEDIATE")
+    try:
+      for key, durations in self.pending.iteritems():
+        row = database.execute(
+            "SELECT avg, count, sketch FROM perfdata WHERE key = ?",
+            (key,)).fetchone()
+        entry = self._Entry(row)
+        for duration in durations:
+          entry.AddResult(duration)
+        database.execute("INSERT OR REPLACE INTO perfdata VALUES (?, ?, ?, ?)",
+                         (key, entry.avg, entry.count,
+                          entry.sketch.Serialize()))
+        if self.entries is not None:
+          self.entries[key] = entry
+      database.execute("COMMIT")
+    except:
+      database.execute("ROLLBACK")
+      raise
+    self.pending = {}
+    self.num_pending = 0
 
   def GetKey(self, test):
-    """Computes the key used to access data for the given testcase."""
-    flags = "".join(test.flags)
-    return str("%s.%s.%s" % (test.suitename(), test.path, flags))
+    return GetKey(test)
+
+  def GetDurations(self):
+    """Returns the average duration of every test, keyed like GetKey()."""
+    with self.lock:
+      self._Load()
+      return dict((key, entry.avg) for key, entry in self.entries.iteritems())
 
   def FetchPerfData(self, test):
     """Returns the observed duration for |test| as read from the store."""
-    key = self.GetKey(test)
-    if key in self.database:
-      return self.database[key].avg
+    entry = self.FetchPerfEntry(test)
+    if entry is not None:
+      return entry.avg
     return None
 
+  def FetchPerfEntry(self, test):
+    """Returns the PerfDataEntry of |test|, or None. It must not be
+    modified."""
+    key = self.GetKey(test)
+    with self.lock:
+      self._Load()
+      return self.entries.get(key)
+
   def UpdatePerfData(self, test):
     """Updates the persisted value in the store with test.duration."""
     testkey = self.GetKey(test)
@@ -81,12 +290,15 @@ class PerfDataStore(object):
 
   def RawUpdatePerfData(self, testkey, duration):
     with self.lock:
-      if testkey in self.database:
-        entry = self.database[testkey]
-      else:
-        entry = PerfDataEntry()
-      entry.AddResult(duration)
-      self.database[testkey] = entry
+      # Keep lookups during the run up to date.
+      if self.entries is not None:
+        if testkey not in self.entries:
+          self.entries[testkey] = PerfDataEntry()
+        self.entries[testkey].AddResult(duration)
+      self.pending.setdefault(testkey, []).append(duration)
+      self.num_pending += 1
+      if self.num_pending >= FLUSH_INTERVAL:
+        self._Flush()
 
 
 class PerfDataManager(object):
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import math
+import os
+import random
+import shelve
+import shutil
+import sys
+import tempfile
+import unittest
+
+# The modules under test use package-relative imports.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from testrunner.local import execution
+from testrunner.local import perfdata
+from testrunner.objects import testcase
+
+
+class FakeSuite(object):
+  def __init__(self, name):
+    self.name = name
+
+
+def MakeTest(path, duration=None):
+  test = testcase.TestCase(FakeSuite("suite"), path)
+  test.duration = duration
+  return test
+
+
+def ExpectedEntry(durations):
+  entry = perfdata.PerfDataEntry()
+  for duration in durations:
+    entry.AddResult(duration)
+  return entry
+
+
+def ExactQuantile(durations, q):
+  """The smallest duration with at least |q| of all durations up to it."""
+  durations = sorted(durations)
+  return durations[max(0, int(math.ceil(q * len(durations))) - 1)]
+
+
+class DurationSketchTest(unittest.TestCase):
+  def testQuantileBounds(self):
+    rng = random.Random(7)
+    for _ in xrange(20):
+      durations = [rng.lognormvariate(-3, 2) for _ in xrange(
+          rng.randint(1, perfdata.DurationSketch.LIMIT))]
+      sketch = perfdata.DurationSketch()
+      for duration in durations:
+        sketch.Add(duration)
+      for q in (0.0, 0.01, 0.5, 0.9, 0.95, 0.99, 1.0):
+        exact = ExactQuantile(durations, q)
+        estimate = sketch.Quantile(q)
+        # An upper bound that is at most 10% too high, or SMALLEST for
+        # anything shorter.
+        self.assertTrue(exact <= estimate * (1 + 1e-9), (q, exact, estimate))
+        self.assertTrue(estimate <= max(exact, perfdata.DurationSketch.SMALLEST)
+                        * perfdata.DurationSketch.GROWTH * (1 + 1e-9),
+                        (q, exact, estimate))
+      self.assertEquals(max(durations), sketch.Quantile(1.0))
+
+  def testEmpty(self):
+    self.assertEquals(None, perfdata.DurationSketch().Quantile(0.5))
+    sketch = perfdata.DurationSketch.Deserialize(None)
+    self.assertEquals(None, sketch.Quantile(0.5))
+
+  def testHalvesPastLimit(self):
+    sketch = perfdata.DurationSketch()
+    for _ in xrange(perfdata.DurationSketch.LIMIT):
+      sketch.Add(1.0)
+    self.assertEquals(perfdata.DurationSketch.LIMIT, sketch.total)
+    sketch.Add(1.0)
+    self.assertTrue(sketch.total <= perfdata.DurationSketch.LIMIT / 2 + 1)
+    self.assertEquals(sum(sketch.buckets.itervalues()), sketch.total)
+    # Recent results outweigh older ones.
+    for _ in xrange(perfdata.DurationSketch.LIMIT):
+      sketch.Add(100.0)
+    self.assertTrue(sketch.total <= perfdata.DurationSketch.LIMIT)
+    self.assertTrue(sketch.Quantile(0.5) >= 100.0)
+    self.assertTrue(sketch.Quantile(0.1) <= 1.1)
+
+  def testSerialize(self):
+    sketch = perfdata.DurationSketch()
+    for duration in [0.0, 0.0005, 0.01, 0.3, 0.3, 7.25]:
+      sketch.Add(duration)
+    copy = perfdata.DurationSketch.Deserialize(sketch.Serialize())
+    self.assertEquals(sketch.buckets, copy.buckets)
+    self.assertEquals(sketch.total, copy.total)
+    self.assertEquals(sketch.max, copy.max)
+    for q in (0.1, 0.5, 0.99):
+      self.assertEquals(sketch.Quantile(q), copy.Quantile(q))
+
+
+class AdaptiveTimeoutTest(unittest.TestCase):
+  def testTimeouts(self):
+    self.assertEquals(None, execution.AdaptiveTimeout(None))
+    too_few = execution.ADAPTIVE_TIMEOUT_MIN_RESULTS - 1
+    self.assertEquals(None,
+                      execution.AdaptiveTimeout(ExpectedEntry([1.0] * too_few)))
+    fast = ExpectedEntry([0.01] * execution.ADAPTIVE_TIMEOUT_MIN_RESULTS)
+    self.assertEquals(execution.ADAPTIVE_TIMEOUT_MIN,
+                      execution.AdaptiveTimeout(fast))
+    durations = [3.0] * 99 + [10.0]
+    slow = ExpectedEntry(durations)
+    timeout = execution.AdaptiveTimeout(slow)
+    p99 = ExactQuantile(durations, 0.99)
+    self.assertTrue(execution.ADAPTIVE_TIMEOUT_FACTOR * p99 <= timeout)
+    self.assertTrue(timeout <= (execution.ADAPTIVE_TIMEOUT_FACTOR * p99 *
+                                perfdata.DurationSketch.GROWTH))
+
+
+class PerfDataStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.datadir = tempfile.mkdtemp()
+    self.flush_interval = perfdata.FLUSH_INTERVAL
+
+  def tearDown(self):
+    perfdata.FLUSH_INTERVAL = self.flush_interval
+    shutil.rmtree(self.datadir)
+
+  def NewStore(self):
+    return perfdata.PerfDataStore(self.datadir, "x64", "release")
+
+  def testRoundTrip(self):
+    store = self.NewStore()
+    self.assertEquals(None, store.FetchPerfData(MakeTest("a")))
+    store.UpdatePerfData(MakeTest("a", 1.0))
+    store.UpdatePerfData(MakeTest("a", 3.0))
+    # Results are visible right away in the same store.
+    self.assertAlmostEqual(2.0, store.FetchPerfData(MakeTest("a")))
+    store.close()
+
+    store = self.NewStore()
+    self.assertAlmostEqual(2.0, store.FetchPerfData(MakeTest("a")))
+    entry = store.FetchPerfEntry(MakeTest("a"))
+    self.assertEquals(2, entry.count)
+    # The sketch is stored along with the average.
+    self.assertEquals(2, entry.sketch.total)
+    self.assertEquals(3.0, entry.sketch.max)
+    self.assertEquals(None, store.FetchPerfData(MakeTest("b")))
+    store.close()
+
+  def testConcurrentStoresMerge(self):
+    first = self.NewStore()
+    second = self.NewStore()
+    # Both stores read the database before either writes to it.
+    self.assertEquals(None, first.FetchPerfData(MakeTest("a")))
+    self.assertEquals(None, second.FetchPerfData(MakeTest("a")))
+    first.UpdatePerfData(MakeTest("a", 1.0))
+    first.UpdatePerfData(MakeTest("b", 4.0))
+    second.UpdatePerfData(MakeTest("a", 2.0))
+    second.UpdatePerfData(MakeTest("a", 6.0))
+    first.close()
+    second.close()
+
+    store = self.NewStore()
+    expected = ExpectedEntry([1.0, 2.0, 6.0])
+    entry = store.FetchPerfEntry(MakeTest("a"))
+    self.assertEquals(expected.count, entry.count)
+    self.assertAlmostEqual(expected.avg, entry.avg)
+    self.assertEquals(expected.sketch.Serialize(), entry.sketch.Serialize())
+    self.assertAlmostEqual(4.0, store.FetchPerfData(MakeTest("b")))
+    store.close()
+
+  def testFlushInterval(self):
+    perfdata.FLUSH_INTERVAL = 3
+    store = self.NewStore()
+    for duration in [1.0, 2.0]:
+      store.UpdatePerfData(MakeTest("a", duration))
+    reader = self.NewStore()
+    self.assertEquals(None, reader.FetchPerfData(MakeTest("a")))
+    reader.close()
+    store.UpdatePerfData(MakeTest("a", 3.0))
+    reader = self.NewStore()
+    self.assertAlmostEqual(2.0, reader.FetchPerfData(MakeTest("a")))
+    reader.close()
+    store.close()
+
+  def testGetDurations(self):
+    store = self.NewStore()
+    store.UpdatePerfData(MakeTest("a", 1.0))
+    store.UpdatePerfData(MakeTest("b", 2.0))
+    store.close()
+    store = self.NewStore()
+    self.assertEquals({perfdata.GetKey(MakeTest("a")): 1.0,
+                       perfdata.GetKey(MakeTest("b")): 2.0},
+                      store.GetDurations())
+    store.close()
+
+  def testImportsShelve(self):
+    old = shelve.open(os.path.join(self.datadir, "x64.release.perfdata"),
+                      protocol=2)
+    old[perfdata.GetKey(MakeTest("a"))] = ExpectedEntry([2.0, 4.0])
+    old.close()
+    store = self.NewStore()
+    entry = store.FetchPerfEntry(MakeTest("a"))
+    self.assertEquals(2, entry.count)
+    self.assertAlmostEqual(3.0, entry.avg)
+    store.close()
+
+  def testCorruptDatabase(self):
+    filename = os.path.join(self.datadir, "x64.release.perfdata.sqlite")
+    with open(filename, "w") as f:
+      f.write("This is not a database, but long enough to look like one. " * 4)
+    store = self.NewStore()
+    self.assertEquals(None, store.FetchPerfData(MakeTest("a")))
+    store.UpdatePerfData(MakeTest("a", 1.0))
+    store.close()
+    self.assertTrue(os.path.exists(filename + ".corrupt"))
+    store = self.NewStore()
+    self.assertAlmostEqual(1.0, store.FetchPerfData(MakeTest("a")))
+    store.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -3,7 +3,10 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-from multiprocessing import Event, Process, Queue
+import multiprocessing
+import os
+import Queue
+import threading
 
 class NormalResult():
   def __init__(self, result):
@@ -24,10 +27,11 @@ class BreakResult():
     self.break_now = True
 
 
-def Worker(fn, work_queue, done_queue, done):
-  """Worker to be run in a child process.
+def Worker(fn, work_queue, done_queue, done, teardown_fn=None):
+  """Worker to be run in a child process or thread.
   The worker stops on two conditions. 1. When the poison pill "STOP" is
-  reached or 2. when the event "done" is set."""
+  reached or 2. when the event "done" is set. It calls "teardown_fn", if
+  given, before it stops."""
   try:
     for args in iter(work_queue.get, "STOP"):
       if done.is_set():
@@ -39,10 +43,42 @@ def Worker(fn, work_queue, done_queue, done):
         done_queue.put(ExceptionResult())
   except KeyboardInterrupt:
     done_queue.put(BreakResult())
+  finally:
+    if teardown_fn is not None:
+      teardown_fn()
+
+
+class WakeupQueue(object):
+  """A queue between the threads of one process. Its get() blocks reading a
+  pipe, which a put() writes a byte to, rather than on a lock, so that
+  keyboard interrupts are delivered while waiting."""
+
+  def __init__(self):
+    self.queue = Queue.Queue()
+    (self.read_fd, self.write_fd) = os.pipe()
+
+  def put(self, item):
+    self.queue.put(item)
+    os.write(self.write_fd, "x")
+
+  def get(self, block=True):
+    if not block:
+      # Raises Queue.Empty like Queue.Queue.
+      item = self.queue.get(False)
+      os.read(self.read_fd, 1)
+      return item
+    os.read(self.read_fd, 1)
+    return self.queue.get(False)
+
+  def close(self):
+    os.close(self.read_fd)
+    os.close(self.write_fd)
 
 
 class Pool():
-  """Distributes tasks to a number of worker processes.
+  """Distributes tasks to a number of worker processes, or threads of the
+  parent process if "use_threads" is set. Threads pass arguments and results
+  without pickling, but share the interpreter lock.
   New tasks can be added dynamically even after the workers have been started.
   Requirement: Tasks can only be added from the parent process, e.g. while
   consuming the results generator."""
@@ -51,8 +87,12 @@ class Pool():
   # Necessary to not overflow the queue's pipe if a keyboard interrupt happens.
   BUFFER_FACTOR = 4
 
-  def __init__(self, num_workers):
+  def __init__(self, num_workers, use_threads=False, teardown_fn=None):
     self.num_workers = num_workers
+    self.use_threads = use_threads
+    # Called by every worker before it stops, e.g. to clean up state kept
+    # across tasks.
+    self.teardown_fn = teardown_fn
     self.processes = []
     self.terminated = False
 
@@ -64,9 +104,14 @@ class Pool():
     # allowed to remove items from the done_queue and to add items to the
     # work_queue.
     self.count = 0
-    self.work_queue = Queue()
-    self.done_queue = Queue()
-    self.done = Event()
+    if use_threads:
+      self.work_queue = Queue.Queue()
+      self.done_queue = WakeupQueue()
+      self.done = threading.Event()
+    else:
+      self.work_queue = multiprocessing.Queue()
+      self.done_queue = multiprocessing.Queue()
+      self.done = multiprocessing.Event()
 
   def imap_unordered(self, fn, gen):
     """Maps function "fn" to items in generator "gen" on the worker processes
@@ -77,10 +122,17 @@ class Pool():
       self.advance = self._advance_more
 
       for w in xrange(self.num_workers):
-        p = Process(target=Worker, args=(fn,
-                                         self.work_queue,
-                                         self.done_queue,
-                                         self.done))
+        if self.use_threads:
+          worker_class = threading.Thread
+        else:
+          worker_class = multiprocessing.Process
+        p = worker_class(target=Worker, args=(fn,
+                                              self.work_queue,
+                                              self.done_queue,
+                                              self.done,
+                                              self.teardown_fn))
+        # Don't keep the interpreter alive for a thread stuck in a task.
+        p.daemon = self.use_threads
         self.processes.append(p)
         p.start()
 
@@ -144,3 +196,5 @@ class Pool():
       while True: self.done_queue.get(False)
     except:
       pass
+    if self.use_threads:
+      self.done_queue.close()
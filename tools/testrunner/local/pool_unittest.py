@@ -39,3 +39,23 @@ class PoolTest(unittest.TestCase):
         pool.add([result + 20])
     self.assertEquals(set(range(0, 10) + range(20, 30) + range(40, 50)),
                       results)
+
+  def testThreads(self):
+    results = set()
+    pool = Pool(3, use_threads=True)
+    for result in pool.imap_unordered(Run, [[x] for x in range(0, 12)]):
+      results.add(result)
+      if result < 30:
+        pool.add([result + 20])
+    # Item 10 fails, so 30 is never added.
+    expect = set(range(0, 12) + range(20, 30) + [31] + range(40, 50))
+    expect.remove(10)
+    self.assertEquals(expect, results)
+
+  def testTeardown(self):
+    torn_down = []
+    pool = Pool(3, use_threads=True,
+                teardown_fn=lambda: torn_down.append(True))
+    for result in pool.imap_unordered(Run, [[x] for x in range(0, 10)]):
+      pass
+    self.assertEquals(3, len(torn_down))
@@ -0,0 +1,177 @@
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Remembers which tests passed, keyed by a hash of everything they ran.
+
+The key of a test covers the contents of the binary and of the startup
+data and shared libraries next to it, the command line with the contents
+of every file on it (the test source and its Files: dependencies), the
+expected outcomes, the testcfg.py of the suite and its expectation files.
+The random seed is left out, since a new one is picked for every run.
+Whatever else a test reads, e.g. files loaded by the test itself, is not
+covered; --clear-result-cache starts over.
+
+The cache holds at most a given number of keys and forgets the least
+recently used ones first.
+"""
+
+import fnmatch
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+# Files next to the binary that are part of what it runs.
+ARTIFACT_PATTERNS = ["*_blob.bin", "*.so", "*.dylib", "*.dll"]
+
+# Seconds to wait for another runner holding the database lock.
+LOCK_TIMEOUT = 60.0
+
+DATABASE = "results.sqlite"
+
+
+def Clear(datadir):
+  """Forgets all results stored in |datadir|."""
+  filename = os.path.join(datadir, DATABASE)
+  if os.path.exists(filename):
+    os.remove(filename)
+
+
+class ResultCache(object):
+
+  def __init__(self, datadir, size):
+    self.filename = os.path.join(datadir, DATABASE)
+    self.size = size
+    self.database = None
+    self.digests = {}  # File name -> (mtime, size, sha1 of the contents).
+    self.artifacts = {}  # Binary -> the files next to it, hashed.
+    self.used = []  # Keys looked up successfully in this run.
+    self.passed = []  # Keys of tests that passed in this run.
+    self.lock = threading.Lock()
+
+  def _Connect(self):
+    if self.database is None:
+      directory = os.path.dirname(self.filename)
+      if not os.path.exists(directory):
+        os.makedirs(directory)
+      try:
+        self.database = self._Open()
+      except sqlite3.OperationalError:
+        raise  # E.g. locked by another runner for too long.
+      except sqlite3.DatabaseError, e:
+        print("Result cache %s is unreadable (%s), starting over." %
+              (self.filename, e))
+        os.remove(self.filename)
+        self.database = self._Open()
+    return self.database
+
+  def _Open(self):
+    database = sqlite3.connect(self.filename, timeout=LOCK_TIMEOUT,
+                               isolation_level=None,
+                               check_same_thread=False)
+    try:
+      database.execute("CREATE TABLE IF NOT EXISTS results ("
+                       "key TEXT PRIMARY KEY, used REAL)")
+      database.execute("SELECT COUNT(*) FROM results").fetchone()
+    except:
+      database.close()
+      raise
+    return database
+
+  def _FileDigest(self, filename):
+    """Returns the sha1 of the contents of |filename|, or None if it is not
+    a file. Files are hashed once per run and size and mtime."""
+    try:
+      stat = os.stat(filename)
+    except OSError:
+      return None
+    if not os.path.isfile(filename):
+      return None
+    entry = self.digests.get(filename)
+    if entry is None or entry[:2] != (stat.st_mtime, stat.st_size):
+      digest = hashlib.sha1()
+      with open(filename, "rb") as f:
+        while True:
+          chunk = f.read(1 << 20)
+          if not chunk:
+            break
+          digest.update(chunk)
+      entry = (stat.st_mtime, stat.st_size, digest.hexdigest())
+      self.digests[filename] = entry
+    return entry[2]
+
+  def _AddFile(self, digest, filename):
+    digest.update("%s\0%s\0" % (filename, self._FileDigest(filename)))
+
+  def _ArtifactsDigest(self, shell):
+    if shell not in self.artifacts:
+      digest = hashlib.sha1()
+      directory = os.path.dirname(shell)
+      for name in sorted(os.listdir(directory)):
+        if any(fnmatch.fnmatch(name, p) for p in ARTIFACT_PATTERNS):
+          self._AddFile(digest, os.path.join(directory, name))
+      self.artifacts[shell] = digest.hexdigest()
+    return self.artifacts[shell]
+
+  def GetKey(self, test, command, dep_command, shell):
+    """Computes the key of |test| run by |command| with the binary |shell|.
+    """
+    digest = hashlib.sha1()
+    digest.update(self._ArtifactsDigest(shell))
+    for args in (command, dep_command or []):
+      for arg in args:
+        if arg.startswith("--random-seed="):
+          continue
+        digest.update("%s\0" % arg)
+        if not arg.startswith("-"):
+          digest.update("%s\0" % self._FileDigest(arg))
+      digest.update("\0")
+    digest.update("%s\0" % " ".join(sorted(test.outcomes or [])))
+    digest.update("%s\0" % test.suite.GetCodeHash())
+    for filename in test.suite.GetExpectationFiles(test):
+      self._AddFile(digest, filename)
+    return digest.hexdigest()
+
+  def HasPassed(self, key):
+    """Returns whether the test with |key| passed before."""
+    with self.lock:
+      row = self._Connect().execute(
+          "SELECT 1 FROM results WHERE key = ?", (key,)).fetchone()
+      if row is not None:
+        self.used.append(key)
+    return row is not None
+
+  def AddPass(self, key):
+    with self.lock:
+      self.passed.append(key)
+
+  def close(self):
+    """Writes the new passes and the use times, then drops the least
+    recently used keys beyond the size limit."""
+    with self.lock:
+      if not self.used and not self.passed:
+        if self.database is not None:
+          self.database.close()
+          self.database = None
+        return
+      now = time.time()
+      database = self._Connect()
+      database.execute("BEGIN IMMEDIATE")
+      try:
+        database.executemany("INSERT OR REPLACE INTO results VALUES (?, ?)",
+                             [(key, now) for key in self.used + self.passed])
+        database.execute("DELETE FROM results WHERE key NOT IN ("
+                         "SELECT key FROM results ORDER BY used DESC "
+                         "LIMIT ?)", (self.size,))
+        database.execute("COMMIT")
+      except:
+        database.execute("ROLLBACK")
+        raise
+      finally:
+        self.used = []
+        self.passed = []
+        database.close()
+        self.database = None
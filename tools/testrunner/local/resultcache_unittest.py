@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# The modules under test use package-relative imports.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from testrunner.local import resultcache
+from testrunner.objects import testcase
+
+
+class FakeSuite(object):
+  def __init__(self):
+    self.name = "suite"
+    self.code_hash = "hash"
+    self.expectation_files = []
+
+  def GetCodeHash(self):
+    return self.code_hash
+
+  def GetExpectationFiles(self, test):
+    return self.expectation_files
+
+
+class ResultCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.datadir = os.path.join(self.directory, "data")
+    self.shell = self.WriteFile("d8", "binary")
+    self.suite = FakeSuite()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def WriteFile(self, name, contents):
+    filename = os.path.join(self.directory, name)
+    with open(filename, "w") as f:
+      f.write(contents)
+    return filename
+
+  def GetKey(self, name, flags=None, seed=1):
+    filename = os.path.join(self.directory, name)
+    test = testcase.TestCase(self.suite, name)
+    command = ([self.shell, "--random-seed=%d" % seed] + (flags or []) +
+               [filename])
+    return resultcache.ResultCache(self.datadir, 10).GetKey(
+        test, command, None, self.shell)
+
+  def Store(self, keys, size=10):
+    cache = resultcache.ResultCache(self.datadir, size)
+    for key in keys:
+      cache.AddPass(key)
+    cache.close()
+
+  def HasPassed(self, key, size=10):
+    cache = resultcache.ResultCache(self.datadir, size)
+    try:
+      return cache.HasPassed(key)
+    finally:
+      cache.close()
+
+  def testHitAndMiss(self):
+    self.WriteFile("a.js", "a")
+    self.WriteFile("b.js", "b")
+    key = self.GetKey("a.js")
+    self.assertFalse(self.HasPassed(key))
+    self.Store([key])
+    self.assertTrue(self.HasPassed(key))
+    self.assertFalse(self.HasPassed(self.GetKey("b.js")))
+    self.assertFalse(self.HasPassed(self.GetKey("a.js", ["--nocrankshaft"])))
+
+  def testRandomSeedIsIgnored(self):
+    self.WriteFile("a.js", "a")
+    self.Store([self.GetKey("a.js", seed=1)])
+    self.assertTrue(self.HasPassed(self.GetKey("a.js", seed=2)))
+
+  def testChangedInputsInvalidate(self):
+    self.WriteFile("a.js", "a")
+    self.Store([self.GetKey("a.js")])
+    self.WriteFile("a.js", "changed")
+    self.assertFalse(self.HasPassed(self.GetKey("a.js")))
+    self.WriteFile("a.js", "a")
+    self.assertTrue(self.HasPassed(self.GetKey("a.js")))
+
+    self.WriteFile("d8", "new binary")
+    self.assertFalse(self.HasPassed(self.GetKey("a.js")))
+    self.WriteFile("d8", "binary")
+
+    self.WriteFile("snapshot_blob.bin", "snapshot")
+    self.assertFalse(self.HasPassed(self.GetKey("a.js")))
+    os.remove(os.path.join(self.directory, "snapshot_blob.bin"))
+
+    self.suite.code_hash = "new hash"
+    self.assertFalse(self.HasPassed(self.GetKey("a.js")))
+    self.suite.code_hash = "hash"
+
+    self.suite.expectation_files = [self.WriteFile("a.out", "expected")]
+    key = self.GetKey("a.js")
+    self.Store([key])
+    self.WriteFile("a.out", "changed")
+    self.assertFalse(self.HasPassed(self.GetKey("a.js")))
+    self.assertTrue(self.HasPassed(key))
+
+  def testEvictsLeastRecentlyUsed(self):
+    self.Store(["old1", "old2"], size=4)
+    self.Store(["new1", "new2"], size=4)
+    # Using old1 makes old2 the least recently used key.
+    self.assertTrue(self.HasPassed("old1", size=4))
+    self.Store(["new3"], size=4)
+    self.assertFalse(self.HasPassed("old2"))
+    for key in ["old1", "new1", "new2", "new3"]:
+      self.assertTrue(self.HasPassed(key))
+
+  def testClear(self):
+    self.Store(["key"])
+    resultcache.Clear(self.datadir)
+    self.assertFalse(self.HasPassed("key"))
+
+
+if __name__ == "__main__":
+  unittest.main()
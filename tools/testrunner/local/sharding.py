@@ -0,0 +1,97 @@
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import heapq
+import json
+
+from . import perfdata
+
+
+def ReadDurations(filename):
+  """Reads a snapshot written by WriteDurations()."""
+  with open(filename) as f:
+    return dict((str(key), float(duration))
+                for key, duration in json.load(f).iteritems())
+
+
+def WriteDurations(filename, perf_store):
+  """Writes the average test durations in |perf_store| to |filename|."""
+  with open(filename, "w") as f:
+    json.dump(perf_store.GetDurations(), f, indent=0, sort_keys=True)
+
+
+class Sharder(object):
+  """Splits tests into shards.
+
+  Every shard run computes the full assignment and keeps its own part. By
+  default each suite is split round-robin by test index. Given a snapshot
+  of |durations|, keyed like the perf data, tests are placed longest first
+  on the shard with the least predicted work so far, carried over from
+  suite to suite. All shard runs must get the same snapshot, or some
+  tests run on several shards and others on none. Suites without any
+  known duration are split round-robin.
+  """
+
+  def __init__(self, shard_count, shard_run, durations=None):
+    if shard_count >= 2 and (shard_run < 1 or shard_run > shard_count):
+      print "shard-run not a valid number, should be in [1:shard-count]"
+      print "defaulting back to running all tests"
+      shard_count = 1
+    self.shard_count = shard_count
+    self.shard_run = shard_run
+    self.durations = durations
+    self.loads = [0.0] * shard_count  # Predicted seconds of each shard.
+    self.sizes = [0] * shard_count  # Number of tests of each shard.
+    self.guessed = False  # Whether a suite had no perf data at all.
+
+  def _Durations(self, tests):
+    if self.durations is None:
+      return None
+    durations = [self.durations.get(perfdata.GetKey(t)) for t in tests]
+    known = [d for d in durations if d is not None]
+    if not known:
+      return None
+    # Tests without data are assumed to be average.
+    average = sum(known) / len(known)
+    return [average if d is None else d for d in durations]
+
+  def Shard(self, tests):
+    """Returns the tests of this shard run, in their original order."""
+    if self.shard_count < 2:
+      return tests
+    durations = self._Durations(tests)
+    if durations is None:
+      self.guessed = True
+      shards = [index % self.shard_count for index in xrange(len(tests))]
+      durations = [1.0] * len(tests)
+    else:
+      shards = [None] * len(tests)
+      heap = [(load, shard) for shard, load in enumerate(self.loads)]
+      heapq.heapify(heap)
+      order = sorted(xrange(len(tests)), key=lambda i: (-durations[i], i))
+      for index in order:
+        (load, shard) = heapq.heappop(heap)
+        shards[index] = shard
+        heapq.heappush(heap, (load + durations[index], shard))
+    for index, shard in enumerate(shards):
+      self.loads[shard] += durations[index]
+      self.sizes[shard] += 1
+    return [test for test, shard in zip(tests, shards)
+            if shard == self.shard_run - 1]
+
+  def PrintPrediction(self, jobs):
+    """Prints the predicted wall-clock time of every shard."""
+    if self.shard_count < 2 or self.durations is None:
+      return
+    note = ""
+    if self.guessed:
+      note = ", assuming 1s per test of suites without durations"
+    print("Predicted shard durations with %d parallel jobs%s:" % (jobs, note))
+    for shard in xrange(self.shard_count):
+      marker = ""
+      if shard == self.shard_run - 1:
+        marker = " <- this shard"
+      print("  %d/%d: %5d tests, %6.0fs%s" %
+            (shard + 1, self.shard_count, self.sizes[shard],
+             self.loads[shard] / max(jobs, 1), marker))
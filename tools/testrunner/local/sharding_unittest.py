@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+# The modules under test use package-relative imports.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from testrunner.local import perfdata
+from testrunner.local import sharding
+from testrunner.objects import testcase
+
+
+class FakeSuite(object):
+  def __init__(self, name):
+    self.name = name
+
+
+def MakeTests(suite_name, count):
+  suite = FakeSuite(suite_name)
+  return [testcase.TestCase(suite, "test%d" % i) for i in xrange(count)]
+
+
+def OldShardTests(tests, shard_count, shard_run):
+  """The round-robin sharding that run-tests.py always used."""
+  return [test for index, test in enumerate(tests)
+          if index % shard_count == shard_run - 1]
+
+
+class ShardingTest(unittest.TestCase):
+  def setUp(self):
+    rng = random.Random(5)
+    self.suites = [MakeTests("big", 300), MakeTests("small", 40),
+                   MakeTests("nodata", 25)]
+    self.durations = {}
+    for test in self.suites[0] + self.suites[1]:
+      # Every 20th test has no duration.
+      if rng.random() > 0.05:
+        duration = rng.lognormvariate(-2, 1.5)
+        if rng.random() < 0.02:
+          duration *= 50
+        self.durations[perfdata.GetKey(test)] = duration
+
+  def Partition(self, shard_count, durations):
+    """Returns the tests of every shard run, suite by suite."""
+    shards = []
+    for shard_run in xrange(1, shard_count + 1):
+      sharder = sharding.Sharder(shard_count, shard_run, durations)
+      shards.append([sharder.Shard(suite) for suite in self.suites])
+    return shards
+
+  def testRoundRobinByDefault(self):
+    for shard_count in (2, 3, 7):
+      shards = self.Partition(shard_count, None)
+      for shard_run in xrange(1, shard_count + 1):
+        for index, suite in enumerate(self.suites):
+          self.assertEquals(OldShardTests(suite, shard_count, shard_run),
+                            shards[shard_run - 1][index])
+
+  def testDurationsFormPartition(self):
+    for shard_count in (2, 4, 7):
+      shards = self.Partition(shard_count, self.durations)
+      for index, suite in enumerate(self.suites):
+        seen = [test for shard in shards for test in shard[index]]
+        self.assertEquals(len(suite), len(seen))
+        self.assertEquals(set(suite), set(seen))
+        for shard in shards:
+          # Each shard keeps the original order.
+          self.assertEquals(sorted(shard[index], key=suite.index),
+                            shard[index])
+
+  def testSuiteWithoutDurationsIsRoundRobin(self):
+    shards = self.Partition(3, self.durations)
+    for shard_run in xrange(1, 4):
+      self.assertEquals(OldShardTests(self.suites[2], 3, shard_run),
+                        shards[shard_run - 1][2])
+
+  def testDurationsBalanceLoad(self):
+    shard_count = 7
+    durations = [self.durations.get(perfdata.GetKey(test))
+                 for test in self.suites[0]]
+    average = (sum(d for d in durations if d is not None) /
+               len([d for d in durations if d is not None]))
+    def MaxLoad(shards):
+      key_durations = dict(zip(self.suites[0], durations))
+      return max(sum(key_durations[test] or average for test in shard[0])
+                 for shard in shards)
+    self.assertLess(MaxLoad(self.Partition(shard_count, self.durations)),
+                    MaxLoad(self.Partition(shard_count, None)))
+
+  def testInvalidShardRunRunsAll(self):
+    tests = MakeTests("suite", 10)
+    self.assertEquals(tests, sharding.Sharder(3, 4).Shard(tests))
+    self.assertEquals(tests,
+                      sharding.Sharder(3, 0, self.durations).Shard(tests))
+
+  def testDurationsFile(self):
+    class FakeStore(object):
+      def GetDurations(store):
+        return self.durations
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, "durations.json")
+      sharding.WriteDurations(filename, FakeStore())
+      read = sharding.ReadDurations(filename)
+    finally:
+      shutil.rmtree(directory)
+    self.assertEquals(sorted(self.durations), sorted(read))
+    for key, duration in self.durations.iteritems():
+      self.assertAlmostEqual(duration, read[key])
+
+
+if __name__ == "__main__":
+  unittest.main()
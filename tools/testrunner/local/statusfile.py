@@ -83,6 +83,80 @@ def IsFailOk(outcomes):
     return (FAIL in outcomes) and (OKAY in outcomes)
 
 
+class WildcardRules(dict):
+  """Maps wildcard rules like "regress/*" to their outcomes.
+
+  Matches() finds all rules matching a test name in one walk along the
+  name through a prefix trie of the rules, instead of trying every rule.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(WildcardRules, self).__init__(*args, **kwargs)
+    self._trie = None
+
+  def _Changed(self):
+    self._trie = None
+
+  def __setitem__(self, rule, outcomes):
+    super(WildcardRules, self).__setitem__(rule, outcomes)
+    self._Changed()
+
+  def __delitem__(self, rule):
+    super(WildcardRules, self).__delitem__(rule)
+    self._Changed()
+
+  def clear(self):
+    super(WildcardRules, self).clear()
+    self._Changed()
+
+  def pop(self, *args):
+    self._Changed()
+    return super(WildcardRules, self).pop(*args)
+
+  def popitem(self):
+    self._Changed()
+    return super(WildcardRules, self).popitem()
+
+  def setdefault(self, rule, default=None):
+    self._Changed()
+    return super(WildcardRules, self).setdefault(rule, default)
+
+  def update(self, *args, **kwargs):
+    super(WildcardRules, self).update(*args, **kwargs)
+    self._Changed()
+
+  def _BuildTrie(self):
+    # Every node is a dict from the next character to the child node. The
+    # key None marks the end of a rule's prefix and holds the position of
+    # the rule in the iteration order of the dict.
+    trie = {}
+    for index, rule in enumerate(self):
+      assert rule[-1] == '*'
+      node = trie
+      for char in rule[:-1]:
+        node = node.setdefault(char, {})
+      node[None] = (index, rule)
+    return trie
+
+  def Matches(self, name):
+    """Returns the rules whose prefix |name| starts with, in the same order
+    as iterating over the dict."""
+    if self._trie is None:
+      self._trie = self._BuildTrie()
+    node = self._trie
+    matches = []
+    if None in node:
+      matches.append(node[None])
+    for char in name:
+      node = node.get(char)
+      if node is None:
+        break
+      if None in node:
+        matches.append(node[None])
+    matches.sort()
+    return [rule for _, rule in matches]
+
+
 def _AddOutcome(result, new):
   global DEFS
   if new in DEFS:
@@ -123,7 +197,7 @@ def ReadStatusFile(path, variables):
     contents = eval(f.read(), KEYWORDS)
 
   rules = {}
-  wildcards = {}
+  wildcards = WildcardRules()
   variables.update(VARIABLES)
   for section in contents:
     assert type(section) == list
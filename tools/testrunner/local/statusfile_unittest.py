@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Import the module the same way as the other modules of the package.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from testrunner.local import statusfile
+
+
+def LinearMatches(wildcards, name):
+  """The scan over all rules that Matches() replaces."""
+  return [rule for rule in wildcards if name.startswith(rule[:-1])]
+
+
+class WildcardRulesTest(unittest.TestCase):
+  def RandomName(self, rng):
+    parts = [rng.choice(["a", "ab", "abc", "b", "regress", "regress-1"])
+             for _ in xrange(rng.randint(0, 3))]
+    return "/".join(parts) + rng.choice(["", "/", "x", "/a", "-1", "1"])
+
+  def testMatchesLinearScan(self):
+    rng = random.Random(3)
+    for _ in xrange(100):
+      wildcards = statusfile.WildcardRules()
+      for _ in xrange(rng.randint(0, 30)):
+        wildcards[self.RandomName(rng) + "*"] = set([statusfile.FAIL])
+      for _ in xrange(50):
+        name = self.RandomName(rng)
+        self.assertEquals(LinearMatches(wildcards, name),
+                          wildcards.Matches(name))
+
+  def testRuleMatchingEverything(self):
+    wildcards = statusfile.WildcardRules({"*": "", "a/*": ""})
+    self.assertEquals(LinearMatches(wildcards, ""), wildcards.Matches(""))
+    self.assertEquals(LinearMatches(wildcards, "a/b"), wildcards.Matches("a/b"))
+    self.assertEquals(["*"], wildcards.Matches("b"))
+
+  def testChangesRebuild(self):
+    wildcards = statusfile.WildcardRules({"a/*": ""})
+    self.assertEquals(["a/*"], wildcards.Matches("a/b"))
+    wildcards["a/b*"] = ""
+    self.assertEquals(LinearMatches(wildcards, "a/b"), wildcards.Matches("a/b"))
+    del wildcards["a/*"]
+    self.assertEquals(["a/b*"], wildcards.Matches("a/b"))
+    wildcards.update({"a*": ""})
+    self.assertEquals(LinearMatches(wildcards, "a/b"), wildcards.Matches("a/b"))
+    wildcards.pop("a/b*")
+    self.assertEquals(["a*"], wildcards.Matches("a/b"))
+    wildcards.setdefault("a/*", "")
+    self.assertEquals(LinearMatches(wildcards, "a/b"), wildcards.Matches("a/b"))
+    wildcards.popitem()
+    self.assertEquals(LinearMatches(wildcards, "a/b"), wildcards.Matches("a/b"))
+    wildcards.clear()
+    self.assertEquals([], wildcards.Matches("a/b"))
+
+  def testReadStatusFile(self):
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, "test.status")
+      with open(filename, "w") as f:
+        f.write("[\n"
+                "[ALWAYS, {\n"
+                "  'exact': [FAIL],\n"
+                "  'regress/*': [SKIP],\n"
+                "}],\n"
+                "['arch == x64', {\n"
+                "  'regress/x64*': [PASS, FLAKY],\n"
+                "}],\n"
+                "]\n")
+      rules, wildcards = statusfile.ReadStatusFile(filename, {"arch": "x64"})
+    finally:
+      shutil.rmtree(directory)
+    self.assertEquals({"exact": set([statusfile.FAIL])}, rules)
+    self.assertTrue(isinstance(wildcards, statusfile.WildcardRules))
+    self.assertEquals(LinearMatches(wildcards, "regress/x64-1"),
+                      wildcards.Matches("regress/x64-1"))
+    self.assertEquals(["regress/*"], wildcards.Matches("regress/1"))
+
+
+if __name__ == "__main__":
+  unittest.main()
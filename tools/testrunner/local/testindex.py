@@ -0,0 +1,122 @@
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""On-disk cache of the test listing and test metadata of a suite.
+
+Listing a large suite walks thousands of directories, and computing the
+flags of a test reads and parses its source, for every variant and rerun.
+An index remembers both across runs: a directory is listed again only if
+its mtime changed, and a source file is parsed again only if its mtime or
+size changed. The parsed metadata is also dropped when the parser, i.e.
+the testcfg.py of the suite, changes. Whoever opens an index calls Save()
+once the tests have run.
+"""
+
+import cPickle
+import os
+
+from . import utils
+
+
+# Bump when the layout of the index file changes.
+VERSION = 1
+
+
+class TestIndex(object):
+
+  def __init__(self, filename, salt):
+    self.filename = filename
+    self.salt = salt
+    # Maps a directory to [mtime, subdirectories, files].
+    self.dirs = {}
+    # Maps a file to [(mtime, size), metadata].
+    self.files = {}
+    # Metadata of the files that were checked in this process.
+    self.checked = {}
+    self.dirty = False
+    self.pid = os.getpid()
+    try:
+      with open(filename, "rb") as f:
+        (version, salt, self.dirs, files) = cPickle.load(f)
+      if version != VERSION:
+        self.dirs = {}
+      elif salt == self.salt:
+        self.files = files
+    except Exception:
+      # A missing or broken index just starts out empty.
+      self.dirs = {}
+      self.files = {}
+
+  def Walk(self, top):
+    """Like os.walk(top), but lists a directory only if it changed.
+
+    The directory names may be pruned in place, as with os.walk.
+    """
+    try:
+      mtime = os.stat(top).st_mtime
+    except OSError:
+      return
+    entry = self.dirs.get(top)
+    if entry is None or entry[0] != mtime:
+      try:
+        names = os.listdir(top)
+      except OSError:
+        return
+      dirs = []
+      files = []
+      for name in names:
+        if os.path.isdir(os.path.join(top, name)):
+          dirs.append(name)
+        else:
+          files.append(name)
+      entry = [mtime, dirs, files]
+      self.dirs[top] = entry
+      self.dirty = True
+    dirs = list(entry[1])
+    yield (top, dirs, list(entry[2]))
+    for name in dirs:
+      path = os.path.join(top, name)
+      if not os.path.islink(path):
+        for result in self.Walk(path):
+          yield result
+
+  def GetMetadata(self, filename, parse):
+    """Returns parse(source of |filename|), from the index if possible.
+
+    The result is shared between callers and must not be modified.
+    """
+    if filename in self.checked:
+      return self.checked[filename]
+    # Stat before reading, so that a change during the read is noticed by
+    # the next run.
+    stat = os.stat(filename)
+    key = (stat.st_mtime, stat.st_size)
+    entry = self.files.get(filename)
+    if entry is None or entry[0] != key:
+      with open(filename) as f:
+        entry = [key, parse(f.read())]
+      self.files[filename] = entry
+      self.dirty = True
+    self.checked[filename] = entry[1]
+    return entry[1]
+
+  def Save(self):
+    # Forked workers inherit the index, but only its owner writes it.
+    if not self.dirty or os.getpid() != self.pid:
+      return
+    directory = os.path.dirname(self.filename)
+    try:
+      if not os.path.exists(directory):
+        os.makedirs(directory)
+      temp = "%s.%d" % (self.filename, self.pid)
+      with open(temp, "wb") as f:
+        cPickle.dump((VERSION, self.salt, self.dirs, self.files), f,
+                     cPickle.HIGHEST_PROTOCOL)
+      if utils.IsWindows() and os.path.exists(self.filename):
+        os.remove(self.filename)
+      os.rename(temp, self.filename)
+      self.dirty = False
+    except (IOError, OSError), e:
+      print("Could not write the test index %s: %s" % (self.filename, e))
+
@@ -26,11 +26,13 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import hashlib
 import imp
 import os
 
 from . import commands
 from . import statusfile
+from . import testindex
 from . import utils
 from ..objects import testcase
 
@@ -56,8 +58,10 @@ class TestSuite(object):
     self.root = root  # string containing path
     self.tests = None  # list of TestCase objects
     self.rules = None  # dictionary mapping test path to list of outcomes
-    self.wildcards = None  # dictionary mapping test paths to list of outcomes
+    self.wildcards = None  # statusfile.WildcardRules of test path prefixes
     self.total_duration = None  # float, assigned on demand
+    self.index = None  # TestIndex, opened on demand
+    self.code_hash = None  # sha1 of testcfg.py, computed on demand
 
   def shell(self):
     return "d8"
@@ -75,6 +79,44 @@ class TestSuite(object):
     else:
       return testcase.path
 
+  def GetIndex(self):
+    """Returns the on-disk index of this suite's tests, see testindex.py."""
+    if self.index is None:
+      workspace = os.path.join(self.root, "..", "..")
+      filename = os.path.join(workspace, "out", "testrunner_data", "index",
+                              "%s.pickle" % self.name)
+      # Metadata parsed by an older testcfg.py is stale.
+      self.index = testindex.TestIndex(os.path.abspath(filename),
+                                       self.GetCodeHash())
+    return self.index
+
+  def SaveIndex(self):
+    """Writes the index back if it was used and changed."""
+    if self.index is not None:
+      self.index.Save()
+
+  def GetCodeHash(self):
+    """Returns the sha1 of this suite's testcfg.py."""
+    if self.code_hash is None:
+      digest = hashlib.sha1()
+      try:
+        with open(os.path.join(self.root, "testcfg.py"), "rb") as f:
+          digest.update(f.read())
+      except IOError:
+        pass
+      self.code_hash = digest.hexdigest()
+    return self.code_hash
+
+  def GetMetadata(self, filename):
+    """Returns ParseMetadata() of the source in |filename|, cached in the
+    index."""
+    return self.GetIndex().GetMetadata(filename, self.ParseMetadata)
+
+  def ParseMetadata(self, source):
+    """Returns what GetFlagsForTestCase() and IsNegativeTest() need to know
+    about a test source, as a picklable value."""
+    return None
+
   def ListTests(self, context):
     raise NotImplementedError
 
@@ -127,17 +169,15 @@ class TestSuite(object):
         slow = statusfile.IsSlow(t.outcomes)
         pass_fail = statusfile.IsPassOrFail(t.outcomes)
       skip = False
-      for rule in self.wildcards:
-        assert rule[-1] == '*'
-        if testname.startswith(rule[:-1]):
-          used_rules.add(rule)
-          t.outcomes = self.wildcards[rule]
-          if statusfile.DoSkip(t.outcomes):
-            skip = True
-            break  # "for rule in self.wildcards"
-          flaky = flaky or statusfile.IsFlaky(t.outcomes)
-          slow = slow or statusfile.IsSlow(t.outcomes)
-          pass_fail = pass_fail or statusfile.IsPassOrFail(t.outcomes)
+      for rule in self.wildcards.Matches(testname):
+        used_rules.add(rule)
+        t.outcomes = self.wildcards[rule]
+        if statusfile.DoSkip(t.outcomes):
+          skip = True
+          break  # "for rule in self.wildcards.Matches(testname)"
+        flaky = flaky or statusfile.IsFlaky(t.outcomes)
+        slow = slow or statusfile.IsSlow(t.outcomes)
+        pass_fail = pass_fail or statusfile.IsPassOrFail(t.outcomes)
       if (skip or self._FilterFlaky(flaky, flaky_tests)
           or self._FilterSlow(slow, slow_tests)
           or self._FilterPassFail(pass_fail, pass_fail_tests)):
@@ -184,6 +224,11 @@ class TestSuite(object):
   def IsFailureOutput(self, output, testpath):
     return output.exit_code != 0
 
+  def GetExpectationFiles(self, testcase):
+    """Returns the files besides those on the command line that
+    IsFailureOutput() reads for |testcase|."""
+    return []
+
   def IsNegativeTest(self, testcase):
     return False
 
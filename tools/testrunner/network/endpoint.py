@@ -119,6 +119,9 @@ def Execute(workspace, ctx, tests, sock, server):
     else:
       message = "%s" % e
     compression.Send([[-1, message]], sock)
+  finally:
+    for s in suites:
+      s.SaveIndex()
   progress_indicator.HasRun(None, None)  # Sentinel to signal the end.
   progress_indicator.sender_lock.acquire()  # Released when sending is done.
   progress_indicator.sender_lock.release()
@@ -112,6 +112,13 @@ class NetworkedRunner(execution.Runner):
       self.local_receiver.Advance()
 
   def Run(self, jobs):
+    try:
+      return self._RunNetworked(jobs)
+    finally:
+      # The perf data store buffers its updates until it is closed.
+      self._RunPerfSafe(lambda: self.perf_data_manager.close())
+
+  def _RunNetworked(self, jobs):
     self.indicator.Starting()
     need_libv8 = False
     for s in self.suites:
@@ -30,7 +30,8 @@ class Context():
   def __init__(self, arch, mode, shell_dir, mode_flags, verbose, timeout,
                isolates, command_prefix, extra_flags, noi18n, random_seed,
                no_sorting, rerun_failures_count, rerun_failures_max,
-               predictable):
+               predictable, max_output, batch_workers, adaptive_timeouts,
+               result_cache, thread_workers):
     self.arch = arch
     self.mode = mode
     self.shell_dir = shell_dir
@@ -46,16 +47,25 @@ class Context():
     self.rerun_failures_count = rerun_failures_count
     self.rerun_failures_max = rerun_failures_max
     self.predictable = predictable
+    self.max_output = max_output
+    self.batch_workers = batch_workers
+    self.adaptive_timeouts = adaptive_timeouts
+    self.result_cache = result_cache
+    self.thread_workers = thread_workers
 
   def Pack(self):
     return [self.arch, self.mode, self.mode_flags, self.timeout, self.isolates,
             self.command_prefix, self.extra_flags, self.noi18n,
             self.random_seed, self.no_sorting, self.rerun_failures_count,
-            self.rerun_failures_max, self.predictable]
+            self.rerun_failures_max, self.predictable, self.max_output,
+            self.batch_workers, self.adaptive_timeouts,
+            self.result_cache, self.thread_workers]
 
   @staticmethod
   def Unpack(packed):
     # For the order of the fields, refer to Pack() above.
     return Context(packed[0], packed[1], None, packed[2], False,
                    packed[3], packed[4], packed[5], packed[6], packed[7],
-                   packed[8], packed[9], packed[10], packed[11], packed[12])
+                   packed[8], packed[9], packed[10], packed[11], packed[12],
+                   packed[13], packed[14], packed[15], packed[16],
+                   packed[17])
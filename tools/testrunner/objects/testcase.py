@@ -38,6 +38,7 @@ class TestCase(object):
     self.output = None
     self.id = None  # int, used to map result back to TestCase instance
     self.duration = None  # assigned during execution
+    self.timeout = None  # adaptive timeout from the perf data, if any
     self.run = 1  # The nth time this test is executed.
 
   def CopyAddingFlags(self, flags):
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Copyright 2015 the V8 project authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import random
+import sys
+import unittest
+
+# The modules under test use package-relative imports.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from testrunner.server import compression
+from testrunner.server import constants
+
+
+class FakeSocket(object):
+  """Returns what was sent in chunks of at most |chunk_size| bytes, or of
+  random sizes up to it with |rng|."""
+
+  def __init__(self, chunk_size=None, rng=None):
+    self.data = ""
+    self.position = 0
+    self.chunk_size = chunk_size
+    self.rng = rng
+    self.recv_calls = 0
+
+  def sendall(self, data):
+    self.data += data
+
+  def recv_into(self, view):
+    self.recv_calls += 1
+    size = min(len(view), len(self.data) - self.position)
+    if self.chunk_size is not None:
+      chunk_size = self.chunk_size
+      if self.rng is not None:
+        chunk_size = self.rng.randint(1, chunk_size)
+      size = min(size, chunk_size)
+    view[:size] = self.data[self.position:self.position + size]
+    self.position += size
+    return size
+
+
+def ReceiveAll(sock):
+  received = []
+  receiver = compression.Receiver(sock)
+  while not receiver.IsDone():
+    received.append(receiver.Current())
+    receiver.Advance()
+  return received
+
+
+class ReceiverTest(unittest.TestCase):
+  def setUp(self):
+    self.messages = [[1, "one"], {"key": [2, 3.5, None]}, "x" * 1000, [],
+                     ["pid", 17, "stdout" * 100]]
+    self.buffer_size = compression.Receiver.BUFFER_SIZE
+
+  def tearDown(self):
+    compression.Receiver.BUFFER_SIZE = self.buffer_size
+
+  def Send(self, sock, messages, end=True):
+    for message in messages:
+      compression.Send(message, sock)
+    if end:
+      compression.Send(constants.END_OF_STREAM, sock)
+
+  def testSplitMessages(self):
+    sock = FakeSocket(chunk_size=1)
+    self.Send(sock, self.messages)
+    self.assertEquals(self.messages, ReceiveAll(sock))
+
+  def testManyMessagesPerReceive(self):
+    sock = FakeSocket()
+    self.Send(sock, self.messages * 20)
+    self.assertEquals(self.messages * 20, ReceiveAll(sock))
+    # Everything up to the end of the stream arrives with the first call.
+    self.assertEquals(1, sock.recv_calls)
+
+  def testSmallBuffer(self):
+    # Moves unread data to the front and grows the buffer for the large
+    # messages.
+    compression.Receiver.BUFFER_SIZE = 16
+    rng = random.Random(11)
+    for chunk_size in (1, 7, 64, 5000):
+      sock = FakeSocket(chunk_size, rng)
+      messages = self.messages * 5 + [range(10000)] + self.messages
+      self.Send(sock, messages)
+      self.assertEquals(messages, ReceiveAll(sock))
+
+  def testClosedWithoutEndOfStream(self):
+    sock = FakeSocket(chunk_size=3)
+    self.Send(sock, self.messages, end=False)
+    self.assertEquals(self.messages, ReceiveAll(sock))
+
+  def testTruncated(self):
+    for cut in (1, constants.SIZE_T, constants.SIZE_T + 2):
+      sock = FakeSocket()
+      self.Send(sock, self.messages, end=False)
+      sock.data = sock.data[:-cut]
+      self.assertEquals(self.messages[:-1], ReceiveAll(sock))
+
+  def testEmpty(self):
+    self.assertEquals([], ReceiveAll(FakeSocket()))
+    sock = FakeSocket()
+    self.Send(sock, [])
+    self.assertEquals([], ReceiveAll(sock))
+
+
+if __name__ == "__main__":
+  unittest.main()
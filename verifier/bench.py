@@ -0,0 +1,247 @@
+# Measures the throughput of the reference validator in dfa_ncval.c
+# against a generated trie_table.h, so that trie and table encoding
+# changes can be compared before and after:
+#
+#   python bench.py -t trie_table.h -o before.json [blob...]
+#   python trie_to_c.py --encoding=comb -o comb.h inst.trie
+#   python bench.py -t comb.h --baseline before.json [blob...]
+#
+# Every run validates a synthetic blob of instructions sampled from
+# instr.py, plus any recorded code blobs given on the command line (raw
+# x64 code, e.g. from "objcopy -O binary --only-section=.text").  The
+# validator is built twice: once for timing, and once with
+# -DDFA_NCVAL_STATS to count the DFA states visited per byte.
+
+import hashlib
+import json
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import byteclass
+import instr
+import triefile
+import verifier
+
+def BuildValidator(cc, table, directory, name, defines):
+  # dfa_ncval.c includes "trie_table.h" from its own directory, so the
+  # table under test is copied next to it.
+  source = os.path.join(directory, 'dfa_ncval.c')
+  if not os.path.exists(source):
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'dfa_ncval.c'), source)
+    shutil.copy(table, os.path.join(directory, 'trie_table.h'))
+  binary = os.path.join(directory, name)
+  command = ([cc, '-O3', '-DDFA_NCVAL_BENCH'] +
+             ['-D%s' % define for define in defines] +
+             [source, '-o', binary])
+  subprocess.check_call(command)
+  return binary
+
+
+# Mirrors validate() in dfa_ncval.c: the longest match starting at |pos|,
+# cut short by the special accept types.  Returns (end, resolved), where
+# |end| is None if nothing matched and |resolved| is False if the match
+# could still change once more bytes are appended.  If |visits| is given,
+# visits[(state, byte)] counts the lookups.
+def Match(rows, accepts, start, data, pos, visits=None):
+  state = start
+  end = None
+  for index in xrange(pos, len(data)):
+    if visits is not None:
+      visits[(state, data[index])] = visits.get((state, data[index]), 0) + 1
+    state = rows[state][data[index]]
+    if state == 0:
+      return end, True
+    accept = accepts[state]
+    if accept in verifier.SPECIAL_TYPES:
+      return index + 1, True
+    if accept is True:
+      end = index + 1
+  return end, False
+
+
+# Returns |size| bytes of instructions drawn uniformly from the encodings
+# of instr.py, with every byte class filled in at random.  Instructions
+# that make the blob fail validation (a longest match running into the
+# next instruction can leave bytes that no instruction starts with) are
+# dropped, so the blob always validates.
+def SyntheticBlob(trie_file, size, seed):
+  table = triefile.Open(trie_file)
+  rows = [table.Row(state) for state in xrange(table.states)]
+  accepts = [table.Accept(state) for state in xrange(table.states)]
+  encodings = [encoding for encoding, _ in instr.IterEncodings()]
+  choices = {}
+  rng = random.Random(seed)
+  data = bytearray()
+  # Everything before |committed| has been matched for good.
+  committed = 0
+  failures = 0
+  while len(data) < size:
+    encoding = rng.choice(encodings)
+    mark = len(data)
+    for key in encoding:
+      if key not in choices:
+        choices[key] = sorted(byteclass.Parse(key))
+      data.append(rng.choice(choices[key]))
+    pos = committed
+    while True:
+      end, resolved = Match(rows, accepts, table.start, data, pos)
+      if not resolved or end is None:
+        break
+      pos = end
+    if resolved and end is None:
+      del data[mark:]
+      failures += 1
+      assert failures < 1000, 'cannot extend the synthetic blob'
+    else:
+      committed = pos
+      failures = 0
+  # The bytes past |committed| may still be waiting for a longer match.
+  return str(data[:committed])
+
+
+def ParseResult(line):
+  fields = dict(field.split('=', 1) for field in line.split()[1:])
+  return dict((key, float(value)) for key, value in fields.iteritems())
+
+
+def Run(binary, iterations, filename):
+  process = subprocess.Popen([binary, str(iterations), filename],
+                             stdout=subprocess.PIPE)
+  output = process.communicate()[0]
+  if process.returncode != 0:
+    sys.exit('%s does not validate' % filename)
+  return ParseResult(output.strip().splitlines()[-1])
+
+
+# Times |filename| for at least |min_time| seconds per repetition and
+# keeps the fastest repetition.
+def Measure(bench, stats, filename, min_time, repeat):
+  iterations = 1
+  while True:
+    result = Run(bench, iterations, filename)
+    if result['seconds'] >= min_time:
+      break
+    iterations *= max(2, int(min_time / max(result['seconds'], 1e-6)))
+  seconds = result['seconds']
+  for _ in xrange(repeat - 1):
+    seconds = min(seconds, Run(bench, iterations, filename)['seconds'])
+  counts = Run(stats, 1, filename)
+  size = int(result['bytes'])
+  return {
+    'bytes': size,
+    'iterations': iterations,
+    'seconds': seconds,
+    'mb_per_s': size * iterations / seconds / 1e6,
+    'states_per_byte': counts['lookups'] / size,
+  }
+
+
+def Sha1(filename):
+  with open(filename, 'rb') as fh:
+    return hashlib.sha1(fh.read()).hexdigest()
+
+
+def PrintResults(results, baseline):
+  previous = {}
+  if baseline:
+    for result in baseline['results']:
+      previous[result['name']] = result
+  print '%-24s %10s %10s %14s %8s' % ('blob', 'bytes', 'MB/s',
+                                      'states/byte', 'speedup')
+  for result in results:
+    speedup = ''
+    old = previous.get(result['name'])
+    if old:
+      if old['sha1'] != result['sha1']:
+        speedup = 'new data'
+      else:
+        speedup = '%.2fx' % (result['mb_per_s'] / old['mb_per_s'])
+    print '%-24s %10i %10.1f %14.3f %8s' % (
+        result['name'][-24:], result['bytes'], result['mb_per_s'],
+        result['states_per_byte'], speedup)
+
+
+def Main(args):
+  parser = optparse.OptionParser(usage='%prog [options] [blob...]')
+  parser.add_option('-t', '--table', default='trie_table.h',
+                    help='The generated table to benchmark')
+  parser.add_option('--trie', default='inst.trie',
+                    help='The trie the synthetic blob is generated from')
+  parser.add_option('--synthetic-size', type='int', default=1 << 20,
+                    help='Size of the synthetic blob in bytes, 0 to skip it')
+  parser.add_option('--seed', type='int', default=0,
+                    help='Random seed of the synthetic blob')
+  parser.add_option('--min-time', type='float', default=0.5,
+                    help='Minimum seconds per timed repetition')
+  parser.add_option('--repeat', type='int', default=3,
+                    help='Number of timed repetitions, the best one counts')
+  parser.add_option('--cc', default=os.environ.get('CC', 'gcc'),
+                    help='The C compiler')
+  parser.add_option('--histogram',
+                    help='Write the number of lookups in every state, '
+                         'over all blobs, to this file (see trie_to_c.py '
+                         '--profile-histogram)')
+  parser.add_option('-o', '--output',
+                    help='Write the results to this JSON file')
+  parser.add_option('--baseline',
+                    help='Compare against the JSON file of an earlier run')
+  (options, blobs) = parser.parse_args(args)
+
+  directory = tempfile.mkdtemp(prefix='dfa_ncval_bench.')
+  try:
+    bench = BuildValidator(options.cc, options.table, directory,
+                           'bench', [])
+    stats = BuildValidator(options.cc, options.table, directory,
+                           'stats', ['DFA_NCVAL_STATS'])
+    inputs = []
+    if options.synthetic_size:
+      start = time.time()
+      filename = os.path.join(directory, 'synthetic.bin')
+      with open(filename, 'wb') as fh:
+        fh.write(SyntheticBlob(options.trie, options.synthetic_size,
+                               options.seed))
+      print 'Generated the synthetic blob in %.1fs' % (time.time() - start)
+      inputs.append(('synthetic-%i' % options.seed, filename))
+    inputs += [(blob, blob) for blob in blobs]
+
+    results = []
+    for name, filename in inputs:
+      result = Measure(bench, stats, filename, options.min_time,
+                       options.repeat)
+      result['name'] = name
+      result['sha1'] = Sha1(filename)
+      results.append(result)
+    if options.histogram:
+      environment = dict(os.environ)
+      environment['DFA_NCVAL_HISTOGRAM'] = os.path.abspath(options.histogram)
+      subprocess.check_call([stats, '1'] +
+                            [filename for _, filename in inputs],
+                            env=environment, stdout=open(os.devnull, 'w'))
+  finally:
+    shutil.rmtree(directory)
+
+  baseline = None
+  if options.baseline:
+    with open(options.baseline) as fh:
+      baseline = json.load(fh)
+  PrintResults(results, baseline)
+  if options.output:
+    with open(options.output, 'w') as fh:
+      json.dump({
+        'table': os.path.abspath(options.table),
+        'table_sha1': Sha1(options.table),
+        'cc': options.cc,
+        'time': time.time(),
+        'results': results,
+      }, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
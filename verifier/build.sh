@@ -1,12 +1,19 @@
 #!/bin/bash
 
-echo "Enumerating instructions..."
-./instr.py > inst
+# The encodings are enumerated in-process by trie.py.  For debugging, the
+# textual listing can still be produced with "./instr.py > inst" and fed
+# to "python trie.py inst".  The sub-trie of every instruction is kept in
+# trie-cache/, so after editing instr.py only the changed instructions are
+# enumerated again.
 echo "Generating Trie..."
-python trie.py inst
+python trie.py -j $(getconf _NPROCESSORS_ONLN) --cache trie-cache
+echo "Minimizing Trie..."
+python minimize.py inst.trie
 echo "Converting Trie..."
 python trie_to_c.py inst.trie
 cp trie_table.h ../src/x64/
 echo "Done"
 #echo "Compiling..."
 #gcc -O3 dfa_ncval.c -o dfa_ncval
+#echo "Benchmarking..."
+#python bench.py -o bench.json
@@ -0,0 +1,74 @@
+# Byte classes label the edges of the verifier trie.  A class is kept as
+# a string so that it can be used as a dictionary key and survives the
+# JSON round trip of the .trie file:
+#
+#   'c0'         a single byte
+#   'XX'         any byte
+#   'c0-c7,d0'   a union of byte ranges
+#
+# Single bytes keep the two-digit form, so "bytes:type" listings written
+# before byte classes existed are still valid input.
+
+import memoize
+
+ANY = 'XX'
+
+
+def IsSingle(key):
+  return len(key) == 2 and key != ANY
+
+
+# Returns the frozenset of byte values in class |key|.
+@memoize.Memoize
+def Parse(key):
+  if key == ANY:
+    return frozenset(xrange(256))
+  values = set()
+  for part in key.split(','):
+    if '-' in part:
+      low, high = part.split('-')
+      values.update(xrange(int(low, 16), int(high, 16) + 1))
+    else:
+      values.add(int(part, 16))
+  return frozenset(values)
+
+
+@memoize.Memoize
+def _FormatSet(values):
+  assert values, 'empty byte class'
+  if len(values) == 256:
+    return ANY
+  ranges = []
+  for value in sorted(values):
+    if ranges and ranges[-1][1] == value - 1:
+      ranges[-1][1] = value
+    else:
+      ranges.append([value, value])
+  return ','.join('%02x' % low if low == high else '%02x-%02x' % (low, high)
+                  for low, high in ranges)
+
+
+# Returns the canonical class for an iterable of byte values.
+def Format(values):
+  return _FormatSet(frozenset(values))
+
+
+# Returns the canonical class covering all the given classes.
+def Union(keys):
+  values = set()
+  for key in keys:
+    values.update(Parse(key))
+  return Format(values)
+
+
+# Returns the coarsest partition of the byte values such that each of
+# |keys| is a union of its blocks.  The blocks are frozensets, ordered by
+# their smallest byte.
+def Atoms(keys):
+  blocks = [frozenset(xrange(256))]
+  for values in set(Parse(key) for key in keys):
+    refined = []
+    for block in blocks:
+      refined += [part for part in (block & values, block - values) if part]
+    blocks = refined
+  return sorted(blocks, key=min)
@@ -12,6 +12,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
 
 #include "trie_table.h"
 
@@ -19,6 +20,17 @@ static const int kBitsPerByte = 8;
 
 static const uint32_t ConstLoadAddr = 0x80000000; // 2GB
 
+// Built with -DDFA_NCVAL_STATS, every DFA transition is counted so the
+// benchmark can report the states visited per byte of code, and
+// trie_to_c.py can number the hot states together.
+#ifdef DFA_NCVAL_STATS
+static uint64_t trie_lookups;
+static uint64_t trie_visits[1 << 16];
+#define COUNT_LOOKUP(state) (trie_lookups++, trie_visits[state]++)
+#else
+#define COUNT_LOOKUP(state)
+#endif
+
 static inline uint8_t *BitmapAllocate(uint32_t indexes) {
   uint32_t byte_count = (indexes + kBitsPerByte - 1) / kBitsPerByte;
   uint8_t *bitmap = malloc(byte_count);
@@ -56,6 +68,7 @@ static int validate(uint8_t *cur, uint8_t *end,
                     uint16_t start, uint16_t *end_state, uint8_t** endptr) {
   uint16_t state = start;
   while (cur < end) {
+    COUNT_LOOKUP(state);
     state = trie_lookup(state, *cur++);
     if (0 == state) {
       return -1;
@@ -65,7 +78,11 @@ static int validate(uint8_t *cur, uint8_t *end,
                trie_accepts_icall(state) ||
                trie_accepts_dcall(state) ||
                trie_accepts_jmp_rel1(state) ||
-               trie_accepts_jmp_rel4(state)) {
+               trie_accepts_jmp_rel4(state) ||
+               trie_accepts_jcc_rel1(state) ||
+               trie_accepts_jcc_rel4(state) ||
+               trie_accepts_ijmp(state) ||
+               trie_accepts_terminator(state)) {
       *end_state = state;
       *endptr = cur;
       return 0;
@@ -184,6 +201,68 @@ int ValidateFile(const char *filename) {
   return ValidateChunk(0x80000000,data, data_size);
 }
 
+#ifdef DFA_NCVAL_BENCH
+// Usage: dfa_ncval_bench iterations file...
+// Validates every file |iterations| times and prints one line of
+// measurements per file, which verifier/bench.py parses.
+int main(int argc, char **argv) {
+  int iterations;
+  int index;
+  int i;
+  if (argc < 3) {
+    printf("%s: usage: %s iterations file...\n", argv[0], argv[0]);
+    return 1;
+  }
+  iterations = atoi(argv[1]);
+  for (index = 2; index < argc; index++) {
+    const char *filename = argv[index];
+    size_t data_size;
+    uint8_t *data;
+    struct timespec begin, finish;
+    double seconds;
+    ReadFile(filename, &data, &data_size);
+#ifdef DFA_NCVAL_STATS
+    trie_lookups = 0;
+#endif
+    clock_gettime(CLOCK_MONOTONIC, &begin);
+    for (i = 0; i < iterations; i++) {
+      if (ValidateChunk(ConstLoadAddr, data, data_size) != 0) {
+        printf("file '%s' failed validation\n", filename);
+        return 1;
+      }
+    }
+    clock_gettime(CLOCK_MONOTONIC, &finish);
+    seconds = (finish.tv_sec - begin.tv_sec) +
+              (finish.tv_nsec - begin.tv_nsec) * 1e-9;
+#ifdef DFA_NCVAL_STATS
+    printf("%s bytes=%lu iterations=%d seconds=%.9f lookups=%llu\n",
+           filename, (unsigned long) data_size, iterations, seconds,
+           (unsigned long long) trie_lookups);
+#else
+    printf("%s bytes=%lu iterations=%d seconds=%.9f\n",
+           filename, (unsigned long) data_size, iterations, seconds);
+#endif
+    free(data);
+  }
+#ifdef DFA_NCVAL_STATS
+  // "state count" lines for trie_to_c.py --profile-histogram.
+  if (getenv("DFA_NCVAL_HISTOGRAM") != NULL) {
+    FILE *fp = fopen(getenv("DFA_NCVAL_HISTOGRAM"), "w");
+    if (fp == NULL) {
+      fprintf(stderr, "Failed to open the histogram file\n");
+      return 1;
+    }
+    for (i = 0; i < (1 << 16); i++) {
+      if (trie_visits[i] != 0) {
+        fprintf(fp, "%d %llu\n", i, (unsigned long long) trie_visits[i]);
+      }
+    }
+    fclose(fp);
+  }
+#endif
+  return 0;
+}
+#else
 int main(int argc, char **argv) {
   int index;
   if (argc == 1) {
@@ -199,3 +278,4 @@ int main(int argc, char **argv) {
   }
   return 0;
 }
+#endif
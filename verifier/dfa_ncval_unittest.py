@@ -0,0 +1,144 @@
+# Checks which code validate() in dfa_ncval.c accepts, and that the
+# Python validator in verifier.py agrees.  The validator is built
+# against the table of a small DFA with one made-up instruction of every
+# accept type, so no inst.trie is needed:
+#
+#   python dfa_ncval_unittest.py
+
+import distutils.spawn
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import triefile
+import verifier
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+CC = os.environ.get('CC', 'cc')
+
+ANY = range(256)
+
+# The bytes of every instruction, one list of allowed values per
+# position, and the accept type of its last state.
+INSTRUCTIONS = [
+    ([[0x90]], True),
+    ([[0x70], ANY], 'jcc_rel1'),
+    ([[0x0f], range(0x80, 0x90), ANY, ANY, ANY, ANY], 'jcc_rel4'),
+    ([[0xeb], ANY], 'jmp_rel1'),
+    ([[0xe9], ANY, ANY, ANY, ANY], 'jmp_rel4'),
+    ([[0xe8], ANY, ANY, ANY, ANY], 'dcall'),
+    ([[0xff], [0xe0]], 'ijmp'),
+    ([[0x41], [0xff], [0xd3]], 'icall'),
+    ([[0x0b]], 'mcficall'),
+    ([[0x0c]], 'mcficheck'),
+    ([[0x0d]], 'mcfiret'),
+    ([[0xf4]], 'terminator'),
+]
+
+VALID = [
+    ('nops', '\x90\x90\x90'),
+    ('jcc_rel1', '\x70\x00\x90'),
+    ('jcc_rel4', '\x0f\x84\x00\x00\x00\x00\x90'),
+    ('jmp_rel1', '\x90\xeb\x00\x90'),
+    ('jmp_rel4', '\xe9\x00\x00\x00\x00\x90'),
+    ('dcall', '\xe8\x00\x00\x00\x00\x90'),
+    ('ijmp', '\xff\xe0\x90'),
+    ('icall', '\x41\xff\xd3\x90'),
+    ('mcfi', '\x0b\x0c\x0d\x90'),
+    ('terminator', '\xf4\x90'),
+    ('jumps_at_end', '\x90\x70\x00\xff\xe0\xf4'),
+]
+
+INVALID = [
+    ('unknown', '\x90\x06\x90'),
+    ('truncated_jcc', '\x90\x70'),
+    ('bad_second_byte', '\xff\xe1'),
+]
+
+
+# Returns (start, accepts, rows) of a tree-shaped DFA for INSTRUCTIONS,
+# numbered in the post-order that triefile expects.
+def BuildDfa():
+  accepts = [False]
+  rows = [[0] * 256]
+  start_row = [0] * 256
+  for values, accept in INSTRUCTIONS:
+    state = len(rows)
+    accepts.append(accept)
+    rows.append([0] * 256)
+    for position in xrange(len(values) - 1, 0, -1):
+      row = [0] * 256
+      for value in values[position]:
+        row[value] = state
+      state = len(rows)
+      accepts.append(False)
+      rows.append(row)
+    for value in values[0]:
+      assert start_row[value] == 0
+      start_row[value] = state
+  accepts.append(False)
+  rows.append(start_row)
+  return len(rows) - 1, accepts, rows
+
+
+class DfaNcvalTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.directory = tempfile.mkdtemp()
+    start, accepts, rows = BuildDfa()
+    cls.table = verifier.Table(rows, accepts, start)
+    trie_file = os.path.join(cls.directory, 'test.trie')
+    with open(trie_file, 'wb') as fh:
+      fh.write(triefile.Pack(start, accepts, rows))
+    cls.binary = None
+    if distutils.spawn.find_executable(CC) is None:
+      return
+    # dfa_ncval.c includes "trie_table.h" from its own directory.
+    shutil.copy(os.path.join(DIRECTORY, 'dfa_ncval.c'), cls.directory)
+    with open(os.devnull, 'w') as devnull:
+      subprocess.check_call(
+          [sys.executable, os.path.join(DIRECTORY, 'trie_to_c.py'),
+           '-o', os.path.join(cls.directory, 'trie_table.h'), trie_file],
+          stdout=devnull)
+    cls.binary = os.path.join(cls.directory, 'dfa_ncval')
+    subprocess.check_call([CC, '-O2', '-o', cls.binary,
+                           os.path.join(cls.directory, 'dfa_ncval.c')])
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory)
+
+  def RunValidator(self, name, blob):
+    filename = os.path.join(self.directory, name)
+    with open(filename, 'wb') as fh:
+      fh.write(blob)
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.call([self.binary, filename], stdout=devnull,
+                             stderr=devnull) == 0
+
+  def testDfaNcval(self):
+    if self.binary is None:
+      self.skipTest('no C compiler')
+    for name, blob in VALID:
+      self.assertTrue(self.RunValidator(name, blob), name)
+    for name, blob in INVALID:
+      self.assertFalse(self.RunValidator(name, blob), name)
+
+  def testVerifier(self):
+    blobs = [blob for _, blob in VALID + INVALID]
+    expected = [None] * len(VALID) + [True] * len(INVALID)
+    results = verifier.ValidateBlobs(self.table, blobs, use_numpy=False)
+    self.assertEquals(expected,
+                      [result and True for result in results])
+    if verifier.numpy is not None:
+      self.assertEquals(results,
+                        verifier.ValidateBlobsLockstep(self.table, blobs))
+
+
+if __name__ == '__main__':
+  unittest.main()
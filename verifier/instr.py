@@ -2,10 +2,20 @@
 # This file contains all allowed instruction's binary encoding, which comes
 # from Intel's software development document.
 
+import hashlib
+import inspect
+import sys
+
+import byteclass
+
 # Byte
 def Byte(x):
     return '0x%02x' % x
 
+# A single trie edge standing for all the given '0x..' bytes
+def ByteClass(bytes):
+    return '0x' + byteclass.Format(int(x, 16) for x in bytes)
+
 def Imm8():
     return '0xXX'
 
@@ -60,29 +70,36 @@ def Triplet(forbidden = set()):
 #for x in Triplet(set(['000'])):
 #    print x
 
-# SIB not only enumerates sib bytes but also the immediates
+# SIB not only enumerates sib bytes but also the immediates.  SIB bytes
+# that are followed by the same immediate are yielded as one byte class.
 def SIB(mod):
     assert(mod != '11')
     SS = ['00', '01', '10', '11']
     Index = [x for x in Triplet()]
     Base = [x for x in Triplet()]
+    groups = {}
     for ss in SS:
         for index in Index:
             for base in Base:
                 sib = Byte(int(ss + index + base, 2))
                 if mod == '00':
                     if base == '101':
-                        yield '%s %s' % (sib, Imm32())
+                        imm = Imm32()
                     else:
-                        yield sib
+                        imm = ''
                 elif mod == '01':
-                    yield '%s %s' % (sib, Imm8())
+                    imm = Imm8()
                 else:
-                    yield '%s %s' % (sib, Imm32())
+                    imm = Imm32()
+                groups.setdefault(imm, []).append(sib)
+    for imm, sibs in sorted(groups.iteritems()):
+        yield '%s %s' % (ByteClass(sibs), imm)
 
 #for x in SIB('10'):
 #    print x
 
+# ModRM bytes that are followed by the same SIB/displacement bytes are
+# yielded as one byte class.
 def ModRM(template, forbidden_reg = set(), forbidden_rm = set()):
     template = template.strip().split()
     assert(len(template) == 3); # Mod Reg R/M
@@ -102,32 +119,34 @@ def ModRM(template, forbidden_reg = set(), forbidden_rm = set()):
     else:
         RM = [x for x in Triplet(forbidden_rm)]
 
+    groups = {}
     for mod in Mod:
         for reg in Reg:
             for rm in RM:
                 modrm = Byte(int(mod + reg + rm, 2))
                 if mod == '00':
                     if rm == '100':
-                        for sib in SIB(mod):
-                            yield '%s %s' % (modrm, sib)
+                        tails = tuple(SIB(mod))
                     elif rm == '101':
                         continue # RIP-relative addressing is not used in v8 JITted code
                     else:
-                        yield modrm
+                        tails = ('',)
                 elif mod == '01':
                     if rm == '100':
-                        for sib in SIB(mod):
-                            yield '%s %s' % (modrm, sib)
+                        tails = tuple(SIB(mod))
                     else:
-                        yield '%s %s' % (modrm, Imm8())
+                        tails = (Imm8(),)
                 elif mod == '10':
                     if rm == '100':
-                        for sib in SIB(mod):
-                            yield '%s %s' % (modrm, sib)
+                        tails = tuple(SIB(mod))
                     else:
-                        yield '%s %s' % (modrm, Imm32())
+                        tails = (Imm32(),)
                 else: # mod == '11'
-                    yield modrm
+                    tails = ('',)
+                groups.setdefault(tails, []).append(modrm)
+    for tails, modrms in sorted(groups.iteritems()):
+        for tail in tails:
+            yield '%s %s' % (ByteClass(modrms), tail)
 
 #for x in ModRM('mod reg r/m'):
 #    print x
@@ -138,9 +157,9 @@ class Encoding:
     def interpret_opcode(self, opcode):
         opcode = ''.join(opcode.strip().split())
         if len(opcode) == 8:
-            return [opc for opc in REX(opcode)]
+            return [ByteClass(REX(opcode))]
         if len(opcode) == 16:
-            return [opc1 + ' ' + opc2 for opc1 in REX(opcode[:8]) for opc2 in REX(opcode[8:])]
+            return [ByteClass(REX(opcode[:8])) + ' ' + ByteClass(REX(opcode[8:]))]
 
     def __init__(self, prefix, rex, opcode, modrm = None,
                  forbidden_reg = set(), forbidden_rm = set(), \
@@ -151,7 +170,7 @@ class Encoding:
             self.prefix = ['']
 
         if rex:
-            self.rex = [rx for rx in REX(rex)]
+            self.rex = [ByteClass(REX(rex))]
         else:
             self.rex = ['']
 
@@ -196,7 +215,7 @@ class Encoding:
             self.prefix = ['']
 
         if rex:
-            self.rex = [rx for rx in REX(rex)]
+            self.rex = [ByteClass(REX(rex))]
         else:
             self.rex = ['']
 
@@ -213,6 +232,8 @@ class Encoding:
 
         self.opcode = [opc for opc in REX(opcode) if not opc in forbidden_opcode ]
         #print self.opcode, forbidden_opcode
+        if self.opcode:
+            self.opcode = [ByteClass(self.opcode)]
         return self
 
     def encoding2(self):
@@ -222,6 +243,9 @@ class Encoding:
                     for imm in self.imm_width:
                         yield '%s %s %s %s' % (prx, rex, opc, imm)
 
+# All declared instructions, in declaration order.
+Instructions = []
+
 class Instruction:
     def __init__(self, name, attr = None):
         self.name = name
@@ -229,26 +253,67 @@ class Instruction:
             self.attr = ''
         else:
             self.attr = attr
-
-    def dump(self, ecd):
-        ecd = ' '.join([x[2:] for x in ecd.strip().split()]) + ':' + self.attr
-        #ecd = ' '.join([x for x in ecd.strip().split()])
-        print ecd
+        # Forms are only recorded here and enumerated lazily by encodings().
+        self.forms = []
+        Instructions.append(self)
 
     def addform(self, prefix, rex, opcode, modrm = None, forbidden_reg = set(), \
                 forbidden_rm = set(), imm_width = 0, extra = None, interpret_opcode = False):
-        #global Dictionary
-        for ecd in Encoding(prefix, rex, opcode, modrm, forbidden_reg, \
-                            forbidden_rm, imm_width, extra, interpret_opcode).encoding():
-            self.dump(ecd)
-            #Dictionary += ecd
+        self.forms.append(('addform', (prefix, rex, opcode, modrm, forbidden_reg, \
+                                       forbidden_rm, imm_width, extra, interpret_opcode)))
 
     def addform2(self, prefix, rex, opcode, forbidden_opcode = set(), imm_width = 0):
-        #global Dictionary
-        for ecd in Encoding(None, None, '').init2(prefix, rex, opcode, \
-                                                  forbidden_opcode, imm_width).encoding2():
-            self.dump(ecd)
-            #Dictionary += ecd
+        self.forms.append(('addform2', (prefix, rex, opcode, forbidden_opcode, imm_width)))
+
+    # A hash of everything the encodings of this instruction depend on,
+    # apart from the helpers covered by HelperDigest().
+    def digest(self):
+        return hashlib.sha1(repr(Canonical((self.name, self.attr, self.forms)))).hexdigest()
+
+    def encodings(self):
+        for kind, args in self.forms:
+            if kind == 'addform':
+                ecds = Encoding(*args).encoding()
+            else:
+                ecds = Encoding(None, None, '').init2(*args).encoding2()
+            for ecd in ecds:
+                yield tuple([x[2:] for x in ecd.strip().split()]), self.attr
+
+# Returns |value| with its sets replaced by sorted lists, so that its repr
+# does not depend on the set iteration order.
+def Canonical(value):
+    if isinstance(value, (set, frozenset)):
+        return ('set', sorted(value))
+    if isinstance(value, (tuple, list)):
+        return tuple(Canonical(x) for x in value)
+    return value
+
+# A hash of the code that expands forms into encodings.  Changing any of
+# it changes the encodings of every instruction.
+def HelperDigest():
+    digest = hashlib.sha1()
+    for helper in [Byte, ByteClass, Imm8, Imm16, Imm32, Imm64, Bits,
+                   REX_low, REX, Triplet, SIB, ModRM, Encoding, Instruction,
+                   IterEncodings, byteclass]:
+        digest.update(inspect.getsource(helper))
+    return digest.hexdigest()
+
+# Yields (byte_tuple, accept_type) for every encoding of |instructions|
+# (default: all of them).  The bytes are hex strings without the '0x'
+# prefix, and the accept type is '' for ordinary instructions.
+def IterEncodings(instructions = None):
+    if instructions is None:
+        instructions = Instructions
+    for inst in instructions:
+        for ecd in inst.encodings():
+            yield ecd
+
+# Writes the textual "bytes:accept_type" listing, one encoding per line.
+# This is only needed for debugging, trie.py consumes IterEncodings()
+# directly.
+def Dump(stream, instructions = None):
+    for bytes, attr in IterEncodings(instructions):
+        stream.write(' '.join(bytes) + ':' + attr + '\n')
 
 SBX = '0x67'
 OSIZE = '0x66'
@@ -2774,3 +2839,6 @@ if True:
                 MCFIRET.addform(None, None, '%s %s %s %s %s %s %s %s %s %s %s' %
                                 (movl, MOVBID, MOVTID, cmpq, JNECHECK, JMPR, TESTB,
                                  JEHLT, cmpl, JNETRY, HLT))
+
+if __name__ == '__main__':
+    Dump(sys.stdout)
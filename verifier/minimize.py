@@ -0,0 +1,101 @@
+# Minimizes the trie DFA produced by trie.py before it is converted to C.
+#
+# Hash-consing in trie.MakeInterned only shares structurally identical
+# subtries.  This pass computes the coarsest partition of the states that
+# respects accept types and transitions (Hopcroft's algorithm), so that
+# trie_to_c.py emits one row per equivalence class.
+
+import sys
+
+import byteclass
+import trie
+
+
+def Minimize(root):
+  nodes = trie.GetAllNodes(root)
+  # Missing transitions lead to the rejecting state, which is modelled
+  # explicitly so that all states have a full transition function.
+  if trie.EmptyNode not in nodes:
+    nodes.append(trie.EmptyNode)
+  node_to_id = dict((node, index) for index, node in enumerate(nodes))
+  dead = node_to_id[trie.EmptyNode]
+
+  # Transitions are computed per byte class atom rather than per byte.
+  atoms = byteclass.Atoms(key for node in nodes for key in node.children)
+  atom_keys = [byteclass.Format(atom) for atom in atoms]
+  delta = []
+  for node in nodes:
+    row = [dead] * len(atoms)
+    for key, child in node.children.iteritems():
+      values = byteclass.Parse(key)
+      for index, atom in enumerate(atoms):
+        if atom <= values:
+          row[index] = node_to_id[child]
+    delta.append(row)
+  inverse = [{} for _ in atoms]
+  for state, row in enumerate(delta):
+    for index, target in enumerate(row):
+      inverse[index].setdefault(target, []).append(state)
+
+  # The initial partition groups the states by accept type.
+  by_accept = {}
+  for state, node in enumerate(nodes):
+    by_accept.setdefault(node.accept, set()).add(state)
+  blocks = by_accept.values()
+  block_of = [None] * len(nodes)
+  for index, block in enumerate(blocks):
+    for state in block:
+      block_of[state] = index
+
+  worklist = set(xrange(len(blocks)))
+  while worklist:
+    splitter = list(blocks[worklist.pop()])
+    for index in xrange(len(atoms)):
+      touched = {}
+      for target in splitter:
+        for state in inverse[index].get(target, ()):
+          touched.setdefault(block_of[state], set()).add(state)
+      for block_index, states in touched.iteritems():
+        block = blocks[block_index]
+        if len(states) == len(block):
+          continue
+        block -= states
+        blocks.append(states)
+        new_index = len(blocks) - 1
+        for state in states:
+          block_of[state] = new_index
+        if block_index in worklist or len(states) <= len(block):
+          worklist.add(new_index)
+        else:
+          worklist.add(block_index)
+
+  dead_block = block_of[dead]
+  built = {}
+  def MakeNode(block_index):
+    node = built.get(block_index)
+    if node is None:
+      state = iter(blocks[block_index]).next()
+      children = {}
+      for index, target in enumerate(delta[state]):
+        if block_of[target] != dead_block:
+          children[atom_keys[index]] = MakeNode(block_of[target])
+      node = trie.MakeInterned(children, nodes[state].accept)
+      built[block_index] = node
+    return node
+
+  return MakeNode(block_of[node_to_id[root]])
+
+
+def Main(args):
+  assert len(args) == 1
+  filename = args[0]
+  root = trie.TrieFromFile(filename)
+  before = len(trie.GetAllNodes(root))
+  root = Minimize(root)
+  after = len(trie.GetAllNodes(root))
+  print 'states before=%i after=%i' % (before, after)
+  trie.WriteToFile(filename, root)
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
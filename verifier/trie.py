@@ -4,19 +4,30 @@
 # This file was modified from Mark Seaborn's verifier for nacl:
 # https://github.com/mseaborn/x86-decoder
 
+import hashlib
+import inspect
+import itertools
 import json
+import multiprocessing
+import optparse
+import os
 import sys
 import time
 import weakref
 
+import byteclass
 import memoize
+import triefile
 
 
 class Trie(object):
+  __slots__ = ('accept', 'children', 'id', '__weakref__')
 
   def __init__(self):
     self.accept = False
     self.children = {}
+    # A unique number, set when the node is interned.
+    self.id = None
 
 
 def Add(root, bytes, instr):
@@ -36,14 +47,39 @@ def Add(root, bytes, instr):
     node.accept = instr
 
 interned = weakref.WeakValueDictionary()
+next_id = itertools.count()
+
+# Relabels |children| so that each distinct child hangs off exactly one
+# byte class.  The classes of an interned node are disjoint, so this is a
+# canonical form and equal subtries still hash-cons to the same node.
+def CanonicalChildren(children):
+  by_child = {}
+  for key, child in children.iteritems():
+    by_child.setdefault(child, []).append(key)
+  if len(by_child) == len(children):
+    return children
+  return dict((byteclass.Union(keys), child)
+              for child, keys in by_child.iteritems())
+
+
+# Returns the interning key of a node: its accept type and its children
+# packed into one string of "class=id" entries.  The children must be
+# interned already.  A string is much smaller than a tuple of
+# (class, node) pairs, and its hash is computed once and then cached.
+def InternKey(children, accept):
+  return '%s|%s' % (accept, ' '.join('%s=%x' % (key, children[key].id)
+                                     for key in sorted(children)))
+
 
 def MakeInterned(children, accept):
-  key = (accept, tuple(sorted(children.iteritems())))
+  children = CanonicalChildren(children)
+  key = InternKey(children, accept)
   node = interned.get(key)
   if node is None:
     node = Trie()
     node.children = children
     node.accept = accept
+    node.id = next(next_id)
     interned[key] = node
   return node
 
@@ -52,22 +88,48 @@ EmptyNode = MakeInterned({}, False)
 AcceptNode = MakeInterned({}, True)
 
 
+# Splits the byte classes of |nodes|, which may overlap, into disjoint
+# classes.  Returns a dict mapping each class to a list of
+# (node index, child) pairs for the children reached on it.
+def SplitChildren(nodes):
+  edges = [(index, key, child)
+           for index, node in enumerate(nodes)
+           for key, child in node.children.iteritems()]
+  by_key = {}
+  if all(byteclass.IsSingle(key) for _, key, _ in edges):
+    for index, key, child in edges:
+      by_key.setdefault(key, []).append((index, child))
+    return by_key
+  targets = [[] for _ in xrange(256)]
+  for index, key, child in edges:
+    for value in byteclass.Parse(key):
+      targets[value].append((index, child))
+  by_targets = {}
+  for value, subnodes in enumerate(targets):
+    if subnodes:
+      by_targets.setdefault(tuple(subnodes), []).append(value)
+  for subnodes, values in by_targets.iteritems():
+    by_key[byteclass.Format(values)] = list(subnodes)
+  return by_key
+
+
 # Assumes that node1 is an already-interned node.
-# node2 does not have to be an interned node.
+# node2 does not have to be an interned node, and its byte classes may
+# overlap.
 def Merge(node1, node2):
   # if node1 == EmptyNode:
   #   return node2
   if node2 == EmptyNode:
     return node1
   children = {}
-  keys = set(node1.children.iterkeys())
-  keys.update(node2.children.iterkeys())
-  if 'XX' in keys and len(keys) != 1:
-    keys = set(['XX'])
-  for key in keys:
-    c1 = node1.children.get(key, EmptyNode)
-    c2 = node2.children.get(key, EmptyNode)
-    children[key] = Merge(c1, c2)
+  for key, subnodes in SplitChildren([node1, node2]).iteritems():
+    merged = EmptyNode
+    for index, child in subnodes:
+      if index == 0:
+        merged = child
+      else:
+        merged = Merge(merged, child)
+    children[key] = merged
   return MakeInterned(children, node1.accept or node2.accept)
 
 
@@ -78,16 +140,11 @@ def MergeMany(nodes, merge_accept_types):
   if len(nodes) == 0:
     return EmptyNode
   children = {}
-  accept_types = set()
+  accept_types = set(node.accept for node in nodes)
 
-  by_key = {}
-  for node in nodes:
-    accept_types.add(node.accept)
-    for key, value in node.children.iteritems():
-      by_key.setdefault(key, []).append(value)
-
-  for key, subnodes in by_key.iteritems():
-    children[key] = MergeMany(subnodes, merge_accept_types)
+  for key, subnodes in SplitChildren(nodes).iteritems():
+    children[key] = MergeMany([child for _, child in subnodes],
+                              merge_accept_types)
 
   if len(accept_types) == 1:
     accept = list(accept_types)[0]
@@ -100,8 +157,6 @@ def Pr(node, stream, indent=0):
   ind = '  ' * indent
   if node.accept:
     stream.write(ind + 'accept\n')
-  if 'XX' in node.children and len(node.children) > 1:
-    stream.write(ind + 'both\n')
   for key, val in sorted(node.children.iteritems()):
     stream.write(ind + key + '\n')
     Pr(val, stream, indent + 1)
@@ -109,8 +164,6 @@ def Pr(node, stream, indent=0):
 def Pr(node, stream, prev=''):
   if node.accept:
     stream.write(prev + ' ' + str(node.accept) + '\n')
-  if 'XX' in node.children and len(node.children) > 1:
-    stream.write(prev + ' both\n')
   for key, val in sorted(node.children.iteritems()):
     stream.write(prev + ' ' + key + '\n')
     Pr(val, stream, prev + ' ' + key)
@@ -129,10 +182,13 @@ def GetAllNodes(root):
   return node_list
 
 
-def Main(args):
-  assert len(args) == 1
-  filename = args[0]
+def ReadEncodings(filename):
+  for line in open(filename, 'r'):
+    bytes, instr = line.strip().split(':', 1)
+    yield bytes.split(' '), instr
+
 
+def BuildTrie(encodings, verbose=True):
   # For performance, we construct the trie in batches.
   #
   # Add() updates a mutable trie without introducing any node sharing.
@@ -148,24 +204,139 @@ def Main(args):
   # mutable trie, and periodically merge this trie back into the main,
   # purely-functional interned trie.
 
-  print 'populating trie...'
+  if verbose:
+    print 'populating trie...'
   root = EmptyNode
   batch = Trie()
   t1 = time.time()
-  for i, line in enumerate(open(filename, 'r')):
+  for i, (bytes, instr) in enumerate(encodings):
     if i % 5000 == 0:
       root = Merge(root, batch)
       batch = Trie()
-      print 'nodes=%i states=%i rate=%.1f node/s' % (
+      if verbose:
+        print 'nodes=%i states=%i rate=%.1f node/s' % (
           i, len(interned), i / (time.time() - t1))
-    bytes, instr = line.strip().split(':', 1)
-    bytes = bytes.split(' ')
     Add(batch, bytes, instr)
   root = Merge(root, batch)
   #Pr(root, sys.stderr)
+  return root
+
+
+# Merges the accept types of equivalent paths from different sub-tries.
+# A byte sequence that is accepted as two different kinds of instruction
+# would make the verifier's behaviour depend on the merge order.
+def MergeAcceptTypes(accept_types):
+  accept_types = set(accept_types) - set([False])
+  assert len(accept_types) <= 1, \
+      'conflicting accept types %r' % sorted(accept_types)
+  if accept_types:
+    return accept_types.pop()
+  return False
+
+
+# Builds the sub-trie of instruction |index| in a worker process.  The
+# result is returned in the packed file format, because interned nodes
+# only make sense within one process.
+def BuildShard(index):
+  import instr
+  encodings = instr.IterEncodings([instr.Instructions[index]])
+  return index, PackTrie(BuildTrie(encodings, False))
+
+
+# Yields (index, packed sub-trie) for the given instructions, in no
+# particular order, building them on |jobs| processes.
+def BuildShards(indexes, jobs):
+  if jobs <= 1:
+    for index in indexes:
+      yield BuildShard(index)
+    return
+  pool = multiprocessing.Pool(jobs)
+  try:
+    for result in pool.imap_unordered(BuildShard, indexes):
+      yield result
+  finally:
+    pool.terminate()
+
+
+# Builds the trie of all instructions in instr.py on |jobs| processes.
+# Every instruction becomes its own sub-trie, and the sub-tries are
+# combined with MergeMany.
+def BuildTrieParallel(jobs):
+  import instr
+  print 'populating trie with %i jobs...' % jobs
+  roots = [TrieFromTable(triefile.TrieTable(data))
+           for _, data in BuildShards(xrange(len(instr.Instructions)), jobs)]
+  print 'merging %i sub-tries...' % len(roots)
+  return MergeMany(roots, MergeAcceptTypes)
+
+
+# A hash of the code that turns encodings into a packed sub-trie.  The
+# whole source of every module involved is hashed, so that no helper can
+# be left out by mistake; editing them is rare compared to instr.py.
+def BuilderDigest():
+  digest = hashlib.sha1()
+  for module in [sys.modules[__name__], byteclass, memoize, triefile]:
+    digest.update(inspect.getsource(module))
+  return digest.hexdigest()
+
+
+# Like BuildTrieParallel, but keeps the sub-trie of every instruction in
+# |cache_dir|, keyed by a hash of its forms and of the code that expands
+# them.  Only the instructions that changed since the last build are
+# enumerated again.  Stale entries are never removed, so the cache can be
+# shared between branches; it is safe to delete at any time.
+def BuildTrieCached(cache_dir, jobs):
+  import instr
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  builder = hashlib.sha1(instr.HelperDigest() + BuilderDigest())
+  paths = []
+  for inst in instr.Instructions:
+    key = builder.copy()
+    key.update(inst.digest())
+    paths.append(os.path.join(cache_dir, '%s.trie' % key.hexdigest()))
+  missing = [index for index, path in enumerate(paths)
+             if not os.path.exists(path)]
+  print '%i of %i sub-tries cached, building %i with %i jobs...' % (
+      len(paths) - len(missing), len(paths), len(missing), jobs)
+  for index, data in BuildShards(missing, jobs):
+    # Write and rename, so an interrupted build leaves no partial entry.
+    temp = '%s.%d.tmp' % (paths[index], os.getpid())
+    with open(temp, 'wb') as fh:
+      fh.write(data)
+    os.rename(temp, paths[index])
+  roots = [TrieFromTable(triefile.Open(path)) for path in paths]
+  print 'merging %i sub-tries...' % len(roots)
+  return MergeMany(roots, MergeAcceptTypes)
+
+
+def Main(args):
+  parser = optparse.OptionParser(usage='%prog [options] [inst]')
+  parser.add_option('-j', '--jobs', type='int', default=1,
+                    help='Number of processes used to build the trie')
+  parser.add_option('--cache', metavar='DIR',
+                    help='Reuse the sub-tries of unchanged instructions '
+                         'from DIR')
+  (options, args) = parser.parse_args(args)
+  # By default the encodings are enumerated in-process from instr.py.
+  # A "bytes:type" listing as written by "./instr.py > inst" can still
+  # be passed instead, which is mostly useful for debugging.
+  if len(args) == 0:
+    filename = 'inst'
+    if options.cache:
+      root = BuildTrieCached(options.cache, options.jobs)
+    elif options.jobs > 1:
+      root = BuildTrieParallel(options.jobs)
+    else:
+      import instr
+      root = BuildTrie(instr.IterEncodings())
+  else:
+    assert len(args) == 1
+    filename = args[0]
+    root = BuildTrie(ReadEncodings(filename))
   output_filename = '%s.trie' % filename
   WriteToFile(output_filename, root)
-  
+
 
 def TrieToDict(root):
   node_list = GetAllNodes(root)
@@ -191,28 +362,76 @@ def TrieFromDict(trie_data):
   return MakeNode(trie_data['start'])
 
 
+# Returns the nodes below |root| (excluding EmptyNode) in post-order, so
+# that every child comes before its parents.
+def GetAllNodesPostOrder(root):
+  node_list = []
+  node_set = set([EmptyNode])
+  stack = [(root, False)]
+  while stack:
+    node, expanded = stack.pop()
+    if expanded:
+      node_list.append(node)
+    elif node not in node_set:
+      node_set.add(node)
+      stack.append((node, True))
+      for key, child in sorted(node.children.iteritems(), reverse=True):
+        stack.append((child, False))
+  return node_list
+
+
+def PackTrie(root):
+  # State 0 is the rejecting state, see triefile.py.
+  nodes = [EmptyNode] + GetAllNodesPostOrder(root)
+  node_to_id = dict((node, index) for index, node in enumerate(nodes))
+  rows = []
+  for node in nodes:
+    row = [0] * 256
+    for key, child in node.children.iteritems():
+      for byte in byteclass.Parse(key):
+        row[byte] = node_to_id[child]
+    rows.append(row)
+  return triefile.Pack(node_to_id[root], [node.accept for node in nodes], rows)
+
+
 def WriteToFile(output_filename, root):
-  fh = open(output_filename, 'w')
-  json.dump(TrieToDict(root), fh, sort_keys=True)
-  fh.close()
+  with open(output_filename, 'wb') as fh:
+    fh.write(PackTrie(root))
+
 
+def TrieFromTable(table):
+  nodes = [EmptyNode]
+  for state in xrange(1, table.states):
+    by_target = {}
+    for low, last, target in table.Runs(state):
+      if target != 0:
+        assert target < state, 'trie file is not in post-order'
+        by_target.setdefault(target, []).extend(xrange(low, last + 1))
+    children = dict((byteclass.Format(values), nodes[target])
+                    for target, values in by_target.iteritems())
+    nodes.append(MakeInterned(children, table.Accept(state)))
+  return nodes[table.start]
 
+
+# Reads a binary trie file, or a JSON one as written by older versions.
 def TrieFromFile(filename):
+  if triefile.IsTrieFile(filename):
+    return TrieFromTable(triefile.Open(filename))
   fh = open(filename, 'r')
   trie_data = json.load(fh)
   fh.close()
   return TrieFromDict(trie_data)
 
 
-def Dump():
-  for i, node in enumerate(node_list):
-    node.id = i
+def Dump(root):
+  node_list = GetAllNodes(root)
+  node_to_id = dict((node, index) for index, node in enumerate(node_list))
   for i, node in enumerate(node_list):
     print 'node %i:' % i
     if node.accept:
       print 'ACCEPT'
     for key, val in sorted(node.children.iteritems()):
-      print '%s -> %s' % (key, val.id)
+      print '%s -> %s' % (key, node_to_id[val])
 
 
 if __name__ == '__main__':
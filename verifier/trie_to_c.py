@@ -4,7 +4,10 @@
 # This file was modified from Mark Seaborn's verifier for nacl:
 # https://github.com/mseaborn/x86-decoder
 
+import optparse
 import sys
+
+import byteclass
 import trie
 
 # Converts the trie/DFA to a C file.
@@ -20,19 +23,23 @@ def SortKey(node):
     return [1]
 
 
+ENCODINGS = ['dense', 'classes', 'comb']
+
+
+def DenseRow(node, node_to_id):
+  bytes = [0] * 256
+  for key, dest_node in node.children.iteritems():
+    for byte in byteclass.Parse(key):
+      bytes[byte] = node_to_id[dest_node]
+  return bytes
+
+
 def WriteTransitionTable(out, nodes, node_to_id):
   out.write('static const uint16_t trie_table[][256] = {\n')
   for node in nodes:
     out.write('  /* state %i: accept=%s */ {\n' %
               (node_to_id[node], node.accept))
-    if 'XX' in node.children:
-      assert len(node.children) == 1, node#, node.children
-      bytes = [node_to_id[node.children['XX']]] * 256
-    else:
-      bytes = [0] * 256
-      for byte, dest_node in node.children.iteritems():
-        #print byte
-        bytes[int(byte, 16)] = node_to_id[dest_node]
+    bytes = DenseRow(node, node_to_id)
     out.write(' ' * 11 + '/* ')
     out.write('  '.join('X%x' % lower for lower in xrange(16)))
     out.write(' */\n')
@@ -43,24 +50,315 @@ def WriteTransitionTable(out, nodes, node_to_id):
       out.write(',\n')
     out.write('  },\n')
   out.write('};\n')
-  #out.write("""
-#static inline uint16_t trie_lookup(uint16_t state, uint16_t byte) {
-#  return trie_table[state][byte];
-#}
-#""")
+  out.write("""
+static inline uint16_t trie_lookup(uint16_t state, uint16_t byte) {
+  return trie_table[state][byte];
+}
+
+""")
+
+
+# Splits the byte values into equivalence classes: two bytes are in the
+# same class if every state has the same transition on both.  Returns the
+# class of every byte, with classes numbered in order of their smallest
+# byte.
+def ComputeByteClasses(rows):
+  class_of_column = {}
+  byte_class = []
+  for byte in xrange(256):
+    column = tuple(row[byte] for row in rows)
+    byte_class.append(class_of_column.setdefault(column,
+                                                 len(class_of_column)))
+  return byte_class
+
+
+# Writes the table in the equivalence-class compressed form, where the
+# rows only have one entry per byte class.
+def WriteClassTransitionTable(out, nodes, node_to_id, byte_class):
+  num_classes = max(byte_class) + 1
+  representative = [byte_class.index(cls) for cls in xrange(num_classes)]
+  out.write('static const uint8_t trie_byte_class[256] = {\n')
+  out.write(' ' * 11 + '/* ')
+  out.write('  '.join('X%x' % lower for lower in xrange(16)))
+  out.write(' */\n')
+  for upper in xrange(16):
+    out.write('    /* %xX */  ' % upper)
+    out.write(', '.join('%2i' % byte_class[upper*16 + lower]
+                        for lower in xrange(16)))
+    out.write(',\n')
+  out.write('};\n\n')
+  out.write('static const uint16_t trie_table[][%d] = {\n' % num_classes)
+  for node in nodes:
+    out.write('  /* state %i: accept=%s */ {\n' %
+              (node_to_id[node], node.accept))
+    bytes = DenseRow(node, node_to_id)
+    for first in xrange(0, num_classes, 16):
+      classes = xrange(first, min(first + 16, num_classes))
+      out.write('    ')
+      out.write(', '.join('%2i' % bytes[representative[cls]]
+                          for cls in classes))
+      out.write(',\n')
+    out.write('  },\n')
+  out.write('};\n')
+  out.write("""
+static inline uint16_t trie_lookup(uint16_t state, uint16_t byte) {
+  return trie_table[state][trie_byte_class[byte]];
+}
+
+""")
+
+
+# Packs the rows into a comb ("base plus check") layout.  Identical rows
+# are stored once, and every row only stores the bytes on which it differs
+# from a shared default row.  The exceptions of all rows are interleaved
+# into one next/check array pair by first fit: the exceptions of row r
+# live at next[base[r] + byte], and check[] holds the row that owns each
+# slot.  Returns (default, row_of_state, base, next, check).
+def PackComb(rows):
+  default = []
+  for byte in xrange(256):
+    counts = {}
+    for row in rows:
+      counts[row[byte]] = counts.get(row[byte], 0) + 1
+    default.append(max(sorted(counts), key=counts.get))
+
+  unique_rows = {}
+  row_of_state = []
+  for row in rows:
+    row_of_state.append(unique_rows.setdefault(tuple(row), len(unique_rows)))
+  exceptions = [None] * len(unique_rows)
+  for row, index in unique_rows.iteritems():
+    exceptions[index] = [byte for byte in xrange(256)
+                         if row[byte] != default[byte]]
+
+  # No row is numbered len(unique_rows), so free slots never match.
+  free = len(unique_rows)
+  next = []
+  check = []
+  occupied = set()
+  lowest_free = 0
+  base = [0] * len(unique_rows)
+  # Placing the densest rows first keeps the comb tight.
+  for index in sorted(xrange(len(unique_rows)),
+                      key=lambda index: (-len(exceptions[index]), index)):
+    if not exceptions[index]:
+      continue
+    # Slots below |lowest_free| are taken, so the first exception cannot
+    # go there.
+    offset = max(0, lowest_free - exceptions[index][0])
+    while any(offset + byte in occupied for byte in exceptions[index]):
+      offset += 1
+    # Keep every base[r] + byte in bounds, so lookups need no range check.
+    while len(check) < offset + 256:
+      next.append(0)
+      check.append(free)
+    base[index] = offset
+    row = rows[row_of_state.index(index)]
+    for byte in exceptions[index]:
+      next[offset + byte] = row[byte]
+      check[offset + byte] = index
+      occupied.add(offset + byte)
+    while lowest_free in occupied:
+      lowest_free += 1
+  return default, row_of_state, base, next, check
+
+
+# Writes a trie_accepts_<type>() predicate for every accept type.  The
+# nodes are sorted by SortKey, so the acceptors of a type are a range of
+# node IDs.
+def WriteAcceptFunctions(out, nodes, node_to_id, accept_types):
+  for accept_type in sorted(accept_types):
+    acceptors = [node_to_id[node] for node in nodes
+                 if node.accept == accept_type]
+    first = min(acceptors)
+    last = max(acceptors)
+    assert last - first + 1 == len(acceptors)
+    if first == last:
+      expr = 'node_id == %i' % first
+    else:
+      expr = 'node_id >= %i && node_id <= %i' % (first, last)
+    out.write('static inline int trie_accepts_%s(int node_id) '
+              '{\n  return %s;\n}\n\n'
+              % (accept_type, expr))
+
+
+def WriteArray(out, ctype, name, values):
+  out.write('static const %s %s[%d] = {\n' % (ctype, name, len(values)))
+  for first in xrange(0, len(values), 16):
+    out.write('  ')
+    out.write(', '.join('%2i' % value for value in values[first:first + 16]))
+    out.write(',\n')
+  out.write('};\n\n')
+
+
+def CType(values):
+  if max(values) < 1 << 16:
+    return 'uint16_t'
+  return 'uint32_t'
+
+
+def WriteCombTransitionTable(out, nodes, comb):
+  default, row_of_state, base, next, check = comb
+  WriteArray(out, 'uint16_t', 'trie_default', default)
+  WriteArray(out, CType(row_of_state), 'trie_row', row_of_state)
+  WriteArray(out, CType(base), 'trie_base', base)
+  WriteArray(out, 'uint16_t', 'trie_next', next)
+  WriteArray(out, CType(check), 'trie_check', check)
+  out.write("""static inline uint16_t trie_lookup(uint16_t state, uint16_t byte) {
+  uint32_t row = trie_row[state];
+  uint32_t index = trie_base[row] + byte;
+  return trie_check[index] == row ? trie_next[index] : trie_default[byte];
+}
 
+""")
+
+
+def CombSize(comb):
+  default, row_of_state, base, next, check = comb
+  size = lambda values: len(values) * (CType(values) == 'uint16_t' and 2 or 4)
+  return (2 * len(default) + size(row_of_state) + size(base) +
+          2 * len(next) + size(check))
+
+
+# Prints the size of every encoding and a rough per-byte lookup cost: the
+# number of dependent loads, and the smallest cache level the whole table
+# fits in.
+def PrintEncodingCosts(costs):
+  def Fits(size):
+    for name, limit in [('L1', 32 << 10), ('L2', 256 << 10),
+                        ('L3', 8 << 20)]:
+      if size <= limit:
+        return name
+    return 'memory'
+  print '%-8s %10s %6s  %s' % ('encoding', 'bytes', 'loads', 'fits')
+  for name, size, loads in costs:
+    print '%-8s %10i %6i  %s' % (name, size, loads, Fits(size))
+
+
+# Counts in visits[(node, byte)] the lookups made while validating |data|
+# the way validate() in dfa_ncval.c does.
+def ProfileCorpus(nodes, root_node, data, visits):
+  import bench
+  node_to_id = dict((node, index) for index, node in enumerate(nodes))
+  rows = [DenseRow(node, node_to_id) for node in nodes]
+  accepts = [node.accept for node in nodes]
+  counts = {}
+  pos = 0
+  while pos < len(data):
+    end, _ = bench.Match(rows, accepts, node_to_id[root_node], data, pos,
+                         counts)
+    if end is None:
+      sys.exit('the corpus does not validate at offset %i' % pos)
+    pos = end
+  for (state, byte), count in counts.iteritems():
+    key = (nodes[state], byte)
+    visits[key] = visits.get(key, 0) + count
 
-def Main(trie_file):
-  root_node = trie.TrieFromFile(trie_file)
+
+# Adds the "state count" lines written by a DFA_NCVAL_STATS build of
+# dfa_ncval.c to |visits|, as visits[(node, None)] since the bytes are
+# unknown.  The histogram must come from a table numbered without a
+# profile, as |nodes| is.
+def ReadHistogram(nodes, filename, visits):
+  for line in open(filename):
+    state, count = [int(field) for field in line.split()]
+    if state >= len(nodes):
+      sys.exit('%s: state %i does not exist, was the histogram recorded '
+               'with another trie?' % (filename, state))
+    key = (nodes[state], None)
+    visits[key] = visits.get(key, 0) + count
+
+
+# Numbers the most visited states first within every SortKey group, so
+# that the hot rows share cache lines and pages while the states of an
+# accept type stay a contiguous range.
+def ProfileOrder(nodes, visits):
+  heat = {}
+  for (node, _), count in visits.iteritems():
+    heat[node] = heat.get(node, 0) + count
+  return [nodes[0]] + sorted(nodes[1:],
+                             key=lambda node: (SortKey(node),
+                                               -heat.get(node, 0)))
+
+
+# Returns the number of pages and cache lines of the transition table
+# touched by the most frequent lookups that together make up |coverage|
+# of all lookups.  |column| maps a byte to its offset within a row of
+# |row_bytes|; a lookup of an unknown byte touches the whole row.
+def Footprint(visits, node_to_id, row_bytes, column, coverage=0.99):
+  total = sum(visits.itervalues())
+  seen = 0
+  lines = set()
+  for (node, byte), count in sorted(visits.iteritems(),
+                                    key=lambda item: (-item[1],
+                                                      item[0][0].id,
+                                                      item[0][1])):
+    if seen >= coverage * total:
+      break
+    seen += count
+    start = node_to_id[node] * row_bytes
+    if byte is None:
+      lines.update(xrange(start // 64, (start + row_bytes - 1) // 64 + 1))
+    else:
+      lines.add((start + column(byte)) // 64)
+  pages = set(line * 64 // 4096 for line in lines)
+  return len(pages), len(lines)
+
+
+def PrintFootprint(encoding, visits, default_nodes, nodes, byte_class):
+  if encoding == 'dense':
+    row_bytes = 256 * 2
+    column = lambda byte: byte * 2
+  elif encoding == 'classes':
+    row_bytes = (max(byte_class) + 1) * 2
+    column = lambda byte: byte_class[byte] * 2
+  else:
+    print 'No footprint estimate for the %s encoding' % encoding
+    return
+  print 'Footprint of 99%% of %i lookups:' % sum(visits.itervalues())
+  for name, order in [('unprofiled', default_nodes), ('profiled', nodes)]:
+    node_to_id = dict((node, index) for index, node in enumerate(order))
+    pages, lines = Footprint(visits, node_to_id, row_bytes, column)
+    print '  %-10s %4i pages, %5i cache lines' % (name, pages, lines)
+
+
+def Main(args):
+  parser = optparse.OptionParser(usage='%prog [options] inst.trie')
+  parser.add_option('--encoding', choices=ENCODINGS, default='dense',
+                    help='Transition table encoding (%s)' %
+                         ', '.join(ENCODINGS))
+  parser.add_option('-o', '--output', default='trie_table.h',
+                    help='Name of the generated header')
+  parser.add_option('--profile-corpus', action='append', default=[],
+                    metavar='FILE',
+                    help='Number the states visited most often while '
+                         'validating the raw code in FILE together')
+  parser.add_option('--profile-histogram', action='append', default=[],
+                    metavar='FILE',
+                    help='Like --profile-corpus, but read the visits of '
+                         'every state from FILE (see bench.py --histogram)')
+  (options, args) = parser.parse_args(args)
+  if len(args) != 1:
+    parser.error('expected a single trie file')
+  root_node = trie.TrieFromFile(args[0])
   nodes = sorted(trie.GetAllNodes(root_node), key=SortKey)
   #for node in nodes:
   #  trie.Pr(node, sys.stderr)  
   # Node ID 0 is reserved as the rejecting state.  For a little extra
   # safety, all transitions from node 0 lead to node 0.
   nodes = [trie.EmptyNode] + nodes
+  default_nodes = nodes
+  visits = {}
+  for filename in options.profile_corpus:
+    with open(filename, 'rb') as fh:
+      ProfileCorpus(nodes, root_node, bytearray(fh.read()), visits)
+  for filename in options.profile_histogram:
+    ReadHistogram(nodes, filename, visits)
+  if visits:
+    nodes = ProfileOrder(nodes, visits)
   node_to_id = dict((node, index) for index, node in enumerate(nodes))
 
-  out = open('trie_table.h', 'w')
+  out = open(options.output, 'w')
   out.write('\n#include <stdint.h>\n\n')
 
   accept_types = set(node.accept for node in nodes
@@ -81,7 +379,25 @@ def Main(trie_file):
   assert 'mcfiret' in accept_types
   assert 'terminator' in accept_types
 
-  WriteTransitionTable(out, nodes, node_to_id)
+  rows = [DenseRow(node, node_to_id) for node in nodes]
+  byte_class = ComputeByteClasses(rows)
+  num_classes = max(byte_class) + 1
+  comb = PackComb(rows)
+  print '%i byte classes, %i distinct rows' % (num_classes, len(comb[2]))
+  PrintEncodingCosts([
+      ('dense', len(nodes) * 256 * 2, 1),
+      ('classes', 256 + len(nodes) * num_classes * 2, 2),
+      # row, base, check and then next or default.
+      ('comb', CombSize(comb), 4)])
+  if visits:
+    PrintFootprint(options.encoding, visits, default_nodes, nodes,
+                   byte_class)
+  if options.encoding == 'classes':
+    WriteClassTransitionTable(out, nodes, node_to_id, byte_class)
+  elif options.encoding == 'comb':
+    WriteCombTransitionTable(out, nodes, comb)
+  else:
+    WriteTransitionTable(out, nodes, node_to_id)
   states = len(nodes)
   verifier_template = """static const struct verifier_t {
   uint16_t *dfa;
@@ -164,22 +480,17 @@ def Main(trie_file):
                                   jcc_rel1, jcc_rel4, mcficall, mcficheck, mcfiret,\
                                   terminator, max_accept)
   print verifier
-  out.write(verifier)
-  #for accept_type in sorted(accept_types):
-  #  acceptors = [node_to_id[node] for node in nodes
-  #               if node.accept == accept_type]
-  #  print 'Type %r has %i acceptors' % (accept_type, len(acceptors))
-  #  if len(acceptors) > 0:
-  #    expr = ' || '.join('node_id == %i' % node_id for node_id in acceptors)
-  #  else:
-  #    expr = '0 /* These instructions are currently disallowed */'
-  #  out.write('static inline int trie_accepts_%s(int node_id) '
-  #            '{\n  return %s;\n}\n\n'
-  #            % (accept_type, expr))
-  #out.write('static const uint16_t trie_start = %i;\n\n' % node_to_id[root_node])
+  if options.encoding == 'dense':
+    out.write(verifier)
+    out.write('\n\n')
+  else:
+    # The runtime walks verifier.dfa as [state][256] rows.
+    out.write('/* The verifier struct needs --encoding=dense. */\n\n')
+  WriteAcceptFunctions(out, nodes, node_to_id, accept_types)
+  out.write('static const uint16_t trie_start = %i;\n\n' % start)
 
   out.close()
 
 
 if __name__ == '__main__':
-  Main(sys.argv[1])
+  Main(sys.argv[1:])
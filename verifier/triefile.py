@@ -0,0 +1,150 @@
+# Binary serialization of the verifier trie/DFA.
+#
+# The file is a little-endian, versioned format that can be used straight
+# from an mmap without building Python Trie objects:
+#
+#   header      magic, version, #states, start state, #accept names, #runs
+#   names       the accept type names, each as a uint16 length + bytes
+#   accepts     uint16 accept index per state (0 = False, 1 = True,
+#               2 + i = names[i])
+#   row_offsets uint32[#states + 1], the runs of state s are
+#               [row_offsets[s], row_offsets[s + 1])
+#   run_last    uint8 per run, the last byte value covered by the run
+#   run_target  uint32 per run, the target state of the run
+#
+# Each row is stored as the runs of equal targets covering bytes 0..255,
+# so the mostly-rejecting rows of the trie stay small.  State 0 is the
+# rejecting state.  All other states are numbered so that every
+# transition goes to a lower-numbered state, which lets a reader rebuild
+# the trie bottom-up without recursion.
+
+import bisect
+import mmap
+import struct
+
+MAGIC = 'MCFITRIE'
+VERSION = 1
+
+HEADER = struct.Struct('<8sIIIII')
+
+
+def _Align(offset):
+  return (offset + 3) & ~3
+
+
+def _Pad(chunks, length):
+  padding = _Align(length) - length
+  if padding:
+    chunks.append('\0' * padding)
+  return length + padding
+
+
+def IsTrieFile(filename):
+  with open(filename, 'rb') as fh:
+    return fh.read(len(MAGIC)) == MAGIC
+
+
+# Serializes a DFA.  |accepts| holds the accept type (False, True or a
+# type name) and |rows| the 256 target states of every state.
+def Pack(start, accepts, rows):
+  assert len(accepts) == len(rows)
+  names = sorted(set(accept for accept in accepts
+                     if accept is not False and accept is not True))
+  name_index = dict((name, index + 2) for index, name in enumerate(names))
+  name_index[False] = 0
+  name_index[True] = 1
+
+  row_offsets = [0]
+  run_last = []
+  run_target = []
+  for row in rows:
+    assert len(row) == 256
+    for byte, target in enumerate(row):
+      if byte == 255 or row[byte + 1] != target:
+        run_last.append(byte)
+        run_target.append(target)
+    row_offsets.append(len(run_last))
+
+  chunks = [HEADER.pack(MAGIC, VERSION, len(rows), start, len(names),
+                        len(run_last))]
+  length = HEADER.size
+  for name in names:
+    name = name.encode('utf-8')
+    chunks.append(struct.pack('<H', len(name)) + name)
+    length += 2 + len(name)
+  length = _Pad(chunks, length)
+  chunks.append(struct.pack('<%dH' % len(accepts),
+                            *[name_index[accept] for accept in accepts]))
+  length = _Pad(chunks, length + 2 * len(accepts))
+  chunks.append(struct.pack('<%dI' % len(row_offsets), *row_offsets))
+  chunks.append(struct.pack('<%dB' % len(run_last), *run_last))
+  length = _Pad(chunks, length + 4 * len(row_offsets) + len(run_last))
+  chunks.append(struct.pack('<%dI' % len(run_target), *run_target))
+  return ''.join(chunks)
+
+
+# Read-only view of a packed DFA held in a string or an mmap.
+class TrieTable(object):
+
+  def __init__(self, data):
+    self.data = data
+    (magic, version, self.states, self.start, num_names,
+     self.runs) = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+      raise ValueError('not a trie file')
+    if version != VERSION:
+      raise ValueError('unsupported trie file version %d' % version)
+    offset = HEADER.size
+    self.names = [False, True]
+    for _ in xrange(num_names):
+      (length,) = struct.unpack_from('<H', data, offset)
+      offset += 2
+      self.names.append(data[offset:offset + length].decode('utf-8'))
+      offset += length
+    self.accepts_offset = _Align(offset)
+    self.row_offsets_offset = _Align(self.accepts_offset + 2 * self.states)
+    self.run_last_offset = self.row_offsets_offset + 4 * (self.states + 1)
+    self.run_target_offset = _Align(self.run_last_offset + self.runs)
+
+  def Accept(self, state):
+    (index,) = struct.unpack_from('<H', self.data,
+                                  self.accepts_offset + 2 * state)
+    return self.names[index]
+
+  def _RowRange(self, state):
+    return struct.unpack_from('<II', self.data,
+                              self.row_offsets_offset + 4 * state)
+
+  def _Target(self, run):
+    return struct.unpack_from('<I', self.data,
+                              self.run_target_offset + 4 * run)[0]
+
+  def Lookup(self, state, byte):
+    first, end = self._RowRange(state)
+    run = bisect.bisect_left(self.data, chr(byte),
+                             self.run_last_offset + first,
+                             self.run_last_offset + end)
+    return self._Target(run - self.run_last_offset)
+
+  # Returns the row of |state| as a list of (first byte, last byte,
+  # target) runs.
+  def Runs(self, state):
+    first, end = self._RowRange(state)
+    runs = []
+    low = 0
+    for run in xrange(first, end):
+      last = ord(self.data[self.run_last_offset + run])
+      runs.append((low, last, self._Target(run)))
+      low = last + 1
+    return runs
+
+  def Row(self, state):
+    row = []
+    for low, last, target in self.Runs(state):
+      row += [target] * (last - low + 1)
+    return row
+
+
+def Open(filename):
+  with open(filename, 'rb') as fh:
+    return TrieTable(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
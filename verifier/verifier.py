@@ -0,0 +1,386 @@
+# A Python implementation of the validator in dfa_ncval.c that runs
+# straight off the trie, so code can be checked against any trie revision
+# without compiling a C harness:
+#
+#   python verifier.py -t inst.trie -j 8 snapshot1.bin module.so ...
+#
+# The table is read from a .trie file or from a trie_table.h generated
+# with --encoding=dense.  Inputs are raw code blobs or ELF files, of
+# which the .text section is checked.  Like validate() in dfa_ncval.c,
+# every instruction is the longest match from the start state, and the
+# MCFI and jump accept types end a match right away.  The direct jumps
+# and calls within a blob must land on an instruction boundary, which is
+# the valid_targets/jump_dests check of CheckJumpTargets.
+#
+# With numpy, a large batch of blobs is scanned in lockstep, one byte of
+# every blob per step.  Otherwise every blob is scanned in a pure Python
+# loop.
+
+import multiprocessing
+import optparse
+import re
+import struct
+import sys
+
+import triefile
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# The accept types on which validate() in dfa_ncval.c ends an instruction
+# without looking for a longer match.
+SPECIAL_TYPES = frozenset(['mcficall', 'mcfiret', 'mcficheck', 'icall',
+                           'dcall', 'jmp_rel1', 'jmp_rel4', 'jcc_rel1',
+                           'jcc_rel4', 'ijmp', 'terminator'])
+
+# The size of the trailing displacement of the direct jumps and calls.
+JUMP_WIDTHS = {'jmp_rel1': 1, 'jcc_rel1': 1,
+               'jmp_rel4': 4, 'jcc_rel4': 4, 'dcall': 4}
+
+# Below this many blobs in a batch, the pure Python scanner is faster
+# than the numpy one.
+LOCKSTEP_MIN_BLOBS = 512
+
+# The kind of every state.
+NONE = 0
+INSTRUCTION = 1  # Accepts, but a longer match may follow.
+END = 2          # Accepts and ends the match.
+
+
+class Table(object):
+
+  def __init__(self, rows, accepts, start):
+    self.start = start
+    self.states = len(rows)
+    self.kinds = []
+    self.widths = []
+    for accept in accepts:
+      if accept in SPECIAL_TYPES:
+        self.kinds.append(END)
+      elif accept is True:
+        self.kinds.append(INSTRUCTION)
+      else:
+        self.kinds.append(NONE)
+      self.widths.append(JUMP_WIDTHS.get(accept, 0))
+    # Indexed by state * 256 + byte.
+    self.flat = [target for row in rows for target in row]
+    if numpy is not None:
+      self.flat_array = numpy.array(self.flat, dtype=numpy.int32)
+      self.kind_array = numpy.array(self.kinds, dtype=numpy.int8)
+      self.width_array = numpy.array(self.widths, dtype=numpy.int8)
+
+
+def LoadTrieFile(filename):
+  table = triefile.Open(filename)
+  return Table([table.Row(state) for state in xrange(table.states)],
+               [table.Accept(state) for state in xrange(table.states)],
+               table.start)
+
+
+def _Ints(text):
+  return [int(value) for value in re.findall(r'\d+', text)]
+
+
+# Reads the dense table, trie_start and the trie_accepts_* range checks
+# written by trie_to_c.py.
+def LoadHeader(filename):
+  with open(filename) as fh:
+    text = re.sub(r'/\*.*?\*/', '', fh.read(), flags=re.DOTALL)
+  match = re.search(r'trie_table\[\]\[256\] = \{(.*?)\};', text, re.DOTALL)
+  if match is None:
+    raise ValueError('%s: no dense trie_table, generate it with '
+                     '--encoding=dense' % filename)
+  values = _Ints(match.group(1))
+  rows = [values[index:index + 256] for index in xrange(0, len(values), 256)]
+  match = re.search(r'trie_start = (\d+);', text)
+  if match is None:
+    raise ValueError('%s: no trie_start' % filename)
+  start = int(match.group(1))
+  accepts = [False] * len(rows)
+  for name, expr in re.findall(
+      r'trie_accepts_(\w+)\(int node_id\) \{\s*return (.*?);', text):
+    bounds = _Ints(expr)
+    for state in xrange(bounds[0], bounds[-1] + 1):
+      accepts[state] = name == 'True' or name
+  return Table(rows, accepts, start)
+
+
+def LoadTable(filename):
+  if filename.endswith('.h'):
+    return LoadHeader(filename)
+  return LoadTrieFile(filename)
+
+
+# Returns the .text section of an ELF64 file, or the data itself if it is
+# not an ELF file.
+def TextSection(data):
+  if not data.startswith('\x7fELF'):
+    return data
+  if data[4] != '\x02' or data[5] != '\x01':
+    raise ValueError('only little-endian ELF64 files are supported')
+  (shoff,) = struct.unpack_from('<Q', data, 0x28)
+  shentsize, shnum, shstrndx = struct.unpack_from('<HHH', data, 0x3a)
+  sections = [struct.unpack_from('<IIQQQQ', data, shoff + index * shentsize)
+              for index in xrange(shnum)]
+  names = sections[shstrndx][4]
+  for name, _, _, _, offset, size in sections:
+    end = data.index('\0', names + name)
+    if data[names + name:end] == '.text':
+      return data[offset:offset + size]
+  raise ValueError('no .text section')
+
+
+def _Displacement(data, end, width):
+  if width == 1:
+    return struct.unpack('<b', str(data[end - 1:end]))[0]
+  return struct.unpack('<i', str(data[end - 4:end]))[0]
+
+
+# Scans one blob.  Returns (error, starts, jumps): the offset at which no
+# instruction matches or None, the offsets of the instructions, and the
+# (source, destination) offsets of the direct jumps.
+def ScanBlob(table, data):
+  flat = table.flat
+  kinds = table.kinds
+  widths = table.widths
+  size = len(data)
+  starts = []
+  jumps = []
+  pos = 0
+  while pos < size:
+    state = table.start
+    last = -1
+    last_state = 0
+    index = pos
+    while index < size:
+      state = flat[state * 256 + data[index]]
+      index += 1
+      if state == 0:
+        break
+      kind = kinds[state]
+      if kind != NONE:
+        last = index
+        last_state = state
+        if kind == END:
+          break
+    if last < 0:
+      return pos, starts, jumps
+    starts.append(pos)
+    width = widths[last_state]
+    if width:
+      jumps.append((pos, last + _Displacement(data, last, width)))
+    pos = last
+  return None, starts, jumps
+
+
+# Like ValidateBlobs, but advancing a lane per blob in lockstep with
+# numpy.  Each step costs a few dozen whole-array
+# operations, so this only pays off with hundreds of lanes.
+def ValidateBlobsLockstep(table, blobs):
+  count = len(blobs)
+  if not count:
+    return []
+  sizes = numpy.array([len(blob) for blob in blobs], dtype=numpy.int64)
+  bases = numpy.zeros(count, dtype=numpy.int64)
+  bases[1:] = numpy.cumsum(sizes)[:-1]
+  limits = bases + sizes
+  data = numpy.frombuffer(''.join(str(blob) for blob in blobs),
+                          dtype=numpy.uint8)
+  # Pad, so that lanes at the end of their blob can read a byte too.
+  data = numpy.concatenate([data, numpy.zeros(1, dtype=numpy.uint8)])
+  starts = numpy.zeros(len(data), dtype=bool)
+  errors = numpy.full(count, -1, dtype=numpy.int64)
+  jump_lanes = []
+  jump_sources = []
+  jump_dests = []
+
+  # Positions are absolute offsets into |data|.
+  begin = bases.copy()
+  pos = bases.copy()
+  state = numpy.full(count, table.start, dtype=numpy.int32)
+  last = numpy.full(count, -1, dtype=numpy.int64)
+  last_state = numpy.zeros(count, dtype=numpy.int32)
+  active = sizes > 0
+
+  while active.any():
+    # A lane at the end of its blob takes its longest match so far.
+    at_end = active & (pos == limits)
+    stepping = active & ~at_end
+    state = numpy.where(stepping,
+                        table.flat_array[state * 256 + data[pos]], state)
+    pos += stepping
+    kinds = table.kind_array[state]
+    accepting = stepping & (kinds != NONE)
+    last = numpy.where(accepting, pos, last)
+    last_state = numpy.where(accepting, state, last_state)
+    ended = stepping & (kinds == END)
+    finished = at_end | (stepping & (state == 0))
+    failed = finished & (last < 0)
+    if failed.any():
+      errors[failed] = begin[failed] - bases[failed]
+      active &= ~failed
+    matched = numpy.flatnonzero(ended | (finished & (last >= 0)))
+    if not len(matched):
+      continue
+    end = numpy.where(ended, pos, last)[matched]
+    end_state = numpy.where(ended, state, last_state)[matched]
+    starts[begin[matched]] = True
+    widths = table.width_array[end_state]
+    for width in (1, 4):
+      selected = widths == width
+      if not selected.any():
+        continue
+      jump_end = end[selected]
+      disp = numpy.zeros(len(jump_end), dtype=numpy.int64)
+      for byte in xrange(width):
+        disp |= data[jump_end - width + byte].astype(numpy.int64) << 8 * byte
+      disp = disp.astype(numpy.uint8 if width == 1 else numpy.uint32)
+      disp = disp.astype(numpy.int8 if width == 1 else numpy.int32)
+      lanes = matched[selected]
+      jump_lanes.append(lanes)
+      jump_sources.append(begin[lanes] - bases[lanes])
+      jump_dests.append(jump_end + disp - bases[lanes])
+    begin[matched] = end
+    pos[matched] = end
+    state[matched] = table.start
+    last[matched] = -1
+    active[matched] = end < limits[matched]
+
+  # The CheckJumpTargets check on the bitmaps of all lanes at once.
+  bad_jumps = {}
+  if jump_lanes:
+    jump_lanes = numpy.concatenate(jump_lanes)
+    jump_sources = numpy.concatenate(jump_sources)
+    jump_dests = numpy.concatenate(jump_dests)
+    inside = (jump_dests >= 0) & (jump_dests < sizes[jump_lanes])
+    targets = bases[jump_lanes] + numpy.where(inside, jump_dests, 0)
+    bad = numpy.flatnonzero(inside & ~starts[targets])
+    for index in bad[numpy.lexsort((jump_sources[bad], jump_lanes[bad]))]:
+      bad_jumps.setdefault(int(jump_lanes[index]),
+                           (int(jump_sources[index]),
+                            int(jump_dests[index])))
+  results = []
+  for lane in xrange(count):
+    if errors[lane] >= 0:
+      results.append(NoMatchError(blobs[lane], errors[lane]))
+    elif lane in bad_jumps:
+      results.append(BadJumpError(*bad_jumps[lane]))
+    else:
+      results.append(None)
+  return results
+
+
+def NoMatchError(blob, offset):
+  return 'no instruction matches at %x (byte 0x%02x)' % (offset,
+                                                          ord(blob[offset]))
+
+
+def BadJumpError(source, dest):
+  return 'bad jump at %x to %x' % (source, dest)
+
+
+# Reproduces CheckJumpTargets: every direct jump or call to an offset
+# within the blob must land on the start of an instruction.  Targets
+# outside the blob, such as calls into the PLT, are not checked.
+def CheckJumpTargets(size, starts, jumps):
+  valid_targets = set(starts)
+  for source, dest in sorted(jumps):
+    if 0 <= dest < size and dest not in valid_targets:
+      return BadJumpError(source, dest)
+  return None
+
+
+# Validates a list of blobs.  Returns an error message or None for each.
+def ValidateBlobs(table, blobs, use_numpy=True):
+  if (use_numpy and numpy is not None and
+      len(blobs) >= LOCKSTEP_MIN_BLOBS):
+    return ValidateBlobsLockstep(table, blobs)
+  results = []
+  for blob in blobs:
+    error, starts, jumps = ScanBlob(table, bytearray(blob))
+    if error is not None:
+      results.append(NoMatchError(blob, error))
+    else:
+      results.append(CheckJumpTargets(len(blob), starts, jumps))
+  return results
+
+
+# The table of a worker process, see ValidateFiles.
+worker_table = None
+worker_use_numpy = True
+
+
+def _InitWorker(table_file, use_numpy):
+  global worker_table, worker_use_numpy
+  worker_table = LoadTable(table_file)
+  worker_use_numpy = use_numpy
+
+
+def _ValidateBatch(filenames):
+  blobs = []
+  results = []
+  for filename in filenames:
+    try:
+      with open(filename, 'rb') as fh:
+        blobs.append(TextSection(fh.read()))
+    except (IOError, ValueError), e:
+      blobs.append(None)
+      results.append(str(e))
+  valid = [blob for blob in blobs if blob is not None]
+  checked = iter(ValidateBlobs(worker_table, valid, worker_use_numpy))
+  return [(filename, checked.next() if blob is not None else results.pop(0))
+          for filename, blob in zip(filenames, blobs)]
+
+
+# Yields (filename, error message or None) for every file, validating
+# batches of |batch_size| files on |jobs| processes.
+def ValidateFiles(table_file, filenames, jobs=1, batch_size=1024,
+                  use_numpy=True):
+  batches = [filenames[index:index + batch_size]
+             for index in xrange(0, len(filenames), batch_size)]
+  if jobs <= 1:
+    _InitWorker(table_file, use_numpy)
+    for batch in batches:
+      for result in _ValidateBatch(batch):
+        yield result
+    return
+  pool = multiprocessing.Pool(jobs, _InitWorker, (table_file, use_numpy))
+  try:
+    for results in pool.imap(_ValidateBatch, batches):
+      for result in results:
+        yield result
+  finally:
+    pool.terminate()
+
+
+def Main(args):
+  parser = optparse.OptionParser(usage='%prog [options] file...')
+  parser.add_option('-t', '--table', default='inst.trie',
+                    help='The .trie file or dense trie_table.h to '
+                         'validate against')
+  parser.add_option('-j', '--jobs', type='int', default=1,
+                    help='Number of processes')
+  parser.add_option('--batch-size', type='int', default=1024,
+                    help='Number of files validated together')
+  parser.add_option('--no-numpy', action='store_false', dest='use_numpy',
+                    default=True,
+                    help='Use the pure Python scanner even if numpy is '
+                         'available')
+  (options, filenames) = parser.parse_args(args)
+  if not filenames:
+    parser.error('no input files')
+  failures = 0
+  for filename, error in ValidateFiles(options.table, filenames,
+                                       options.jobs, options.batch_size,
+                                       options.use_numpy):
+    if error:
+      print '%s: %s' % (filename, error)
+      failures += 1
+  print '%i of %i files failed validation' % (failures, len(filenames))
+  return failures != 0
+
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))